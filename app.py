@@ -2,20 +2,34 @@
 # -*- coding: utf-8 -*-
 """My Perfumery v3 - نظام إدارة التركيبات العطرية مع MSDS و IFRA"""
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, make_response, Response
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, make_response, Response, g, has_app_context, has_request_context, send_file
+import click
 import sqlite3
 import os
 import sys
 import re
 import json
 import glob
+import hashlib
 import shutil
 import zipfile
+import zlib
+import base64
+import bisect
+import unicodedata
 import xml.etree.ElementTree as ET
 import tempfile
 import uuid
+import threading
+import weakref
+import time
+import multiprocessing
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
 from functools import wraps
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 
 # --- Path resolution: dev script, Docker, and PyInstaller-frozen desktop build ---
 IS_FROZEN = getattr(sys, 'frozen', False)
@@ -48,76 +62,377 @@ app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50 MB cap for uploads (MS
 
 DB_PATH = os.path.join(USER_DIR, 'database', 'perfume.db')
 BACKUP_DIR = os.path.join(USER_DIR, 'database', 'backups')
+FILES_DIR = os.path.join(USER_DIR, 'database', 'files')  # content-addressed material attachments
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 os.makedirs(BACKUP_DIR, exist_ok=True)
 
-MAX_BACKUPS = 20  # Keep last 20 backups
+MAX_BACKUPS = 20  # the newest 20 backups are always kept
+BACKUP_DAILY_DAYS = 90  # then the newest backup of each day, this far back
+BACKUP_MONTHLY_MONTHS = 24  # then the newest backup of each month, this far back
+BACKUP_BUDGET_MB = 500  # past this the oldest backups go, whatever the rules above keep
+
+# ===== File store =====
+# Material attachments live outside the database, in FILES_DIR, one file per
+# distinct content named by its SHA-256 (files/ab/cd/abcd…). material_files
+# rows keep the name/mime/size and the hash, so the same PDF attached to ten
+# materials is stored once, backups of perfume.db stay small, and downloads
+# are streamed from disk (send_file: Range, ETag = hash). Blobs are never
+# deleted with their row — a backup may still point at them — but by
+# prune_file_store() when no kept database references them any more.
+FILE_CHUNK = 1024 * 1024
+PRUNE_GRACE_SECONDS = 3600  # a blob just stored may not have its row committed yet
+
+def file_store_path(sha256):
+    return os.path.join(FILES_DIR, sha256[:2], sha256[2:4], sha256)
+
+def store_file(chunks):
+    """Write an iterable of byte chunks to the store; returns (sha256, size).
+    Content already stored is not written twice."""
+    os.makedirs(FILES_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=FILES_DIR, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+        sha256 = digest.hexdigest()
+        path = file_store_path(sha256)
+        if size and not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        elif size:
+            os.utime(path)  # fresh again: see PRUNE_GRACE_SECONDS
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return sha256, size
+
+def referenced_blobs(db_path, immutable=False):
+    """Hashes a database (live or backup) points at; none for a backup made
+    before attachments moved out of the database. immutable=True for a file
+    nothing else has open: no -wal/-shm is created beside it."""
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro{'&immutable=1' if immutable else ''}", uri=True, timeout=30)
+        try:
+            return {r[0] for r in conn.execute("SELECT DISTINCT sha256 FROM material_files WHERE sha256 IS NOT NULL")}
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return set()
+
+def prune_file_store():
+    """Delete stored blobs that neither the database nor any backup uses."""
+    if not os.path.isdir(FILES_DIR):
+        return 0
+    keep = referenced_blobs(DB_PATH) | backup_blobs()
+    removed = 0
+    cutoff = time.time() - PRUNE_GRACE_SECONDS
+    for path in glob.glob(os.path.join(FILES_DIR, '??', '??', '*')):
+        if os.path.basename(path) not in keep and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed += 1
+    if removed:
+        log(f"[FILES] Pruned {removed} unreferenced attachment(s)")
+    return removed
+
+BACKUP_STEP_PAGES = 1024  # pages copied per backup step; the source is unlocked in between
+backup_status = {'running': False}  # progress of the backup being taken, for the settings page
+_backup_lock = threading.Lock()
+
+def copy_database(src_path, dst_path, progress=None):
+    """Copy one SQLite database onto another with the backup API, in steps of
+    BACKUP_STEP_PAGES. Unlike a file copy this is a consistent snapshot that
+    includes commits still in the -wal file, and readers and writers of the
+    source carry on meanwhile. progress(remaining, total) after each step."""
+    src = sqlite3.connect(src_path, timeout=30)
+    dst = sqlite3.connect(dst_path, timeout=30)
+    try:
+        src.backup(dst, pages=BACKUP_STEP_PAGES, sleep=0.005,
+                   progress=(lambda status, remaining, total: progress(remaining, total)) if progress else None)
+    finally:
+        dst.close()
+        src.close()
+
+def integrity_problems(path):
+    """PRAGMA integrity_check of a database file; [] when it is sound."""
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        rows = [r[0] for r in conn.execute("PRAGMA integrity_check").fetchall()]
+    except sqlite3.DatabaseError as e:  # too damaged to even check
+        rows = [str(e)]
+    finally:
+        conn.close()
+    return [] if rows == ['ok'] else rows
+
+# ===== Backup chain =====
+# A backup is not a copy of perfume.db but a list of chunk hashes. The
+# snapshot taken with copy_database() is cut into chunks of BACKUP_CHUNK_PAGES
+# pages and each distinct chunk is stored once, zlib-compressed, as
+# backups/chunks/ab/<sha256>.z — so a backup only adds the chunks whose pages
+# changed since the backups before it. backups/snapshots/<name>.json lists a
+# backup's chunks and the attachments it references; backups/manifest.json is
+# the index the settings page reads. Every backup is complete on its own:
+# restoring one is decompressing its chunks in order, wherever it sits in the
+# chain, and deleting one frees only the chunks no other backup uses.
+BACKUP_CHUNK_PAGES = 16
+
+def _manifest_path():
+    return os.path.join(BACKUP_DIR, 'manifest.json')
+
+def _snapshot_path(name):
+    return os.path.join(BACKUP_DIR, 'snapshots', name + '.json')
+
+def _chunk_path(sha256):
+    return os.path.join(BACKUP_DIR, 'chunks', sha256[:2], sha256 + '.z')
+
+def _read_json(path, default):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+def _write_json(path, data):
+    """Written aside and renamed, so a crash never leaves half a file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+def load_backup_manifest():
+    return _read_json(_manifest_path(), {'backups': []})
+
+def backup_blobs():
+    """Attachment hashes referenced by any kept backup."""
+    blobs = set()
+    for b in load_backup_manifest()['backups']:
+        blobs.update(_read_json(_snapshot_path(b['filename']), {}).get('blobs', []))
+    return blobs
+
+def _store_snapshot(path, name, reason, created):
+    """Cut a database file into the chunk store; returns its manifest entry."""
+    with open(path, 'rb') as f:
+        page_size = int.from_bytes(f.read(100)[16:18], 'big')
+        page_size = 65536 if page_size == 1 else page_size  # how the header spells 64 KiB
+        f.seek(0)
+        chunks, added = [], 0
+        for data in iter(lambda: f.read(page_size * BACKUP_CHUNK_PAGES), b''):
+            sha256 = hashlib.sha256(data).hexdigest()
+            chunks.append(sha256)
+            chunk = _chunk_path(sha256)
+            if not os.path.exists(chunk):
+                packed = zlib.compress(data, 6)
+                os.makedirs(os.path.dirname(chunk), exist_ok=True)
+                with open(chunk + '.tmp', 'wb') as out:
+                    out.write(packed)
+                os.replace(chunk + '.tmp', chunk)
+                added += len(packed)
+    size = os.path.getsize(path)
+    _write_json(_snapshot_path(name), {
+        'size': size, 'page_size': page_size, 'chunks': chunks,
+        'blobs': sorted(referenced_blobs(path, immutable=True)),
+    })
+    return {'filename': name, 'created': created.strftime('%Y-%m-%d %H:%M:%S'),
+            'reason': reason, 'size': size, 'added': added}
+
+def _materialise_snapshot(name, dst_path):
+    """Rebuild a backup's database file from its chunks."""
+    snapshot = _read_json(_snapshot_path(name), None)
+    if snapshot is None:
+        raise FileNotFoundError(f'snapshot {name} is missing')
+    with open(dst_path, 'wb') as out:
+        for sha256 in snapshot['chunks']:
+            with open(_chunk_path(sha256), 'rb') as f:
+                data = zlib.decompress(f.read())
+            if hashlib.sha256(data).hexdigest() != sha256:
+                raise ValueError(f'chunk {sha256[:12]} is damaged')
+            out.write(data)
+
+def _expired_backups(backups, now):
+    """Names no retention rule keeps: the newest MAX_BACKUPS, then the newest
+    of each day for BACKUP_DAILY_DAYS, then of each month for BACKUP_MONTHLY_MONTHS."""
+    keep = {b['filename'] for b in backups[-MAX_BACKUPS:]}
+    days, months = set(), set()
+    for b in reversed(backups):  # newest first, so the first one seen per day/month is kept
+        created = datetime.strptime(b['created'], '%Y-%m-%d %H:%M:%S')
+        month = (created.year, created.month)
+        if (now - created).days < BACKUP_DAILY_DAYS and created.date() not in days:
+            days.add(created.date())
+            keep.add(b['filename'])
+        if (now.year - created.year) * 12 + now.month - created.month < BACKUP_MONTHLY_MONTHS and month not in months:
+            months.add(month)
+            keep.add(b['filename'])
+    return {b['filename'] for b in backups if b['filename'] not in keep}
+
+def backup_chain_bytes():
+    return sum(os.path.getsize(p) for p in glob.glob(os.path.join(BACKUP_DIR, 'chunks', '??', '*.z')))
+
+def _drop_backups(manifest, names):
+    """Remove backups from the chain and free the chunks only they used."""
+    manifest['backups'] = [b for b in manifest['backups'] if b['filename'] not in names]
+    # Manifest first: a crash part-way leaves unused chunks, never a listed
+    # backup with chunks missing
+    _write_json(_manifest_path(), manifest)
+    for name in names:
+        if os.path.exists(_snapshot_path(name)):
+            os.remove(_snapshot_path(name))
+    live = set()
+    for b in manifest['backups']:
+        live.update(_read_json(_snapshot_path(b['filename']), {}).get('chunks', []))
+    for path in glob.glob(os.path.join(BACKUP_DIR, 'chunks', '??', '*.z')):
+        if os.path.basename(path)[:-2] not in live:
+            os.remove(path)
 
 def create_backup(reason='auto'):
     """Create a backup of the database"""
     if not os.path.exists(DB_PATH):
         return None
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_name = f"backup_{timestamp}_{reason}.db"
-    backup_path = os.path.join(BACKUP_DIR, backup_name)
-    shutil.copy2(DB_PATH, backup_path)
-    # Cleanup old backups
-    backups = sorted(glob.glob(os.path.join(BACKUP_DIR, 'backup_*.db')))
-    while len(backups) > MAX_BACKUPS:
-        os.remove(backups.pop(0))
-    log(f"[BACKUP] Created: {backup_name}")
+    with _backup_lock:
+        now = datetime.now()
+        manifest = load_backup_manifest()
+        taken = {b['filename'] for b in manifest['backups']}
+        backup_name = base_name = f"backup_{now:%Y%m%d_%H%M%S}_{reason}"
+        n = 1
+        while backup_name in taken:  # two backups within the same second
+            n += 1
+            backup_name = f"{base_name}_{n}"
+        # The snapshot is checked before any of it goes into the chain, so a
+        # backup listed in the settings page is always complete and sound
+        partial = os.path.join(BACKUP_DIR, '.snapshot.part')
+
+        def progress(remaining, total):
+            backup_status.update(pages_done=total - remaining, pages_total=total)
+
+        backup_status.clear()
+        backup_status.update(running=True, filename=backup_name, pages_done=0, pages_total=0)
+        try:
+            copy_database(DB_PATH, partial, progress)
+            problems = integrity_problems(partial)
+            if problems:
+                raise RuntimeError(f"Backup failed integrity check: {problems[0]}")
+            entry = _store_snapshot(partial, backup_name, reason, now)
+        finally:
+            backup_status['running'] = False
+            if os.path.exists(partial):
+                os.remove(partial)
+        manifest['backups'].append(entry)
+        _write_json(_manifest_path(), manifest)
+        # Thin out old backups
+        expired = _expired_backups(manifest['backups'], now)
+        if expired:
+            _drop_backups(manifest, expired)
+        while len(manifest['backups']) > 1 and backup_chain_bytes() > BACKUP_BUDGET_MB * 1024 * 1024:
+            _drop_backups(manifest, {manifest['backups'][0]['filename']})
+        # Attachments no longer referenced by the database or any kept backup
+        prune_file_store()
+    log(f"[BACKUP] Created: {backup_name} (+{entry['added'] // 1024} KB)")
     return backup_name
 
 def list_backups():
-    """List all available backups"""
-    backups = []
-    for f in sorted(glob.glob(os.path.join(BACKUP_DIR, 'backup_*.db')), reverse=True):
-        name = os.path.basename(f)
-        size = os.path.getsize(f)
-        # Parse timestamp from filename: backup_20260412_215443_auto.db
-        parts = name.replace('backup_', '').replace('.db', '').split('_')
-        if len(parts) >= 3:
-            date_str = parts[0]
-            time_str = parts[1]
-            reason = '_'.join(parts[2:])
+    """List all available backups, newest first — read from the manifest alone"""
+    return [{
+        'filename': b['filename'],
+        'date': b['created'],
+        'reason': b['reason'],
+        'size_kb': round(b['size'] / 1024, 1),
+        'added_kb': round(b['added'] / 1024, 1),
+    } for b in reversed(load_backup_manifest()['backups'])]
+
+def delete_backup(filename):
+    with _backup_lock:
+        manifest = load_backup_manifest()
+        if not any(b['filename'] == filename for b in manifest['backups']):
+            return False
+        _drop_backups(manifest, {filename})
+        prune_file_store()
+    log(f"[BACKUP] Deleted: {filename}")
+    return True
+
+def adopt_legacy_backups():
+    """Move the full-copy backups (backup_*.db) of older releases into the chain."""
+    legacy = sorted(glob.glob(os.path.join(BACKUP_DIR, 'backup_*.db')))
+    if not legacy:
+        return 0
+    with _backup_lock:
+        manifest = load_backup_manifest()
+        taken = {b['filename'] for b in manifest['backups']}
+        for path in legacy:
+            name = os.path.basename(path)[:-len('.db')]
+            # backup_20260412_215443_auto.db
+            parts = name.replace('backup_', '', 1).split('_')
             try:
-                dt = datetime.strptime(f"{date_str}_{time_str}", '%Y%m%d_%H%M%S')
-                formatted = dt.strftime('%Y-%m-%d %H:%M:%S')
-            except:
-                formatted = name
-        else:
-            formatted = name
-            reason = 'unknown'
-        backups.append({
-            'filename': name,
-            'date': formatted,
-            'reason': reason,
-            'size_kb': round(size / 1024, 1)
-        })
-    return backups
+                created = datetime.strptime('_'.join(parts[:2]), '%Y%m%d_%H%M%S')
+                reason = '_'.join(parts[2:]) or 'auto'
+            except ValueError:
+                created = datetime.fromtimestamp(os.path.getmtime(path))
+                reason = 'auto'
+            if name not in taken:
+                manifest['backups'].append(_store_snapshot(path, name, reason, created))
+        manifest['backups'].sort(key=lambda b: b['created'])
+        _write_json(_manifest_path(), manifest)
+        for path in legacy:
+            for leftover in (path, path + '-wal', path + '-shm'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+    log(f"[BACKUP] Moved {len(legacy)} full-copy backup(s) into the backup chain")
+    return len(legacy)
 
 def restore_backup(filename):
     """Restore database from backup, keeping admin credentials"""
-    backup_path = os.path.join(BACKUP_DIR, filename)
-    if not os.path.exists(backup_path):
+    if not any(b['filename'] == filename for b in load_backup_manifest()['backups']):
         return False, 'Backup not found'
-    # Save current admin credentials
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    admin = conn.execute("SELECT username, password, name, role FROM users WHERE id=1").fetchone()
-    admin_data = dict(admin) if admin else None
-    conn.close()
-    # Create a safety backup before restore
-    create_backup('pre_restore')
-    # Restore
-    shutil.copy2(backup_path, DB_PATH)
-    # Re-apply admin credentials
-    if admin_data:
+    # Rebuilt next to the live file (same filesystem, so the swap is a
+    # rename) and checked before anything else happens
+    staged = DB_PATH + '.restore'
+    try:
+        try:
+            with _backup_lock:  # its chunks cannot be freed meanwhile
+                _materialise_snapshot(filename, staged)
+        except (OSError, ValueError, zlib.error) as e:
+            log(f"[BACKUP] Not restoring {filename}: {e}")
+            return False, f'Backup is damaged: {e}'
+        problems = integrity_problems(staged)
+        if problems:
+            log(f"[BACKUP] Not restoring {filename}: {problems[0]}")
+            return False, f'Backup failed integrity check: {problems[0]}'
+        # Save current admin credentials
         conn = sqlite3.connect(DB_PATH)
-        conn.execute("UPDATE users SET username=?, password=?, name=?, role=? WHERE id=1",
-            (admin_data['username'], admin_data['password'], admin_data['name'], admin_data['role']))
-        conn.commit()
+        conn.row_factory = sqlite3.Row
+        admin = conn.execute("SELECT username, password, name, role FROM users WHERE id=1").fetchone()
+        admin_data = dict(admin) if admin else None
         conn.close()
+        # Create a safety backup before restore
+        create_backup('pre_restore')
+        if admin_data:
+            conn = sqlite3.connect(staged)
+            conn.execute("UPDATE users SET username=?, password=?, name=?, role=? WHERE id=1",
+                (admin_data['username'], admin_data['password'], admin_data['name'], admin_data['role']))
+            conn.commit()
+            conn.close()
+        # Swap while nothing has the database open: the old -wal/-shm belong
+        # to the file being replaced and must not be applied to the new one
+        try:
+            with quiesce_db():
+                for suffix in ('-wal', '-shm'):
+                    if os.path.exists(DB_PATH + suffix):
+                        os.remove(DB_PATH + suffix)
+                os.replace(staged, DB_PATH)
+        except TimeoutError:
+            return False, 'Database is busy, try again'
+    finally:
+        if os.path.exists(staged):
+            os.remove(staged)
+    # Backups from older releases are brought up to the current schema
+    migrate_db()
+    db_write(new_material_changes_epoch)
+    # In-memory IFRA data came from the replaced file; reloading the standards
+    # also reloads the contributions index and drops cached mixture limits
+    load_ifra_index()
+    refresh_material_typeahead(None)
+    invalidate_etags()
     log(f"[BACKUP] Restored from: {filename}")
     return True, 'Restored successfully'
 
@@ -506,85 +821,108 @@ GHS_SIGNAL_WORDS = ['Warning', 'Danger']
 GHS_CLASSIFICATIONS = ['Irritant', 'Oxidizing', 'Flammable', 'Environmentally Damaging', 'Corrosive', 'Toxic', 'Health Hazard', 'Compressed Gas', 'Explosive']
 
 # ===== قاعدة البيانات =====
-def get_db():
-    if not os.path.exists(DB_PATH):
-        init_db()
-    conn = sqlite3.connect(DB_PATH, timeout=30)
-    conn.row_factory = sqlite3.Row
-    # إنشاء جدول البروفايل العطري لو ما كان موجود
-    conn.execute('''CREATE TABLE IF NOT EXISTS material_olfactive (
-        material_id INTEGER PRIMARY KEY,
-        citrus INTEGER DEFAULT 0, aldehydic INTEGER DEFAULT 0, aromatic INTEGER DEFAULT 0,
-        green INTEGER DEFAULT 0, marine INTEGER DEFAULT 0, floral INTEGER DEFAULT 0,
-        fruity INTEGER DEFAULT 0, spicy INTEGER DEFAULT 0, balsamic INTEGER DEFAULT 0,
-        woody INTEGER DEFAULT 0, ambery INTEGER DEFAULT 0, musky INTEGER DEFAULT 0,
-        leathery INTEGER DEFAULT 0, animal INTEGER DEFAULT 0,
-        FOREIGN KEY (material_id) REFERENCES materials(id)
-    )''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS formula_notes (
+# Staged IFRA standards workbooks (e.g. a new amendment), kept side by side
+# with the live ifra_standards / ifra_cas_lookup pair for impact analysis.
+IFRA_AMENDMENT_DDL = (
+    '''CREATE TABLE IF NOT EXISTS ifra_amendments (
         id INTEGER PRIMARY KEY,
-        formula_id INTEGER,
-        title TEXT,
-        content TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (formula_id) REFERENCES formulas(id) ON DELETE CASCADE
-    )''')
-    # Migrate: add columns if missing
-    existing = [row[1] for row in conn.execute("PRAGMA table_info(formulas)").fetchall()]
-    for col in ['target_audience', 'age_group', 'gender', 'season', 'occasion', 'scent_type', 'review_notes', 'card_settings']:
-        if col not in existing:
-            conn.execute(f"ALTER TABLE formulas ADD COLUMN {col} TEXT DEFAULT ''")
-    # Migrate: add ifra_override to formula_ingredients
-    fi_cols = [row[1] for row in conn.execute("PRAGMA table_info(formula_ingredients)").fetchall()]
-    if 'ifra_override' not in fi_cols:
-        conn.execute("ALTER TABLE formula_ingredients ADD COLUMN ifra_override REAL DEFAULT NULL")
-    # Draft system tables
-    conn.execute('''CREATE TABLE IF NOT EXISTS formula_drafts (
+        label TEXT,
+        filename TEXT,
+        amendment INTEGER,
+        standards_count INTEGER DEFAULT 0,
+        imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS ifra_amendment_standards (
         id INTEGER PRIMARY KEY,
-        formula_id INTEGER,
-        draft_number INTEGER,
+        amendment_id INTEGER NOT NULL,
+        ifra_key TEXT,
         name TEXT,
-        notes TEXT,
-        is_final INTEGER DEFAULT 0,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (formula_id) REFERENCES formulas(id) ON DELETE CASCADE
-    )''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS draft_ingredients (
+        cas_numbers TEXT,
+        synonyms TEXT,
+        standard_type TEXT,
+        amendment INTEGER,
+        year_published TEXT,
+        risk_property TEXT,
+        restriction_notes TEXT,
+        specification_notes TEXT,
+        contributions TEXT,
+        cat1 REAL, cat2 REAL, cat3 REAL, cat4 REAL,
+        cat5a REAL, cat5b REAL, cat5c REAL, cat5d REAL,
+        cat6 REAL, cat7a REAL, cat7b REAL, cat8 REAL,
+        cat9 REAL, cat10a REAL, cat10b REAL,
+        cat11a REAL, cat11b REAL, cat12 REAL,
+        UNIQUE (amendment_id, ifra_key),
+        FOREIGN KEY (amendment_id) REFERENCES ifra_amendments(id) ON DELETE CASCADE
+    )''',
+    '''CREATE TABLE IF NOT EXISTS ifra_amendment_cas (
         id INTEGER PRIMARY KEY,
-        draft_id INTEGER,
-        material_id INTEGER,
-        weight REAL DEFAULT 0,
-        dilution REAL DEFAULT 0,
-        diluent TEXT DEFAULT '',
-        diluent_other TEXT DEFAULT '',
-        notes TEXT,
-        ifra_override REAL DEFAULT NULL,
-        FOREIGN KEY (draft_id) REFERENCES formula_drafts(id) ON DELETE CASCADE
-    )''')
-    return conn
+        amendment_id INTEGER NOT NULL,
+        cas_number TEXT,
+        ifra_key TEXT,
+        FOREIGN KEY (amendment_id) REFERENCES ifra_amendments(id) ON DELETE CASCADE
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_ifra_amendment_cas ON ifra_amendment_cas(amendment_id, cas_number)",
+)
 
-def init_db():
-    log("[DB] Initializing database...")
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
+# Evaluation frozen when a draft is approved (see freeze_formula_snapshot).
+# payload is compact JSON; content_hash is the SHA-256 of it, so approving
+# the same content twice reuses one row.
+FORMULA_SNAPSHOTS_DDL = '''CREATE TABLE IF NOT EXISTS formula_snapshots (
+    id INTEGER PRIMARY KEY,
+    formula_id INTEGER NOT NULL,
+    draft_id INTEGER,
+    content_hash TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (formula_id, content_hash),
+    FOREIGN KEY (formula_id) REFERENCES formulas(id) ON DELETE CASCADE
+)'''
+
+# ===== Schema migrations =====
+# PRAGMA user_version is the number of MIGRATIONS applied to a database.
+# migrate_db() runs the missing ones in order, each in one transaction with
+# its user_version bump and schema_migrations row. It runs at bootstrap() and
+# on first use of a database file (a restored backup, a CLI command), never
+# per request. Migration 1 is the schema the old init_db()/get_db() pair
+# converged on; it only uses IF NOT EXISTS / missing-column checks so any
+# database created by an earlier release can run it. Append new migrations
+# at the end — never edit or reorder an applied one.
+MIGRATIONS = []  # [(version, name, fn(conn))]
+
+def migration(name, vacuum=False):
+    """Register fn(conn) as the next schema migration. vacuum=True for one
+    that frees a lot of space: the file is VACUUMed once it has committed."""
+    def register(fn):
+        fn.vacuum = vacuum
+        MIGRATIONS.append((len(MIGRATIONS) + 1, name, fn))
+        return fn
+    return register
+
+def _add_columns(conn, table, columns):
+    """ALTER TABLE ADD COLUMN for each (name, type) the table does not have."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    for column, dtype in columns:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {dtype}")
+
+@migration('base schema and default data')
+def _migrate_base_schema(c):
     c.execute('''CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT, name TEXT, role TEXT DEFAULT 'user'
     )''')
-    
+
     c.execute('''CREATE TABLE IF NOT EXISTS company_info (
         id INTEGER PRIMARY KEY, name TEXT, address TEXT, phone TEXT, email TEXT, website TEXT, logo_path TEXT
     )''')
-    
+
     c.execute('''CREATE TABLE IF NOT EXISTS suppliers (
         id INTEGER PRIMARY KEY, name TEXT, country TEXT, email TEXT, phone TEXT, website TEXT, notes TEXT
     )''')
-    
+
     c.execute('''CREATE TABLE IF NOT EXISTS families (
         id INTEGER PRIMARY KEY, name TEXT, name_ar TEXT, description TEXT, icon TEXT
     )''')
-    
+
     c.execute('''CREATE TABLE IF NOT EXISTS materials (
         id INTEGER PRIMARY KEY, name TEXT, name_ar TEXT, cas_number TEXT,
         family_id INTEGER, profile TEXT DEFAULT 'Heart', supplier_id INTEGER,
@@ -596,7 +934,7 @@ def init_db():
         synonyms TEXT, lot TEXT, strength_odor TEXT, vapor_pressure TEXT,
         effect TEXT, recommended_smell_pct TEXT, properties TEXT, in_stock REAL DEFAULT 0
     )''')
-    
+
     c.execute('''CREATE TABLE IF NOT EXISTS ifra_standards (
         id INTEGER PRIMARY KEY,
         ifra_key TEXT UNIQUE,
@@ -665,7 +1003,7 @@ def init_db():
         leathery INTEGER DEFAULT 0, animal INTEGER DEFAULT 0,
         FOREIGN KEY (material_id) REFERENCES materials(id)
     )''')
-    
+
     c.execute('''CREATE TABLE IF NOT EXISTS formulas (
         id INTEGER PRIMARY KEY, name TEXT, description TEXT, ifra_category TEXT DEFAULT 'cat4',
         status TEXT DEFAULT 'draft', notes TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -675,21 +1013,21 @@ def init_db():
         season TEXT DEFAULT '', occasion TEXT DEFAULT '', scent_type TEXT DEFAULT '',
         review_notes TEXT DEFAULT ''
     )''')
-    # Add review columns if they don't exist (for existing databases)
-    for col in ['target_audience', 'age_group', 'gender', 'season', 'occasion', 'scent_type', 'review_notes']:
-        try:
-            c.execute(f"ALTER TABLE formulas ADD COLUMN {col} TEXT DEFAULT ''")
-        except:
-            pass
-    
+    # Add review / card columns if they don't exist (for existing databases)
+    _add_columns(c, 'formulas', [(col, "TEXT DEFAULT ''") for col in
+                                 ['target_audience', 'age_group', 'gender', 'season', 'occasion',
+                                  'scent_type', 'review_notes', 'card_settings']])
+
     c.execute('''CREATE TABLE IF NOT EXISTS formula_ingredients (
         id INTEGER PRIMARY KEY, formula_id INTEGER, material_id INTEGER,
-        weight REAL DEFAULT 0, dilution REAL DEFAULT 0, 
+        weight REAL DEFAULT 0, dilution REAL DEFAULT 0,
         diluent TEXT DEFAULT '', diluent_other TEXT DEFAULT '',
         notes TEXT,
         FOREIGN KEY (formula_id) REFERENCES formulas(id) ON DELETE CASCADE
     )''')
-    
+
+    _add_columns(c, 'formula_ingredients', [('ifra_override', 'REAL DEFAULT NULL')])
+
     c.execute('''CREATE TABLE IF NOT EXISTS formula_notes (
         id INTEGER PRIMARY KEY,
         formula_id INTEGER,
@@ -756,7 +1094,7 @@ def init_db():
     c.execute("INSERT OR IGNORE INTO company_info (id, name, address, phone, email) VALUES (1, 'My Perfumery', 'Kuwait', '+965 xxxx xxxx', 'info@myperfumery.com')")
     # Rebrand stale company name
     c.execute("UPDATE company_info SET name='My Perfumery' WHERE LOWER(TRIM(name)) IN ('perfume vault', 'perfumevault', 'perfume-vault')")
-    
+
     # حذف العوائل القديمة وإعادة إضافتها بدون تكرار
     c.execute("DELETE FROM families")
     families = [
@@ -770,9 +1108,7 @@ def init_db():
     ]
     for i, (name, name_ar, icon) in enumerate(families, 1):
         c.execute("INSERT INTO families (id, name, name_ar, icon) VALUES (?, ?, ?, ?)", (i, name, name_ar, icon))
-    
-    conn.commit()
-    
+
     # تحديث الجداول القديمة - إضافة أعمدة جديدة إذا لم تكن موجودة
     new_columns = [
         ('materials', 'flash_point', 'TEXT'),
@@ -805,19 +1141,993 @@ def init_db():
         ('formulas', 'sample_weight', 'REAL'),
     ]
     for table, column, dtype in new_columns:
-        try:
-            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {dtype}")
-        except: pass
-    
-    conn.commit()
+        _add_columns(c, table, [(column, dtype)])
+
+@migration('material composition closure')
+def _migrate_composition_closure(conn):
+    # Transitive closure of material_composition, one row per path from a
+    # mixture to each direct/indirect component (max depth 5). effective_pct
+    # is the component's share of 100% of the ancestor; seq keeps the
+    # depth-first order of the walk. Rebuilt by rebuild_composition_closure().
+    conn.execute('''CREATE TABLE IF NOT EXISTS material_composition_closure (
+        ancestor_id INTEGER NOT NULL,
+        descendant_id INTEGER NOT NULL,
+        depth INTEGER NOT NULL,
+        effective_pct REAL NOT NULL,
+        pct_in_parent REAL NOT NULL,
+        path TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        PRIMARY KEY (ancestor_id, seq)
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_composition_closure_descendant ON material_composition_closure(descendant_id)")
+    rebuild_composition_closure(conn)
+
+@migration('IFRA amendment staging tables')
+def _migrate_ifra_amendments(conn):
+    for ddl in IFRA_AMENDMENT_DDL:
+        conn.execute(ddl)
+
+@migration('approved formula snapshots')
+def _migrate_formula_snapshots(conn):
+    conn.execute(FORMULA_SNAPSHOTS_DDL)
+    _add_columns(conn, 'formulas', [('snapshot_id', 'INTEGER DEFAULT NULL')])
+
+# Secondary indexes for the per-formula / per-material lookups in HOT_QUERIES.
+# Trailing columns make them covering where the query reads only those
+# (the formulas list totals, the olfactive weights, the files list, which
+# would otherwise walk each row's BLOB overflow pages). `id` right after
+# formula_id keeps ingredients in insertion order for the queries that have
+# no ORDER BY, as they were when read from the table. ifra_cas_lookup and
+# ifra_contributions are read whole into the in-memory IFRA indices, so they
+# get none. Change the set with a new migration; `flask db-plan` checks it.
+HOT_INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS idx_formula_ingredients_formula ON formula_ingredients(formula_id, id, material_id, weight, dilution)",
+    "CREATE INDEX IF NOT EXISTS idx_formula_ingredients_material ON formula_ingredients(material_id)",
+    "CREATE INDEX IF NOT EXISTS idx_formula_drafts_formula ON formula_drafts(formula_id, draft_number)",
+    "CREATE INDEX IF NOT EXISTS idx_draft_ingredients_draft ON draft_ingredients(draft_id)",
+    "CREATE INDEX IF NOT EXISTS idx_formula_notes_formula ON formula_notes(formula_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_material_composition_parent ON material_composition(parent_material_id, component_material_id, pct)",
+    "CREATE INDEX IF NOT EXISTS idx_material_composition_component ON material_composition(component_material_id)",
+    "CREATE INDEX IF NOT EXISTS idx_material_files_material ON material_files(material_id, uploaded_at, filename, mime_type, size)",
+    "CREATE INDEX IF NOT EXISTS idx_production_orders_status ON production_orders(status)",
+)
+
+@migration('indexes for hot lookups')
+def _migrate_hot_indexes(conn):
+    for ddl in HOT_INDEX_DDL:
+        conn.execute(ddl)
+
+@migration('material files moved to the file store', vacuum=True)
+def _migrate_file_store(conn):
+    _add_columns(conn, 'material_files', [('sha256', 'TEXT')])
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_material_files_sha256 ON material_files(sha256)")
+    ids = [r[0] for r in conn.execute(
+        "SELECT id FROM material_files WHERE content IS NOT NULL AND sha256 IS NULL").fetchall()]
+    for fid in ids:  # one BLOB in memory at a time
+        content = conn.execute("SELECT content FROM material_files WHERE id=?", (fid,)).fetchone()[0]
+        sha256, size = store_file([bytes(content)])
+        conn.execute("UPDATE material_files SET sha256=?, size=?, content=NULL WHERE id=?", (sha256, size, fid))
+    if ids:
+        log(f"[FILES] Moved {len(ids)} attachment(s) out of the database")
+
+# One row per formula with what the formulas list shows: ingredient count,
+# total weight and cost, ingredient names (JSON, in ingredient order) and,
+# per olfactive axis, the sum of axis × pure weight (weight × dilution) — the
+# profile is that over pure_weight. Kept current by the triggers below, so
+# every write path (ingredient edits, drafts, imports, material price or
+# olfactive changes, restores) updates it without knowing it exists.
+# Columns without a declared type keep ints and floats as SUM() returned them.
+FORMULA_SUMMARY_DDL = f'''CREATE TABLE IF NOT EXISTS formula_summary (
+    formula_id INTEGER PRIMARY KEY,
+    ingredients_count INTEGER DEFAULT 0, total_weight DEFAULT 0, total_cost DEFAULT 0,
+    ingredient_names TEXT DEFAULT '[]', pure_weight DEFAULT 0,
+    {', '.join(OLFACTIVE_CATEGORIES)}
+)'''
+
+def formula_summary_sql(formula_ids):
+    """Recompute the formula_summary rows of `formula_ids`, an SQL expression
+    (a subquery, a parameter list, NEW.formula_id in a trigger)."""
+    pure = "fi.weight * COALESCE(NULLIF(fi.dilution, 0), 1)"  # as `dilution or 1`
+    # NULLIF: an axis at 0 adds nothing, and one no ingredient has stays NULL
+    axes = ', '.join(f"SUM({pure} * NULLIF(o.{cat}, 0))" for cat in OLFACTIVE_CATEGORIES)
+    return f'''INSERT OR REPLACE INTO formula_summary
+        (formula_id, ingredients_count, total_weight, total_cost, ingredient_names, pure_weight,
+         {', '.join(OLFACTIVE_CATEGORIES)})
+        SELECT f.id, COUNT(fi.id), COALESCE(SUM(fi.weight), 0),
+               COALESCE(SUM(fi.weight * m.price_per_gram), 0),
+               (SELECT json_group_array(name) FROM (
+                    SELECT m2.name FROM formula_ingredients fi2 JOIN materials m2 ON m2.id = fi2.material_id
+                    WHERE fi2.formula_id = f.id ORDER BY fi2.id)),
+               COALESCE(SUM({pure}), 0), {axes}
+        FROM formulas f
+        LEFT JOIN formula_ingredients fi ON fi.formula_id = f.id
+        LEFT JOIN materials m ON m.id = fi.material_id
+        LEFT JOIN material_olfactive o ON o.material_id = fi.material_id
+        WHERE f.id IN ({formula_ids})
+        GROUP BY f.id'''
+
+def _formula_summary_triggers():
+    using = lambda row: f"SELECT formula_id FROM formula_ingredients WHERE material_id = {row}"
+    refresh = {
+        'formulas_insert': ('AFTER INSERT ON formulas', 'NEW.id'),
+        'ingredients_insert': ('AFTER INSERT ON formula_ingredients', 'NEW.formula_id'),
+        'ingredients_update': ('AFTER UPDATE OF formula_id, material_id, weight, dilution ON formula_ingredients',
+                               'OLD.formula_id, NEW.formula_id'),
+        'ingredients_delete': ('AFTER DELETE ON formula_ingredients', 'OLD.formula_id'),
+        'materials_insert': ('AFTER INSERT ON materials', using('NEW.id')),
+        'materials_update': ('AFTER UPDATE OF name, price_per_gram ON materials WHEN '
+                             'OLD.name IS NOT NEW.name OR OLD.price_per_gram IS NOT NEW.price_per_gram',
+                             using('NEW.id')),
+        'materials_delete': ('AFTER DELETE ON materials', using('OLD.id')),
+        'olfactive_insert': ('AFTER INSERT ON material_olfactive', using('NEW.material_id')),
+        'olfactive_update': ('AFTER UPDATE ON material_olfactive', using('NEW.material_id')),
+        'olfactive_delete': ('AFTER DELETE ON material_olfactive', using('OLD.material_id')),
+    }
+    ddl = [f"CREATE TRIGGER IF NOT EXISTS formula_summary_{name} {event} BEGIN {formula_summary_sql(ids)}; END"
+           for name, (event, ids) in refresh.items()]
+    ddl.append("CREATE TRIGGER IF NOT EXISTS formula_summary_formulas_delete AFTER DELETE ON formulas "
+               "BEGIN DELETE FROM formula_summary WHERE formula_id = OLD.id; END")
+    return ddl
+
+@migration('formula summary')
+def _migrate_formula_summary(conn):
+    conn.execute(FORMULA_SUMMARY_DDL)
+    # The formulas list, newest first: ties (same second) in id order
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_formulas_created ON formulas(created_at DESC)")
+    for ddl in _formula_summary_triggers():
+        conn.execute(ddl)
+    conn.execute(formula_summary_sql("SELECT id FROM formulas"))
+
+# The materials catalogue pages through these orders (MATERIAL_SORTS): the
+# same expressions as the ORDER BY, id last, so a page and its keyset
+# condition are an index range instead of a sort of the whole table.
+CATALOGUE_INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS idx_materials_sort_name ON materials(COALESCE(name, ''), id)",
+    "CREATE INDEX IF NOT EXISTS idx_materials_sort_price ON materials(COALESCE(price_per_gram, 0), id)",
+)
+
+@migration('materials catalogue sort indexes')
+def _migrate_catalogue_indexes(conn):
+    for ddl in CATALOGUE_INDEX_DDL:
+        conn.execute(ddl)
+
+# Full-text search over materials: materials_fts (FTS5, rowid = materials.id)
+# holds a folded copy of the searchable columns, kept in step by triggers.
+# Folding is plain SQL REPLACE()s so every connection (the sqlite3 shell
+# included) keeps the index right; fold_search_text() applies the same table
+# to a query. unicode61 then case-folds and strips Latin accents.
+SEARCH_COLUMNS = ('name', 'name_ar', 'synonyms', 'cas_number', 'odor_description')
+SEARCH_FOLD = (
+    [('أ', 'ا'), ('إ', 'ا'), ('آ', 'ا'), ('ٱ', 'ا'), ('ؤ', 'و'), ('ئ', 'ي'), ('ى', 'ي'), ('ة', 'ه')]
+    # Harakat, superscript alef, tatweel
+    + [(chr(c), '') for c in list(range(0x064B, 0x0653)) + [0x0670, 0x0640]]
+    # Separators the tokenizer would split on anyway: as spaces, a word after
+    # them starts with ' ' and loses its article below
+    + [(c, ' ') for c in '()[]{}<>«»"/\\,.;:!?-_+&*،؛؟\t\n']
+)
+SEARCH_ARTICLE = ' ال'
+
+_SEARCH_FOLD_TABLE = str.maketrans(dict(SEARCH_FOLD))
+
+def fold_search_text(text):
+    return (' ' + (text or '')).translate(_SEARCH_FOLD_TABLE).replace(SEARCH_ARTICLE, ' ')
+
+def fold_search_sql(source, columns, from_=''):
+    """SELECT id, `columns` of `source` (NEW or a table) as fold_search_text()
+    would give them. The REPLACE()s are nested a few at a time in subqueries:
+    SQLite's parser stack takes only about 30 nested calls."""
+    sql = (f"SELECT {source}.id AS id, "
+           + ', '.join(f"' ' || COALESCE({source}.{c}, '') AS {c}" for c in columns) + from_)
+    steps = SEARCH_FOLD + [(SEARCH_ARTICLE, ' ')]
+    for i in range(0, len(steps), 16):
+        folded = []
+        for c in columns:
+            expr = c
+            for a, b in steps[i:i + 16]:
+                expr = f"REPLACE({expr}, '{a}', '{b}')"
+            folded.append(f"{expr} AS {c}")
+        sql = f"SELECT id, {', '.join(folded)} FROM ({sql})"
+    return sql
+
+def fts_insert_sql(fts_table, columns, source, from_=''):
+    """(Re)index `source` rows into fts_table, rowid = their id."""
+    return (f"INSERT OR REPLACE INTO {fts_table} (rowid, {', '.join(columns)}) "
+            f"{fold_search_sql(source, columns, from_)}")
+
+def _materials_fts_insert(source, from_=''):
+    return fts_insert_sql('materials_fts', SEARCH_COLUMNS, source, from_)
+
+MATERIALS_FTS_DDL = (
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS materials_fts USING fts5(
+        {', '.join(SEARCH_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""",
+    f"CREATE TRIGGER IF NOT EXISTS materials_fts_insert AFTER INSERT ON materials "
+    f"BEGIN {_materials_fts_insert('NEW')}; END",
+    f"CREATE TRIGGER IF NOT EXISTS materials_fts_update AFTER UPDATE OF id, {', '.join(SEARCH_COLUMNS)} ON materials "
+    f"BEGIN DELETE FROM materials_fts WHERE rowid = OLD.id; {_materials_fts_insert('NEW')}; END",
+    "CREATE TRIGGER IF NOT EXISTS materials_fts_delete AFTER DELETE ON materials "
+    "BEGIN DELETE FROM materials_fts WHERE rowid = OLD.id; END",
+)
+
+@migration('materials full-text search')
+def _migrate_materials_fts(conn):
+    for ddl in MATERIALS_FTS_DDL:
+        conn.execute(ddl)
+    conn.execute(_materials_fts_insert('materials', ' FROM materials'))
+
+# The notebook list pages by updated_at through its own index, searches
+# notebook_fts (folded like materials_fts) and filters on notebook_tags:
+# the comma-separated `tags` of each entry as rows, split by trigger
+# (json_each over the list turned into a JSON array; a list that still
+# isn't valid JSON gets no tag rows rather than failing the save).
+NOTEBOOK_SEARCH_COLUMNS = ('title', 'tags', 'body')
+
+def _notebook_tags_insert(row, from_=''):
+    tags = f"REPLACE(REPLACE(COALESCE({row}.tags, ''), '\\', '\\\\'), '\"', '\\\"')"
+    for ch in ('char(9)', 'char(10)', 'char(13)'):
+        tags = f"REPLACE({tags}, {ch}, ' ')"
+    array = f"""'["' || REPLACE({tags}, ',', '","') || '"]'"""
+    return (f"INSERT OR IGNORE INTO notebook_tags (tag, entry_id) "
+            f"SELECT TRIM(value), {row}.id FROM {from_}json_each(CASE WHEN json_valid({array}) THEN {array} ELSE '[]' END) "
+            f"WHERE TRIM(value) != ''")
+
+_NOTEBOOK_SEARCH_CHANGED = ' OR '.join(f"OLD.{c} IS NOT NEW.{c}" for c in NOTEBOOK_SEARCH_COLUMNS)
+NOTEBOOK_INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS idx_notebook_entries_updated ON notebook_entries(updated_at DESC, id DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_notebook_entries_category ON notebook_entries(category, updated_at DESC, id DESC)",
+    """CREATE TABLE IF NOT EXISTS notebook_tags (
+        tag TEXT NOT NULL,
+        entry_id INTEGER NOT NULL,
+        PRIMARY KEY (tag, entry_id)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_notebook_tags_entry ON notebook_tags(entry_id)",
+    f"CREATE TRIGGER IF NOT EXISTS notebook_tags_insert AFTER INSERT ON notebook_entries "
+    f"BEGIN {_notebook_tags_insert('NEW')}; END",
+    f"CREATE TRIGGER IF NOT EXISTS notebook_tags_update AFTER UPDATE OF id, tags ON notebook_entries "
+    f"WHEN OLD.id IS NOT NEW.id OR OLD.tags IS NOT NEW.tags "
+    f"BEGIN DELETE FROM notebook_tags WHERE entry_id = OLD.id; {_notebook_tags_insert('NEW')}; END",
+    "CREATE TRIGGER IF NOT EXISTS notebook_tags_delete AFTER DELETE ON notebook_entries "
+    "BEGIN DELETE FROM notebook_tags WHERE entry_id = OLD.id; END",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS notebook_fts USING fts5(
+        {', '.join(NOTEBOOK_SEARCH_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""",
+    f"CREATE TRIGGER IF NOT EXISTS notebook_fts_insert AFTER INSERT ON notebook_entries "
+    f"BEGIN {fts_insert_sql('notebook_fts', NOTEBOOK_SEARCH_COLUMNS, 'NEW')}; END",
+    # Autosave rewrites every column; only a change to the text reindexes it
+    f"CREATE TRIGGER IF NOT EXISTS notebook_fts_update AFTER UPDATE OF id, {', '.join(NOTEBOOK_SEARCH_COLUMNS)} "
+    f"ON notebook_entries WHEN OLD.id IS NOT NEW.id OR {_NOTEBOOK_SEARCH_CHANGED} "
+    f"BEGIN DELETE FROM notebook_fts WHERE rowid = OLD.id; "
+    f"{fts_insert_sql('notebook_fts', NOTEBOOK_SEARCH_COLUMNS, 'NEW')}; END",
+    "CREATE TRIGGER IF NOT EXISTS notebook_fts_delete AFTER DELETE ON notebook_entries "
+    "BEGIN DELETE FROM notebook_fts WHERE rowid = OLD.id; END",
+)
+
+@migration('notebook list index, tags and full-text search')
+def _migrate_notebook_search(conn):
+    for ddl in NOTEBOOK_INDEX_DDL:
+        conn.execute(ddl)
+    conn.execute(_notebook_tags_insert('notebook_entries', 'notebook_entries, '))
+    conn.execute(fts_insert_sql('notebook_fts', NOTEBOOK_SEARCH_COLUMNS, 'notebook_entries', ' FROM notebook_entries'))
+
+# One change counter per table the conditional GETs read (conditional_get):
+# every insert / update / delete on it bumps its table_versions row, from
+# this app or any other connection. Derived tables (formula_summary, the
+# closure) are counted themselves, so an endpoint lists what it reads.
+VERSIONED_TABLES = (
+    'materials', 'families', 'suppliers', 'material_olfactive', 'material_msds',
+    'material_composition', 'material_composition_closure',
+    'formulas', 'formula_ingredients', 'formula_summary',
+    'ifra_standards', 'ifra_cas_lookup', 'ifra_contributions',
+    'notebook_entries',
+)
+
+def _table_version_triggers():
+    return [f"CREATE TRIGGER IF NOT EXISTS table_version_{table}_{event.lower()} AFTER {event} ON {table} "
+            f"BEGIN UPDATE table_versions SET version = version + 1 WHERE name = '{table}'; END"
+            for table in VERSIONED_TABLES for event in ('INSERT', 'UPDATE', 'DELETE')]
+
+@migration('table version counters')
+def _migrate_table_versions(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS table_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID""")
+    conn.executemany("INSERT OR IGNORE INTO table_versions (name) VALUES (?)", [(t,) for t in VERSIONED_TABLES])
+    for ddl in _table_version_triggers():
+        conn.execute(ddl)
+
+# Append-only log of which materials changed, for delta sync
+# (/api/materials/changes): triggers add the material's id on any write to
+# it, its olfactive scores or its composition, and for every material of a
+# family / supplier whose name (or icon) changes — whichever code path wrote.
+# AUTOINCREMENT: a seq is never handed out twice, even after compaction.
+def _material_change_triggers(table, column):
+    log = "INSERT INTO material_changes (material_id)"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS material_changes_{table}_insert AFTER INSERT ON {table} "
+        f"BEGIN {log} VALUES (NEW.{column}); END",
+        f"CREATE TRIGGER IF NOT EXISTS material_changes_{table}_update AFTER UPDATE ON {table} "
+        f"BEGIN {log} SELECT OLD.{column} WHERE OLD.{column} IS NOT NEW.{column} "
+        f"UNION ALL SELECT NEW.{column}; END",
+        f"CREATE TRIGGER IF NOT EXISTS material_changes_{table}_delete AFTER DELETE ON {table} "
+        f"BEGIN {log} VALUES (OLD.{column}); END",
+    ]
+
+MATERIAL_CHANGES_DDL = (
+    """CREATE TABLE IF NOT EXISTS material_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        material_id INTEGER NOT NULL
+    )""",
+    # One row: names this log, so a copy synced against another database
+    # (a restored backup has its own history) is not patched with it
+    "CREATE TABLE IF NOT EXISTS material_changes_epoch (epoch TEXT NOT NULL)",
+    *_material_change_triggers('materials', 'id'),
+    *_material_change_triggers('material_olfactive', 'material_id'),
+    *_material_change_triggers('material_composition', 'parent_material_id'),
+    "CREATE TRIGGER IF NOT EXISTS material_changes_families_update AFTER UPDATE OF name, icon ON families "
+    "WHEN OLD.name IS NOT NEW.name OR OLD.icon IS NOT NEW.icon "
+    "BEGIN INSERT INTO material_changes (material_id) SELECT id FROM materials WHERE family_id = NEW.id; END",
+    "CREATE TRIGGER IF NOT EXISTS material_changes_families_delete AFTER DELETE ON families "
+    "BEGIN INSERT INTO material_changes (material_id) SELECT id FROM materials WHERE family_id = OLD.id; END",
+    "CREATE TRIGGER IF NOT EXISTS material_changes_suppliers_update AFTER UPDATE OF name ON suppliers "
+    "WHEN OLD.name IS NOT NEW.name "
+    "BEGIN INSERT INTO material_changes (material_id) SELECT id FROM materials WHERE supplier_id = NEW.id; END",
+    "CREATE TRIGGER IF NOT EXISTS material_changes_suppliers_delete AFTER DELETE ON suppliers "
+    "BEGIN INSERT INTO material_changes (material_id) SELECT id FROM materials WHERE supplier_id = OLD.id; END",
+)
+
+def new_material_changes_epoch(conn):
+    conn.execute("DELETE FROM material_changes_epoch")
+    conn.execute("INSERT INTO material_changes_epoch (epoch) VALUES (?)", (uuid.uuid4().hex,))
+
+def compact_material_changes(conn):
+    """Drop the log entries a later one for the same material supersedes:
+    a delta only needs each material's latest change."""
+    conn.execute("""DELETE FROM material_changes WHERE seq NOT IN
+        (SELECT MAX(seq) FROM material_changes GROUP BY material_id)""")
+
+@migration('material change log')
+def _migrate_material_changes(conn):
+    for ddl in MATERIAL_CHANGES_DDL:
+        conn.execute(ddl)
+    # Every existing material counts as changed once, so since=0 is the whole catalogue
+    conn.execute("INSERT INTO material_changes (material_id) SELECT id FROM materials ORDER BY id")
+    new_material_changes_epoch(conn)
+
+def migrate_db():
+    """Apply pending MIGRATIONS to DB_PATH. Returns [(version, name)] applied."""
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    applied = []
+    vacuum = False
+    try:
+        # Persistent: stored in the file, so it is set once per database
+        conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        if current > len(MIGRATIONS):
+            log(f"[DB] Schema version {current} is newer than this build ({len(MIGRATIONS)})")
+        for version, name, fn in MIGRATIONS:
+            if version <= current:
+                continue
+            conn.execute("BEGIN")
+            try:
+                fn(conn)
+                conn.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY, name TEXT, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
+                conn.execute("INSERT OR REPLACE INTO schema_migrations (version, name) VALUES (?,?)", (version, name))
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                log(f"[DB] Migration {version} ({name}) failed: {e}")
+                raise
+            log(f"[DB] Migration {version} applied: {name}")
+            applied.append((version, name))
+            vacuum = vacuum or fn.vacuum
+        if vacuum:
+            try:
+                conn.execute("VACUUM")
+            except sqlite3.Error as e:
+                log(f"[DB] VACUUM after migration skipped: {e}")
+    finally:
+        conn.close()
+    return applied
+
+def schema_status():
+    """Schema version and migration history, for the settings page / support."""
+    conn = get_db()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    history = [dict(r) for r in conn.execute(
+        "SELECT version, name, applied_at FROM schema_migrations ORDER BY version").fetchall()]
     conn.close()
-    log("[DB] Database initialized!")
+    return {'version': version, 'latest': len(MIGRATIONS), 'migrations': history}
+
+# ===== Connection pool =====
+# get_db() used to connect() and re-run schema checks on every call.
+# Now idle connections wait in a process-wide queue: get_db() checks one out
+# (health-checked), whichever thread asks — the threaded server starts a new
+# thread per request, so a per-thread pool would never be reused — and
+# conn.close() rolls back anything left uncommitted and puts it back. Nested
+# get_db() calls get separate connections, exactly as before. Connections a
+# request checked out but never closed (error paths) are kept on g and
+# returned at teardown. reset_db_pool() retires every pooled connection,
+# e.g. after a restore.
+#
+# The database runs in WAL mode, so readers never wait for the writer (and
+# the writer never waits for readers). GET/HEAD requests get query_only
+# connections from a separate queue; writes belong in db_write().
+DB_POOL_SIZE = 8  # idle connections kept, per kind (read-write / read-only)
+QUIESCE_TIMEOUT = 30  # seconds quiesce_db() waits for checked-out connections
+DB_JOURNAL_MODE = 'WAL'
+DB_CACHE_KIB = 16 * 1024  # page cache per connection
+DB_MMAP_BYTES = 256 * 1024 * 1024
+_db_local = threading.local()  # per-thread checkout count, for quiesce_db()
+_db_idle = {False: queue.Queue(DB_POOL_SIZE), True: queue.Queue(DB_POOL_SIZE)}  # by readonly
+_db_connects = 0  # connections opened since startup (`flask db-pool-check`)
+_db_pool_generation = 0
+_db_schema_ready = None  # (DB_PATH, generation) migrate_db() last ran for
+_db_schema_lock = threading.Lock()
+_db_open = weakref.WeakSet()  # every pooled connection not yet discarded
+_db_gate = threading.Condition()
+_db_checked_out = 0  # across all threads
+_db_quiesced = False
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to the pool."""
+    pool_key = None
+    checked_out = False
+    readonly = False
+    changes_noted = 0  # total_changes already passed to note_writes()
+
+    def commit(self):
+        super().commit()
+        note_writes(self.total_changes - self.changes_noted)
+        self.changes_noted = self.total_changes
+
+    def close(self):
+        if not self.checked_out:
+            return
+        self.checked_out = False
+        _check_in()
+        try:
+            if self.in_transaction:
+                self.rollback()
+            self.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            self.discard()
+            return
+        if self.pool_key == (DB_PATH, _db_pool_generation):
+            try:
+                _db_idle[self.readonly].put_nowait(self)
+                return
+            except queue.Full:
+                pass
+        self.discard()
+
+    def discard(self):
+        """Really close the connection."""
+        self.checked_out = False
+        _db_open.discard(self)
+        super().close()
+
+def _apply_pragmas(conn):
+    """Per-connection settings (journal_mode is per database, see migrate_db)."""
+    conn.execute("PRAGMA synchronous = NORMAL")  # durable at checkpoints; safe with WAL
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KIB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_BYTES}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+def _connect(readonly=False):
+    """Open a pooled connection with the per-connection settings applied once."""
+    global _db_connects
+    # Used by one thread at a time, but not always the one that opened it
+    conn = sqlite3.connect(DB_PATH, timeout=30, factory=PooledConnection, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    _apply_pragmas(conn)
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    conn.readonly = readonly
+    conn.pool_key = (DB_PATH, _db_pool_generation)
+    _db_open.add(conn)
+    _db_connects += 1
+    return conn
 
-def import_ifra_standards():
-    """Import IFRA standards from the downloaded XLSX file"""
+def _check_out():
+    """Count a checkout; waits while quiesce_db() holds the database, unless
+    this thread already has a connection out (it must be able to finish)."""
+    global _db_checked_out
+    held = getattr(_db_local, 'held', 0)
+    with _db_gate:
+        while _db_quiesced and not held:
+            _db_gate.wait()
+        _db_checked_out += 1
+    _db_local.held = held + 1
+
+def _check_in():
+    global _db_checked_out
+    _db_local.held = getattr(_db_local, 'held', 1) - 1
+    with _db_gate:
+        _db_checked_out -= 1
+        _db_gate.notify_all()
+
+@contextmanager
+def quiesce_db(timeout=QUIESCE_TIMEOUT):
+    """Hold new checkouts and write batches, wait for the connections that are
+    out to come back, and close every connection to the database, so the file
+    can be replaced. Raises TimeoutError if requests keep theirs too long."""
+    global _db_quiesced
+    with _db_gate:
+        while _db_quiesced:
+            _db_gate.wait()
+        _db_quiesced = True
+        if not _db_gate.wait_for(lambda: _db_checked_out == 0, timeout):
+            _db_quiesced = False
+            _db_gate.notify_all()
+            raise TimeoutError('database connections still checked out')
+    try:
+        with _db_writer.batch_lock:
+            reset_db_pool()
+            _db_writer.close()
+            _backup_scheduler.close_watch()
+            for conn in list(_db_open):
+                conn.discard()
+            yield
+    finally:
+        with _db_gate:
+            _db_quiesced = False
+            _db_gate.notify_all()
+
+def _healthy(conn):
+    try:
+        conn.execute("SELECT 1").fetchone()
+        return True
+    except sqlite3.Error:
+        return False
+
+def _prepare_db(key):
+    global _db_schema_ready
+    with _db_schema_lock:
+        if _db_schema_ready == key:
+            return
+        migrate_db()
+        _db_schema_ready = key
+
+def reset_db_pool():
+    """Retire every pooled connection (those checked out are dropped when
+    they come back) and check the schema version again on next use."""
+    global _db_pool_generation
+    with _db_schema_lock:
+        _db_pool_generation += 1
+    for idle in _db_idle.values():
+        while True:
+            try:
+                idle.get_nowait().discard()
+            except queue.Empty:
+                break
+
+def get_db(readonly=None):
+    """A connection from the pool; close() returns it.
+    readonly defaults to True while serving a GET/HEAD request."""
+    if readonly is None:
+        readonly = has_request_context() and request.method in ('GET', 'HEAD')
+    _check_out()
+    try:
+        key = (DB_PATH, _db_pool_generation)
+        if _db_schema_ready != key:
+            _prepare_db(key)
+        conn = None
+        while conn is None:
+            try:
+                candidate = _db_idle[readonly].get_nowait()
+            except queue.Empty:
+                break
+            if candidate.pool_key == key and _healthy(candidate):
+                conn = candidate
+            else:
+                candidate.discard()
+        if conn is None:
+            conn = _connect(readonly)
+    except BaseException:
+        _check_in()
+        raise
+    conn.checked_out = True
+    if has_app_context():
+        g.setdefault('db_connections', []).append(conn)
+    return conn
+
+@contextmanager
+def db_connection():
+    """with db_connection() as conn: ... — returned to the pool on exit,
+    uncommitted work rolled back."""
+    conn = get_db()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+@app.teardown_appcontext
+def _return_db_connections(exc):
+    for conn in g.pop('db_connections', ()):
+        conn.close()
+
+# ===== Single writer =====
+# SQLite allows one writer at a time. Instead of request threads racing for
+# the lock (and sleeping in busy_timeout), writes are handed to one writer
+# thread: db_write(fn) queues fn(conn) and returns its result. The writer
+# runs whatever is queued — up to WRITE_BATCH_MAX jobs — in a single
+# BEGIN IMMEDIATE ... COMMIT, so a burst of small saves (notebook autosave,
+# ingredient edits) costs one commit. Each job runs inside its own SAVEPOINT:
+# a job that raises is rolled back alone and the exception is re-raised in
+# its caller. A long write (the import) is one job and simply holds the
+# queue. Jobs must not commit, and must not call db_write() or write through
+# get_db() connections of their own. Material, composition, formula (with its
+# ingredients, notes and drafts), notebook, attachment and import writes go
+# through it; the few admin writes left (suppliers, production orders,
+# settings, IFRA staging) still commit on their request's connection.
+WRITE_BATCH_MAX = 64
+
+class DBWriter:
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.conn = None
+        self.conn_key = None
+        self.lock = threading.Lock()
+        self.batch_lock = threading.Lock()  # held while a batch runs; quiesce_db() takes it
+
+    def submit(self, fn):
+        """Queue fn(conn); returns a Future with its result."""
+        future = Future()
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self.thread.start()
+        self.jobs.put((fn, future))
+        return future
+
+    def close(self):
+        """Drop the writer's connection; the next batch opens a new one."""
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+        self.conn_key = None
+
+    def _connection(self):
+        key = (DB_PATH, _db_pool_generation)
+        if _db_schema_ready != key:
+            _prepare_db(key)
+        if self.conn_key != key:
+            if self.conn is not None:
+                self.conn.close()
+            # isolation_level=None: transactions are managed here, explicitly
+            self.conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            _apply_pragmas(self.conn)
+            self.conn_key = key
+        return self.conn
+
+    def _run(self):
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < WRITE_BATCH_MAX:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            with self.batch_lock:
+                self._run_batch([job for job in batch if job[1].set_running_or_notify_cancel()])
+
+    def _run_batch(self, batch):
+        outcomes = []
+        conn = None
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            changes = conn.total_changes
+            for fn, future in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    outcomes.append((future, fn(conn), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    outcomes.append((future, None, e))
+                conn.execute("RELEASE job")
+            conn.execute("COMMIT")
+            note_writes(conn.total_changes - changes)
+        except Exception as e:
+            log(f"[DB] Write batch of {len(batch)} failed: {e}")
+            try:
+                if conn is not None and conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                self.conn_key = None  # reconnect for the next batch
+            for fn, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+_db_writer = DBWriter()
+
+def db_write(fn):
+    """Run fn(conn) on the writer thread, committed, and return its result."""
+    if threading.current_thread() is _db_writer.thread:
+        return fn(_db_writer.conn)  # nested: already inside the batch
+    return _db_writer.submit(fn).result()
+
+# ===== Backup scheduler =====
+# Besides the manual and pre-restore backups, a background thread backs the
+# database up once it has changed enough: BACKUP_AFTER_WRITES rows written,
+# or BACKUP_AFTER_MINUTES after the first change not yet in a backup. Rows
+# written through the pool and the writer are counted by note_writes();
+# PRAGMA data_version also catches commits made any other way. It waits
+# while an import runs (import_running()), leaves BACKUP_MIN_INTERVAL_MINUTES
+# between backups, and create_backup() keeps the chain within
+# BACKUP_BUDGET_MB. The login backup is requested from it too, so no request
+# thread waits for a backup to be copied.
+BACKUP_POLL_SECONDS = 10
+BACKUP_AFTER_WRITES = 500
+BACKUP_AFTER_MINUTES = 15
+BACKUP_MIN_INTERVAL_MINUTES = 5
+backup_schedule = {'enabled': False, 'state': 'idle', 'writes': 0, 'dirty_since': None,
+                   'last_backup': None, 'last_error': None}
+_db_writes = 0  # rows written through the pool and the writer since startup
+_imports_running = 0
+_counter_lock = threading.Lock()
+
+def note_writes(rows):
+    global _db_writes
+    if rows > 0:
+        with _counter_lock:
+            _db_writes += rows
+
+@contextmanager
+def import_running():
+    """Marks a bulk import: the scheduler does not start a backup meanwhile."""
+    global _imports_running
+    with _counter_lock:
+        _imports_running += 1
+    try:
+        yield
+    finally:
+        with _counter_lock:
+            _imports_running -= 1
+
+def _stamp(t):
+    return datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S') if t else None
+
+class BackupScheduler:
+    def __init__(self):
+        self.thread = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.requested = None  # reason of a backup asked for, e.g. 'login'
+        self.watch = None  # [path, own connection, PRAGMA data_version last seen]
+        self.writes_backed_up = 0  # _db_writes at the last backup
+        self.dirty_since = None
+        self.last_backup = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='backup-scheduler', daemon=True)
+                self.thread.start()
+        backup_schedule['enabled'] = True
+
+    def request(self, reason):
+        """Back up soon, on the scheduler thread; returns at once."""
+        self.requested = reason
+        self.start()
+        self.wake.set()
+
+    def _run(self):
+        while True:
+            self.wake.wait(BACKUP_POLL_SECONDS)
+            self.wake.clear()
+            try:
+                self._tick()
+            except Exception as e:
+                backup_schedule.update(state='error', last_error=str(e))
+                log(f"[BACKUP] Scheduled backup failed: {e}")
+
+    def _committed_elsewhere(self):
+        """Whether another connection committed since the last look.
+        data_version is per connection, so the scheduler keeps one of its own
+        outside the pool; the first look on a new one (at startup, after a
+        restore) only sets the baseline."""
+        _check_out()  # waits while quiesce_db() holds the database
+        try:
+            if self.watch is not None and self.watch[0] != DB_PATH:
+                self.close_watch()
+            if self.watch is None:
+                conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+                conn.execute("PRAGMA query_only = ON")
+                self.watch = [DB_PATH, conn, conn.execute("PRAGMA data_version").fetchone()[0]]
+                return False
+            version = self.watch[1].execute("PRAGMA data_version").fetchone()[0]
+            changed = version != self.watch[2]
+            self.watch[2] = version
+            return changed
+        finally:
+            _check_in()
+
+    def close_watch(self):
+        """Close the data_version connection (quiesce_db: the file may be replaced)."""
+        if self.watch is not None:
+            self.watch[1].close()
+            self.watch = None
+
+    def _tick(self):
+        now = time.time()
+        writes = _db_writes - self.writes_backed_up
+        if (self._committed_elsewhere() or writes) and self.dirty_since is None:
+            self.dirty_since = now
+        reason = self.requested
+        due = reason or (self.dirty_since is not None and (
+            writes >= BACKUP_AFTER_WRITES or now - self.dirty_since >= BACKUP_AFTER_MINUTES * 60))
+        if not due:
+            state = 'idle' if self.dirty_since is None else 'pending'
+        elif _imports_running:
+            state = 'import_running'
+        elif not reason and self.last_backup and now - self.last_backup < BACKUP_MIN_INTERVAL_MINUTES * 60:
+            state = 'throttled'
+        else:
+            state = 'running'
+        backup_schedule.update(state=state, writes=writes, dirty_since=_stamp(self.dirty_since))
+        if state != 'running':
+            return
+        self.requested = None
+        writes_at = _db_writes
+        create_backup(reason or 'auto')
+        # Commits made while the copy ran may be missing from it: they show
+        # up as a change on the next look
+        self.writes_backed_up = writes_at
+        self.dirty_since = None
+        self.last_backup = time.time()
+        backup_schedule.update(state='idle', writes=_db_writes - writes_at, dirty_since=None,
+                               last_backup=_stamp(self.last_backup), last_error=None)
+
+_backup_scheduler = BackupScheduler()
+
+# ifra_standards columns filled from the workbook, in INSERT order
+IFRA_STANDARD_FIELDS = (
+    'ifra_key', 'name', 'cas_numbers', 'synonyms', 'standard_type', 'amendment', 'year_published',
+    'risk_property', 'restriction_notes', 'specification_notes', 'contributions',
+    'cat1', 'cat2', 'cat3', 'cat4', 'cat5a', 'cat5b', 'cat5c', 'cat5d',
+    'cat6', 'cat7a', 'cat7b', 'cat8', 'cat9', 'cat10a', 'cat10b', 'cat11a', 'cat11b', 'cat12',
+)
+
+def parse_ifra_standards_xlsx(xlsx_path):
+    """Read an IFRA standards workbook (51st Amendment layout) into a list of
+    dicts keyed by IFRA_STANDARD_FIELDS, plus 'cas_list' (valid CAS numbers)."""
     import zipfile
     import xml.etree.ElementTree as ET
 
+    zf = zipfile.ZipFile(xlsx_path)
+    ns = {'s': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+
+    # Read shared strings
+    shared = []
+    try:
+        ss_tree = ET.parse(zf.open('xl/sharedStrings.xml'))
+        for si in ss_tree.findall('.//s:si', ns):
+            parts = []
+            for t in si.iter('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}t'):
+                if t.text:
+                    parts.append(t.text)
+            shared.append(''.join(parts))
+    except:
+        pass
+
+    # Read sheet1
+    sheet_tree = ET.parse(zf.open('xl/worksheets/sheet1.xml'))
+    rows = sheet_tree.findall('.//s:sheetData/s:row', ns)
+    zf.close()
+
+    def cell_ref_to_col(ref):
+        col = ''
+        for ch in ref:
+            if ch.isalpha():
+                col += ch
+            else:
+                break
+        result = 0
+        for ch in col:
+            result = result * 26 + (ord(ch) - ord('A') + 1)
+        return result - 1  # A=0, B=1, ..., Z=25, AA=26, AB=27
+
+    def get_cell_value(cell):
+        t = cell.get('t', '')
+        v_el = cell.find('s:v', ns)
+        if v_el is None or v_el.text is None:
+            return ''
+        if t == 's':
+            idx = int(v_el.text)
+            return shared[idx] if idx < len(shared) else ''
+        return v_el.text
+
+    # Category column indices (T=19 through AK=36)
+    cat_cols = {
+        19: 'cat1', 20: 'cat2', 21: 'cat3', 22: 'cat4',
+        23: 'cat5a', 24: 'cat5b', 25: 'cat5c', 26: 'cat5d',
+        27: 'cat6', 28: 'cat7a', 29: 'cat7b', 30: 'cat8',
+        31: 'cat9', 32: 'cat10a', 33: 'cat10b',
+        34: 'cat11a', 35: 'cat11b', 36: 'cat12'
+    }
+
+    def parse_cat_value(val):
+        """Parse category limit value to float or None"""
+        if not val:
+            return None
+        val = val.strip()
+        if not val or val.lower() in ('', 'none'):
+            return None
+        if 'no restriction' in val.lower():
+            return -1  # -1 = no restriction
+        if 'prohibited' in val.lower():
+            return 0
+        if 'see notebox' in val.lower():
+            return None
+        # Handle comma decimals (European format)
+        val = val.replace(',', '.').strip("'").strip()
+        # Extract first number
+        m = re.match(r'(-?[\d.]+)', val)
+        if m:
+            try:
+                return float(m.group(1))
+            except:
+                return None
+        return None
+
+    records = []
+    for row_el in rows:
+        row_num = int(row_el.get('r', '0'))
+        if row_num < 4:  # Skip header rows
+            continue
+
+        cells = {}
+        for cell in row_el.findall('s:c', ns):
+            ref = cell.get('r', '')
+            col_idx = cell_ref_to_col(ref)
+            cells[col_idx] = get_cell_value(cell)
+
+        ifra_key = cells.get(0, '').strip()
+        if not ifra_key or not ifra_key.startswith('IFRA_STD'):
+            continue
+
+        cas_raw = cells.get(7, '').strip()
+        amendment = cells.get(1, '')
+        try:
+            amendment = int(float(amendment)) if amendment else 0
+        except:
+            amendment = 0
+
+        record = {
+            'ifra_key': ifra_key,
+            'name': cells.get(6, '').strip(),
+            'cas_numbers': cas_raw,
+            'synonyms': cells.get(9, '').strip(),
+            'standard_type': cells.get(10, '').strip(),
+            'amendment': amendment,
+            'year_published': cells.get(3, ''),
+            'risk_property': cells.get(11, '').strip(),
+            'restriction_notes': cells.get(15, '').strip(),
+            'specification_notes': cells.get(16, '').strip(),
+            'contributions': cells.get(17, '').strip(),
+        }
+        # Parse category limits
+        for col_idx, cat_name in cat_cols.items():
+            record[cat_name] = parse_cat_value(cells.get(col_idx, ''))
+        record['cas_list'] = [cas.strip() for cas in re.split(r'[\n\r\s]+', cas_raw)
+                              if cas.strip() and re.match(r'\d+-\d+-\d+', cas.strip())]
+        records.append(record)
+    return records
+
+def import_ifra_standards():
+    """Import IFRA standards from the downloaded XLSX file"""
     xlsx_path = os.path.join(ASSET_DIR, 'data', 'ifra_standards.xlsx')
     if not os.path.exists(xlsx_path):
         log("[IFRA] Standards file not found, skipping import")
@@ -841,147 +2151,25 @@ def import_ifra_standards():
     log("[IFRA] Importing IFRA 51st Amendment standards...")
 
     try:
-        zf = zipfile.ZipFile(xlsx_path)
-        ns = {'s': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+        imported = 0
+        for record in parse_ifra_standards_xlsx(xlsx_path):
+            conn.execute(f'''INSERT OR REPLACE INTO ifra_standards ({', '.join(IFRA_STANDARD_FIELDS)})
+                VALUES ({','.join('?' * len(IFRA_STANDARD_FIELDS))})''',
+                tuple(record[k] for k in IFRA_STANDARD_FIELDS))
 
-        # Read shared strings
-        shared = []
-        try:
-            ss_tree = ET.parse(zf.open('xl/sharedStrings.xml'))
-            for si in ss_tree.findall('.//s:si', ns):
-                parts = []
-                for t in si.iter('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}t'):
-                    if t.text:
-                        parts.append(t.text)
-                shared.append(''.join(parts))
-        except:
-            pass
+            std_id = conn.execute("SELECT id FROM ifra_standards WHERE ifra_key=?", (record['ifra_key'],)).fetchone()['id']
 
-        # Read sheet1
-        sheet_tree = ET.parse(zf.open('xl/worksheets/sheet1.xml'))
-        rows = sheet_tree.findall('.//s:sheetData/s:row', ns)
-
-        def cell_ref_to_col(ref):
-            col = ''
-            for ch in ref:
-                if ch.isalpha():
-                    col += ch
-                else:
-                    break
-            result = 0
-            for ch in col:
-                result = result * 26 + (ord(ch) - ord('A') + 1)
-            return result - 1  # A=0, B=1, ..., Z=25, AA=26, AB=27
-
-        def get_cell_value(cell):
-            t = cell.get('t', '')
-            v_el = cell.find('s:v', ns)
-            if v_el is None or v_el.text is None:
-                return ''
-            if t == 's':
-                idx = int(v_el.text)
-                return shared[idx] if idx < len(shared) else ''
-            return v_el.text
-
-        # Category column indices (T=19 through AK=36)
-        cat_cols = {
-            19: 'cat1', 20: 'cat2', 21: 'cat3', 22: 'cat4',
-            23: 'cat5a', 24: 'cat5b', 25: 'cat5c', 26: 'cat5d',
-            27: 'cat6', 28: 'cat7a', 29: 'cat7b', 30: 'cat8',
-            31: 'cat9', 32: 'cat10a', 33: 'cat10b',
-            34: 'cat11a', 35: 'cat11b', 36: 'cat12'
-        }
-
-        def parse_cat_value(val):
-            """Parse category limit value to float or None"""
-            if not val:
-                return None
-            val = val.strip()
-            if not val or val.lower() in ('', 'none'):
-                return None
-            if 'no restriction' in val.lower():
-                return -1  # -1 = no restriction
-            if 'prohibited' in val.lower():
-                return 0
-            if 'see notebox' in val.lower():
-                return None
-            # Handle comma decimals (European format)
-            val = val.replace(',', '.').strip("'").strip()
-            # Extract first number
-            m = re.match(r'(-?[\d.]+)', val)
-            if m:
-                try:
-                    return float(m.group(1))
-                except:
-                    return None
-            return None
-
-        imported = 0
-        for row_el in rows:
-            row_num = int(row_el.get('r', '0'))
-            if row_num < 4:  # Skip header rows
-                continue
-
-            cells = {}
-            for cell in row_el.findall('s:c', ns):
-                ref = cell.get('r', '')
-                col_idx = cell_ref_to_col(ref)
-                cells[col_idx] = get_cell_value(cell)
-
-            ifra_key = cells.get(0, '').strip()
-            if not ifra_key or not ifra_key.startswith('IFRA_STD'):
-                continue
-
-            name = cells.get(6, '').strip()
-            cas_raw = cells.get(7, '').strip()
-            amendment = cells.get(1, '')
-            year_pub = cells.get(3, '')
-            std_type = cells.get(10, '').strip()
-            risk_prop = cells.get(11, '').strip()
-            synonyms = cells.get(9, '').strip()
-            restriction_notes = cells.get(15, '').strip()
-            spec_notes = cells.get(16, '').strip()
-            contributions = cells.get(17, '').strip()
-
-            try:
-                amendment = int(float(amendment)) if amendment else 0
-            except:
-                amendment = 0
-
-            # Parse category limits
-            cat_values = {}
-            for col_idx, cat_name in cat_cols.items():
-                cat_values[cat_name] = parse_cat_value(cells.get(col_idx, ''))
-
-            conn.execute('''INSERT OR REPLACE INTO ifra_standards
-                (ifra_key, name, cas_numbers, synonyms, standard_type, amendment, year_published,
-                 risk_property, restriction_notes, specification_notes, contributions,
-                 cat1, cat2, cat3, cat4, cat5a, cat5b, cat5c, cat5d,
-                 cat6, cat7a, cat7b, cat8, cat9, cat10a, cat10b, cat11a, cat11b, cat12)
-                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
-                (ifra_key, name, cas_raw, synonyms, std_type, amendment, year_pub,
-                 risk_prop, restriction_notes, spec_notes, contributions,
-                 cat_values.get('cat1'), cat_values.get('cat2'), cat_values.get('cat3'), cat_values.get('cat4'),
-                 cat_values.get('cat5a'), cat_values.get('cat5b'), cat_values.get('cat5c'), cat_values.get('cat5d'),
-                 cat_values.get('cat6'), cat_values.get('cat7a'), cat_values.get('cat7b'), cat_values.get('cat8'),
-                 cat_values.get('cat9'), cat_values.get('cat10a'), cat_values.get('cat10b'),
-                 cat_values.get('cat11a'), cat_values.get('cat11b'), cat_values.get('cat12')))
-
-            std_id = conn.execute("SELECT id FROM ifra_standards WHERE ifra_key=?", (ifra_key,)).fetchone()['id']
-
-            # Insert CAS lookup entries
-            cas_list = re.split(r'[\n\r\s]+', cas_raw)
-            for cas in cas_list:
-                cas = cas.strip()
-                if cas and re.match(r'\d+-\d+-\d+', cas):
-                    conn.execute("INSERT OR IGNORE INTO ifra_cas_lookup (cas_number, ifra_standard_id) VALUES (?,?)",
-                                 (cas, std_id))
+            # Insert CAS lookup entries
+            for cas in record['cas_list']:
+                conn.execute("INSERT OR IGNORE INTO ifra_cas_lookup (cas_number, ifra_standard_id) VALUES (?,?)",
+                             (cas, std_id))
 
             imported += 1
 
         conn.commit()
-        zf.close()
         log(f"[IFRA] Imported {imported} IFRA standards")
+        # Tables were rewritten — refresh the in-memory index
+        load_ifra_index()
     except Exception as e:
         log(f"[IFRA] Error importing: {e}")
     finally:
@@ -1127,6 +2315,7 @@ def import_ifra_contributions():
         conn.commit()
         zf.close()
         log(f"[IFRA] Imported {imported} contribution entries")
+        load_contributions_index()
     except Exception as e:
         log(f"[IFRA] Error importing contributions: {e}")
     finally:
@@ -1147,6 +2336,1442 @@ def get_concentration(dilution):
         return 1.0  # صافي 100%
     return float(dilution)  # النسبة (0 إلى 1)
 
+# ===== IFRA in-memory index =====
+# Every IFRA code path used to run the same
+#   ifra_standards JOIN ifra_cas_lookup WHERE cas_number=?
+# once per ingredient / constituent / category. The standards only change when
+# import_ifra_standards() rewrites them, so we load them once into a dict:
+#   cas -> {'standard': {...row as dict...}, 'limits': (cat1, ..., cat12)}
+# 'limits' has one slot per IFRA_CATEGORIES entry (same order) and keeps the
+# raw sentinels: None = not applicable, -1 = no restriction, 0 = prohibited.
+IFRA_CAT_KEYS = [c['id'] for c in IFRA_CATEGORIES]
+IFRA_CAT_SLOT = {k: i for i, k in enumerate(IFRA_CAT_KEYS)}
+
+def ifra_cat_key(value):
+    """A formula's stored ifra_category, or cat4 when it is empty or unknown."""
+    return value if value in IFRA_CAT_SLOT else 'cat4'
+
+_ifra_index = None
+_ifra_index_lock = threading.Lock()
+
+def build_ifra_index(rows):
+    """CAS -> {'standard', 'limits'} from standard rows carrying a lookup_cas
+    column, in lookup order."""
+    index = {}
+    for r in rows:
+        cas = r['lookup_cas']
+        if cas in index:
+            continue  # first standard wins, same as the old fetchone()
+        std = dict(r)
+        std.pop('lookup_cas', None)
+        index[cas] = {
+            'standard': std,
+            'limits': tuple(std.get(k) for k in IFRA_CAT_KEYS),
+        }
+    return index
+
+def load_ifra_index():
+    """(Re)build the CAS -> IFRA standard index from the database."""
+    global _ifra_index
+    with _ifra_index_lock:
+        conn = get_db()
+        rows = conn.execute('''
+            SELECT l.cas_number AS lookup_cas, s.*
+            FROM ifra_cas_lookup l
+            JOIN ifra_standards s ON l.ifra_standard_id = s.id
+            ORDER BY l.id
+        ''').fetchall()
+        conn.close()
+        index = build_ifra_index(rows)
+        _ifra_index = index
+    log(f"[IFRA] Index loaded: {len(index)} CAS numbers")
+    # Constituent limits in the contributions index come from this one
+    load_contributions_index()
+    invalidate_mixture_limits()
+    return index
+
+def get_ifra_index():
+    """Return the loaded IFRA index, loading it on first use."""
+    index = _ifra_index
+    if index is None:
+        index = load_ifra_index()
+    return index
+
+def ifra_standard_for_cas(cas):
+    """IFRA standard (dict, shared — copy before mutating) for a CAS, or None."""
+    if not cas:
+        return None
+    entry = get_ifra_index().get(cas)
+    return entry['standard'] if entry else None
+
+def ifra_limit_for_cas(cas, cat_key):
+    """Raw category value for a CAS (None / -1 / 0 / positive %).
+    Returns (found, value) so callers can tell "no standard" from "None"."""
+    if not cas:
+        return False, None
+    entry = get_ifra_index().get(cas)
+    if not entry:
+        return False, None
+    return True, entry['limits'][IFRA_CAT_SLOT[cat_key]]
+
+# ===== IFRA contributions index (naturals + Schiff bases) =====
+# ncs_cas -> {
+#   'constituents': [{constituent_cas, constituent_name, concentration_pct,
+#                     ncs_name, source_type, limits}],   # limits: 18-tuple or None
+#   'derived': (slot per category: (limit, constituent_name) or None),
+# }
+# 'derived' is the "no direct standard → derive from constituents" limit the
+# formula page uses: min over constituents of limit / (concentration / 100),
+# prohibited constituents give 0, no-restriction (-1) ones are skipped.
+_contrib_index = None
+_contrib_index_lock = threading.Lock()
+
+CONTRIBUTION_ROWS_SQL = '''
+    SELECT ncs_cas, ncs_name, source_type, constituent_cas, constituent_name, concentration_pct
+    FROM ifra_contributions ORDER BY id
+'''
+
+def build_contributions_index(rows, ifra):
+    """NCS CAS -> constituents/derived limits, with constituent limits taken
+    from the given IFRA index."""
+    index = {}
+    for r in rows:
+        entry = index.setdefault(r['ncs_cas'], {'constituents': [], 'derived': None})
+        std = ifra.get(r['constituent_cas'])
+        entry['constituents'].append({
+            'constituent_cas': r['constituent_cas'],
+            'constituent_name': r['constituent_name'],
+            'concentration_pct': r['concentration_pct'],
+            'ncs_name': r['ncs_name'],
+            'source_type': r['source_type'],
+            'limits': std['limits'] if std else None,
+        })
+    for entry in index.values():
+        derived = []
+        for slot in range(len(IFRA_CAT_KEYS)):
+            best = None
+            for c in entry['constituents']:
+                if c['limits'] is None:
+                    continue
+                c_val = c['limits'][slot]
+                if c_val is None or c_val < 0 or not c['concentration_pct'] > 0:
+                    continue
+                d = 0 if c_val == 0 else c_val / (c['concentration_pct'] / 100)
+                if best is None or d < best[0]:
+                    best = (d, c['constituent_name'])
+            derived.append(best)
+        entry['derived'] = tuple(derived)
+    return index
+
+def load_contributions_index():
+    """(Re)build the NCS CAS -> constituents index from ifra_contributions."""
+    global _contrib_index
+    ifra = get_ifra_index()
+    with _contrib_index_lock:
+        conn = get_db()
+        rows = conn.execute(CONTRIBUTION_ROWS_SQL).fetchall()
+        conn.close()
+        index = build_contributions_index(rows, ifra)
+        _contrib_index = index
+    log(f"[IFRA] Contributions index loaded: {len(index)} NCS materials")
+    return index
+
+def get_contributions_index():
+    """Return the loaded contributions index, loading it on first use."""
+    index = _contrib_index
+    if index is None:
+        index = load_contributions_index()
+    return index
+
+def contributions_for_cas(ncs_cas):
+    """Constituent list for a natural / Schiff base CAS ([] if none)."""
+    if not ncs_cas:
+        return []
+    entry = get_contributions_index().get(ncs_cas)
+    return entry['constituents'] if entry else []
+
+def derived_contribution_limit(ncs_cas, cat_key):
+    """(limit, binding constituent name) derived from contributions, or None."""
+    if not ncs_cas:
+        return None
+    entry = get_contributions_index().get(ncs_cas)
+    return entry['derived'][IFRA_CAT_SLOT[cat_key]] if entry else None
+
+# ===== Mixture IFRA limit cache =====
+# Per-material 18-vectors of resolved IFRA limits and the derived mixture
+# limits (binding component per category), shared across requests. Entries
+# are dropped when the material, anything it contains, or the IFRA data
+# changes; the generation counter stops a request that started before an
+# invalidation from writing back stale results.
+_mixture_limit_cache = {}  # mat_id -> {('vector', depth, max_depth): tuple, ('mixture', max_depth): dict}
+_mixture_limit_lock = threading.Lock()
+_mixture_limit_generation = 0
+
+def invalidate_mixture_limits(material_ids=None):
+    """Forget cached limits for material_ids (all materials when None).
+    Callers pass the ancestors too — see composition_ancestors()."""
+    global _mixture_limit_generation
+    with _mixture_limit_lock:
+        _mixture_limit_generation += 1
+        if material_ids is None:
+            _mixture_limit_cache.clear()
+        else:
+            for mid in material_ids:
+                _mixture_limit_cache.pop(int(mid), None)
+
+def composition_ancestors(conn, material_ids):
+    """material_ids plus every mixture that contains one of them."""
+    ids = {int(m) for m in material_ids}
+    if not ids:
+        return ids
+    placeholders = ','.join('?' * len(ids))
+    return ids | {r[0] for r in conn.execute(
+        f"SELECT DISTINCT ancestor_id FROM material_composition_closure WHERE descendant_id IN ({placeholders})",
+        list(ids)).fetchall()}
+
+# ===== Formula evaluation engine =====
+# The H/J/N/L/E3/N3 maths, the contribution map, the mixture expansion and the
+# olfactive roll-up in one place. Nothing below touches Flask or SQLite: the
+# caller loads the ingredient rows and hands over the IFRA, contributions and
+# composition indices (formula_evaluator() does that for a connection).
+
+class CompositionIndex:
+    """In-memory slice of materials + material_composition.
+
+    materials: id -> {name, cas_number, ifra_limit, manual_ifra_cats (dict), price_per_gram}
+    children:  parent id -> [(component id, pct)] in material_composition order
+    closure:   ancestor id -> flattened components from material_composition_closure
+               [(component id, name, cas, effective_pct of 100% ancestor, pct_in_parent)]
+    """
+
+    def __init__(self, materials, children, closure=None):
+        self.materials = materials
+        self.children = children
+        self.closure = closure
+
+    def expand(self, mat_id, accumulated_pct, depth=0, max_depth=5, visited=None):
+        """Yield every direct/indirect component of a mixture with its effective
+        percentage of the *outer* context (accumulated_pct is in the same unit,
+        e.g. 5.0 for 5% of the formula). Stops at max_depth and at cycles."""
+        if depth >= max_depth or accumulated_pct <= 0:
+            return
+        if self.closure is not None and depth == 0 and max_depth == 5 and visited is None:
+            # Precomputed paths — no walk needed
+            for comp_id, name, cas, effective_pct, pct_in_parent in self.closure.get(mat_id, ()):
+                yield {
+                    'mat_id': comp_id,
+                    'cas': cas or '',
+                    'name': name or '',
+                    'effective_pct': accumulated_pct * effective_pct / 100.0,
+                    'pct_in_parent': pct_in_parent,
+                }
+            return
+        if visited is None:
+            visited = set()
+        if mat_id in visited:
+            return
+        visited = visited | {mat_id}
+        for comp_id, pct in self.children.get(mat_id, ()):
+            comp = self.materials.get(comp_id)
+            pct_in_parent = pct or 0
+            if comp is None or pct_in_parent <= 0:
+                continue
+            effective = accumulated_pct * pct_in_parent / 100.0
+            yield {
+                'mat_id': comp_id,
+                'cas': comp['cas_number'] or '',
+                'name': comp['name'] or '',
+                'effective_pct': effective,
+                'pct_in_parent': pct_in_parent,
+            }
+            yield from self.expand(comp_id, effective, depth + 1, max_depth, visited)
+
+    def effective_ppg(self, mat_id, own_ppg, depth=0, max_depth=5, visited=None):
+        """own_ppg if > 0, otherwise the weighted average of the component ppg
+        (recursive). Unspecified remainder counts as zero-cost carrier."""
+        if own_ppg and own_ppg > 0:
+            return own_ppg
+        if depth >= max_depth:
+            return 0
+        if visited is None:
+            visited = set()
+        if mat_id in visited:
+            return 0
+        visited = visited | {mat_id}
+        weighted = 0.0
+        for comp_id, pct in self.children.get(mat_id, ()):
+            comp = self.materials.get(comp_id)
+            p = pct or 0
+            if comp is None or p <= 0:
+                continue
+            c_ppg = self.effective_ppg(comp_id, comp['price_per_gram'] or 0, depth + 1, max_depth, visited)
+            weighted += c_ppg * p / 100.0
+        return weighted
+
+
+def load_composition_index(conn, material_ids=None):
+    """Load the composition sub-graph reachable from material_ids (all
+    materials when None): the flattened closure rows of the given materials,
+    then the materials and direct edges of every node they reach."""
+    materials = {}
+    children = {}
+    closure = {}
+
+    mat_sql = "SELECT id, name, cas_number, ifra_limit, manual_ifra_cats, price_per_gram FROM materials"
+    edge_sql = "SELECT parent_material_id, component_material_id, pct FROM material_composition"
+    closure_sql = '''
+        SELECT c.ancestor_id, c.descendant_id, c.effective_pct, c.pct_in_parent, m.name, m.cas_number
+        FROM material_composition_closure c
+        JOIN materials m ON m.id = c.descendant_id
+    '''
+    if material_ids is None:
+        mat_rows = conn.execute(mat_sql).fetchall()
+        edge_rows = conn.execute(edge_sql + " ORDER BY id").fetchall()
+        closure_rows = conn.execute(closure_sql + " ORDER BY c.ancestor_id, c.seq").fetchall()
+    else:
+        ids = sorted({int(m) for m in material_ids})
+        placeholders = ','.join('?' * len(ids))
+        closure_rows = conn.execute(
+            f"{closure_sql} WHERE c.ancestor_id IN ({placeholders}) ORDER BY c.ancestor_id, c.seq", ids).fetchall()
+        ids = sorted(set(ids) | {r['descendant_id'] for r in closure_rows})
+        placeholders = ','.join('?' * len(ids))
+        mat_rows = conn.execute(f"{mat_sql} WHERE id IN ({placeholders})", ids).fetchall()
+        edge_rows = conn.execute(f"{edge_sql} WHERE parent_material_id IN ({placeholders}) ORDER BY id", ids).fetchall()
+
+    for r in mat_rows:
+        try:
+            manual = json.loads(r['manual_ifra_cats'] or '{}') or {}
+        except Exception:
+            manual = {}
+        materials[r['id']] = {
+            'name': r['name'],
+            'cas_number': r['cas_number'],
+            'ifra_limit': r['ifra_limit'],
+            'manual_ifra_cats': manual,
+            'price_per_gram': r['price_per_gram'],
+        }
+    for e in edge_rows:
+        children.setdefault(e['parent_material_id'], []).append((e['component_material_id'], e['pct']))
+    for r in closure_rows:
+        closure.setdefault(r['ancestor_id'], []).append(
+            (r['descendant_id'], r['name'], r['cas_number'], r['effective_pct'], r['pct_in_parent']))
+    return CompositionIndex(materials, children, closure)
+
+
+def load_olfactive_map(conn, material_ids):
+    """material_id -> {olfactive axis: value} for the given materials."""
+    ids = sorted({int(m) for m in material_ids})
+    if not ids:
+        return {}
+    placeholders = ','.join('?' * len(ids))
+    rows = conn.execute(f"SELECT * FROM material_olfactive WHERE material_id IN ({placeholders})", ids).fetchall()
+    return {r['material_id']: {c: r[c] or 0 for c in OLFACTIVE_CATEGORIES} for r in rows}
+
+
+@dataclass
+class IngredientEvaluation:
+    row: dict
+    concentration: float          # E
+    pure_weight: float            # I = G × E
+    weight_pct: float             # H (0-1)
+    pure_pct: float               # J (0-1)
+    ifra_limit: object            # F — None no value, -1 no restriction, 0 prohibited
+    ifra_std_name: object = None
+    ifra_std_type: object = None
+    ifra_key: object = None
+    design_calc: object = None    # N = F / H
+    final_calc: object = None     # L = F / J
+    design_exceeded: bool = False  # M
+    final_exceeded: bool = False   # K
+    constituents: list = field(default_factory=list)
+    effective_ppg: float = 0
+    prohibited: bool = False      # the IFRA standard itself is 0 in this category
+
+    @property
+    def no_restriction(self):
+        return self.ifra_limit == -1
+
+    @property
+    def cost(self):
+        return self.row['weight'] * self.effective_ppg
+
+    def to_dict(self):
+        """Row shape served by /api/formula/<fid>/ingredients."""
+        return {
+            **self.row,
+            'concentration': self.concentration,
+            'pure_weight': self.pure_weight,
+            'weight_percentage': self.weight_pct * 100,
+            'percentage': self.pure_pct * 100,
+            'ifra_cat_limit': self.ifra_limit,
+            'ifra_std_name': self.ifra_std_name,
+            'ifra_std_type': self.ifra_std_type,
+            'ifra_design_calc': self.design_calc,
+            'ifra_design_exceeded': self.design_exceeded,
+            'ifra_final_calc': self.final_calc,
+            'ifra_final_exceeded': self.final_exceeded,
+            'constituents': self.constituents,
+            'effective_ppg': self.effective_ppg,
+            'cost': self.cost,
+        }
+
+
+@dataclass
+class FormulaEvaluation:
+    category: str
+    ingredients: list
+    total_weight: float
+    total_pure: float
+    active_ratio: float           # J2
+    design_limit: float           # N3 (with the 0.99 safety factor)
+    final_limit: float            # E3 (with the 0.99 safety factor)
+    design_bound: object = None   # min N before the safety factor
+    final_bound: object = None    # min L before the safety factor
+    design_binding: object = None  # name of the ingredient / constituent setting N3
+    final_binding: object = None   # name of the ingredient / constituent setting E3
+    contributions: list = field(default_factory=list)
+    contribution_warnings: list = field(default_factory=list)
+    olfactive: dict = field(default_factory=dict)
+
+    def to_dict(self):
+        """Payload served by /api/formula/<fid>/ingredients (minus 'success')."""
+        return {
+            'data': [i.to_dict() for i in self.ingredients],
+            'total_weight': self.total_weight,
+            'total_pure': self.total_pure,
+            'active_ratio': self.active_ratio,
+            'ifra_category': self.category,
+            'ifra_design_limit': self.design_limit,
+            'ifra_final_limit': self.final_limit,
+            'ifra_design_binding': self.design_binding,
+            'ifra_final_binding': self.final_binding,
+            'olfactive_profile': self.olfactive,
+            'contributions': self.contributions,
+            'contribution_warnings': self.contribution_warnings,
+        }
+
+
+@dataclass
+class CategoryEvaluation:
+    category: str
+    design_limit: float           # N3
+    final_limit: float            # E3
+    design_bound: object = None
+    final_bound: object = None
+    design_binding: object = None
+    final_binding: object = None
+    prohibited: list = field(default_factory=list)  # prohibited ingredients / constituents
+
+    def to_dict(self):
+        return {
+            'ifra_design_limit': self.design_limit,
+            'ifra_final_limit': self.final_limit,
+            'ifra_design_binding': self.design_binding,
+            'ifra_final_binding': self.final_binding,
+            'prohibited': self.prohibited,
+        }
+
+
+@dataclass
+class AllCategoriesEvaluation:
+    total_weight: float
+    total_pure: float
+    categories: dict              # cat_key -> CategoryEvaluation
+    regulated_ids: list = field(default_factory=list)  # rows with an IFRA source in any category
+
+    def to_dict(self):
+        return {k: v.to_dict() for k, v in self.categories.items()}
+
+
+class FormulaEvaluator:
+    """Evaluates ingredient rows against one IFRA category.
+
+    Rows need material_id, name, cas_number, weight, dilution, ifra_limit,
+    manual_ifra_cats, price_per_gram and (optionally) ifra_override; every
+    other column is passed through to the output untouched.
+    """
+
+    def __init__(self, ifra_index, contrib_index, composition, olfactive=None, limit_cache=None):
+        self.ifra = ifra_index
+        self.contribs = contrib_index
+        self.composition = composition
+        self.olfactive = olfactive or {}
+        # limit_cache is the shared _mixture_limit_cache when built through
+        # formula_evaluator(); a standalone evaluator memoises privately.
+        self._shared = limit_cache is not None
+        self._cache = limit_cache if limit_cache is not None else {}
+        self._generation = _mixture_limit_generation
+
+    def _cached(self, mat_id, key):
+        entry = self._cache.get(mat_id)
+        return entry.get(key) if entry else None
+
+    def _remember(self, mat_id, key, value):
+        if not self._shared:
+            self._cache.setdefault(mat_id, {})[key] = value
+            return
+        with _mixture_limit_lock:
+            if self._generation == _mixture_limit_generation:
+                self._cache.setdefault(mat_id, {})[key] = value
+
+    # --- IFRA limit resolution -------------------------------------------
+    def _std_value(self, cas, cat_key):
+        entry = self.ifra.get(cas) if cas else None
+        if not entry:
+            return None, None
+        return entry, entry['limits'][IFRA_CAT_SLOT[cat_key]]
+
+    def material_limits(self, mat_id, depth=0, max_depth=5):
+        """IFRA limit (% in formula) of a material for all 18 categories using
+        the same priority chain as ingredients:
+          1. manual_ifra_cats[cat_key]  2. blanket ifra_limit
+          3. CAS lookup in IFRA standards  4. composition-derived (bottom-up)
+        Each slot is a positive float, 0 (prohibited), -1 (no restriction) or
+        None. Memoised per (material, depth); cycles are rejected when a
+        composition is saved, so the depth cap is the only stop needed."""
+        if depth >= max_depth:
+            return (None,) * len(IFRA_CAT_KEYS)
+        key = ('vector', depth, max_depth)
+        cached = self._cached(mat_id, key)
+        if cached is not None:
+            return cached
+        mat = self.composition.materials.get(mat_id)
+        if not mat:
+            return (None,) * len(IFRA_CAT_KEYS)
+
+        manual = mat['manual_ifra_cats']
+        blanket = mat['ifra_limit']
+        entry = self.ifra.get(mat['cas_number']) if mat['cas_number'] else None
+        comp_rows = self.composition.children.get(mat_id)
+        sub_vectors = None
+
+        out = []
+        for slot, cat_key in enumerate(IFRA_CAT_KEYS):
+            v = manual.get(cat_key)
+            if v is not None and v != '':
+                try:
+                    vf = float(v)
+                    if vf > 0:
+                        out.append(vf)
+                        continue
+                except (TypeError, ValueError):
+                    pass
+            if blanket and blanket > 0:
+                out.append(float(blanket))
+                continue
+            if entry and entry['limits'][slot] is not None:
+                out.append(entry['limits'][slot])  # may be -1, 0, or positive
+                continue
+            if not comp_rows:
+                out.append(None)
+                continue
+
+            if sub_vectors is None:
+                sub_vectors = [(pct, self.material_limits(cid, depth + 1, max_depth))
+                               for cid, pct in comp_rows if (pct or 0) > 0]
+            min_derived = None
+            prohibited = False
+            for c_pct, vec in sub_vectors:
+                sub = vec[slot]
+                if sub is None or sub == -1:
+                    continue
+                if sub == 0:
+                    prohibited = True  # any prohibited component prohibits the whole mixture
+                    break
+                derived = sub / (c_pct / 100.0)
+                if min_derived is None or derived < min_derived:
+                    min_derived = derived
+            if prohibited:
+                out.append(0)
+            elif min_derived is not None and min_derived > 100:
+                # A derived limit > 100% is meaningless (you can never use more
+                # than 100% of a mixture in a formula) — "No Restriction".
+                out.append(-1)
+            else:
+                out.append(min_derived)
+
+        out = tuple(out)
+        self._remember(mat_id, key, out)
+        return out
+
+    def material_limit(self, mat_id, cat_key, depth=0, max_depth=5):
+        """material_limits() for a single category."""
+        return self.material_limits(mat_id, depth, max_depth)[IFRA_CAT_SLOT[cat_key]]
+
+    def mixture_limits(self, mat_id, max_depth=5):
+        """Per-category derived IFRA limit of a mixture from its composition:
+        {cat_key: {limit, binding_name, binding_cas, prohibited, no_restriction}}.
+        Empty dict if the material has no composition."""
+        key = ('mixture', max_depth)
+        cached = self._cached(mat_id, key)
+        if cached is not None:
+            return cached
+        comp = [(pct or 0, self.composition.materials[cid], self.material_limits(cid, 1, max_depth))
+                for cid, pct in self.composition.children.get(mat_id, ())
+                if cid in self.composition.materials]
+        derived = {}
+        for slot, ck in enumerate(IFRA_CAT_KEYS if comp else ()):
+            binding_limit = None
+            binding_name = None
+            binding_cas = None
+            prohibited = False
+            for c_pct, cm, vec in comp:
+                if c_pct <= 0:
+                    continue
+                comp_limit = vec[slot]
+                if comp_limit is None or comp_limit == -1:
+                    continue
+                if comp_limit == 0:
+                    prohibited = True
+                    binding_name = cm['name']
+                    binding_cas = cm['cas_number'] or ''
+                    binding_limit = 0
+                    break
+                d = comp_limit / (c_pct / 100.0)
+                if binding_limit is None or d < binding_limit:
+                    binding_limit = d
+                    binding_name = cm['name']
+                    binding_cas = cm['cas_number'] or ''
+            if binding_limit is not None:
+                # > 100% means no constraint in practice; encode it as the
+                # No-Restriction sentinel so the UI can render "غير مقيّد".
+                if binding_limit > 100 and not prohibited:
+                    limit_out = -1
+                else:
+                    limit_out = round(binding_limit, 4) if binding_limit > 0 else 0
+                derived[ck] = {
+                    'limit': limit_out,
+                    'binding_name': binding_name,
+                    'binding_cas': binding_cas,
+                    'prohibited': prohibited,
+                    'no_restriction': (limit_out == -1),
+                }
+        self._remember(mat_id, key, derived)
+        return derived
+
+    def ingredient_limits(self, row, cat_keys=None):
+        """F for one ingredient row in each of cat_keys (all 18 by default),
+        in priority order:
+          1. manual_ifra_cats[cat_key]   2. materials.ifra_limit
+          3. IFRA standard by CAS        4. IFRA contributions (naturals)
+          5. composition-derived         6. per-ingredient ifra_override wins
+        Returns [(limit, std_name, std_type, ifra_key, prohibited)] aligned
+        with cat_keys. limit is None when no source has a value (a
+        SPECIFICATION standard leaves every category empty); prohibited is
+        set only when the matched standard is 0 for the category."""
+        cat_keys = IFRA_CAT_KEYS if cat_keys is None else cat_keys
+        cas = row.get('cas_number') or ''
+        manual = {}
+        manual_raw = row.get('manual_ifra_cats')
+        if manual_raw:
+            try:
+                manual = json.loads(manual_raw) or {}
+            except Exception:
+                manual = {}
+        manual_mat_ifra = row.get('ifra_limit') or 0
+        entry = self.ifra.get(cas) if cas else None
+        centry = self.contribs.get(cas) if cas else None
+        mat_id = row.get('material_id')
+        override = row.get('ifra_override')
+
+        out = []
+        for cat_key in cat_keys:
+            slot = IFRA_CAT_SLOT[cat_key]
+            ifra_limit = None
+            prohibited = False
+            std_name = None
+            std_type = None
+            ifra_key = None
+
+            manual_cat_value = None
+            v = manual.get(cat_key)
+            try:
+                if v is not None and v != '' and float(v) > 0:
+                    manual_cat_value = float(v)
+            except (TypeError, ValueError):
+                pass
+
+            if manual_cat_value is not None:
+                ifra_limit = manual_cat_value
+                std_name = f'Manual ({cat_key})'
+                std_type = 'manual_category'
+            elif manual_mat_ifra > 0:
+                ifra_limit = manual_mat_ifra
+                std_name = 'Manual (material)'
+                std_type = 'manual_material'
+            elif cas:
+                if entry:
+                    std = entry['standard']
+                    std_name = std['name']
+                    std_type = std['standard_type']
+                    ifra_key = std['ifra_key']
+                    ifra_limit = entry['limits'][slot]  # None no value, -1 no restriction, 0 prohibited
+                    prohibited = ifra_limit == 0
+                # No direct standard — derive from constituents of naturals / Schiff bases
+                if std_name is None:
+                    derived = centry['derived'][slot] if centry else None
+                    if derived is not None:
+                        ifra_limit = round(derived[0], 6)
+                        std_name = f"Contrib: {derived[1]}"
+                        std_type = 'contribution'
+
+            # Composition-derived fallback (mixture / base / accord without its
+            # own IFRA limit): E3 shrinks when a hidden component is restricted.
+            if std_name is None and mat_id is not None:
+                derived_for_cat = self.material_limit(mat_id, cat_key, depth=1)
+                if derived_for_cat is not None:
+                    binding = self.mixture_limits(mat_id).get(cat_key)
+                    if binding:
+                        ifra_limit = -1 if derived_for_cat == -1 else (derived_for_cat if derived_for_cat > 0 else 0)
+                        std_name = f"Mix: {binding['binding_name']}"
+                        std_type = 'composition'
+
+            if override is not None:
+                ifra_limit = override
+                prohibited = False
+                std_name = std_name or 'Manual'
+                std_type = 'override'
+            out.append((ifra_limit, std_name, std_type, ifra_key, prohibited))
+        return out
+
+    def ingredient_limit(self, row, cat_key):
+        """(limit, std_name, std_type, ifra_key, prohibited) for a single category."""
+        return self.ingredient_limits(row, (cat_key,))[0]
+
+    # --- Whole-formula evaluation ----------------------------------------
+    def evaluate(self, rows, cat_key='cat4'):
+        """Evaluate ingredient rows for one category → FormulaEvaluation.
+
+        Spreadsheet columns: G weight, E dilution, I = G×E, H = G/ΣG,
+        J = I/ΣI, N = F/H (design), L = F/J (final); N3/E3 = min × 0.99."""
+        ingredients = [self.ingredient(dict(r), cat_key) for r in rows]
+        return self.finish(ingredients, cat_key)
+
+    def ingredient(self, row, cat_key):
+        """The per-row part that does not depend on the other rows: F and its
+        source, the natural constituents and the rolled-up price per gram."""
+        limit, std_name, std_type, ifra_key, prohibited = self.ingredient_limit(row, cat_key)
+        cas = row.get('cas_number') or ''
+        centry = self.contribs.get(cas) if cas else None
+        constituents = [{'name': c['constituent_name'], 'cas': c['constituent_cas'], 'pct': c['concentration_pct']}
+                        for c in (centry['constituents'] if centry else ())]
+        return IngredientEvaluation(
+            row=row,
+            concentration=0,
+            pure_weight=0,
+            weight_pct=0,
+            pure_pct=0,
+            ifra_limit=limit,
+            ifra_std_name=std_name,
+            ifra_std_type=std_type,
+            ifra_key=ifra_key,
+            prohibited=prohibited,
+            constituents=constituents,
+            effective_ppg=self.composition.effective_ppg(row['material_id'], row.get('price_per_gram') or 0),
+        )
+
+    def finish(self, ingredients, cat_key, contributions=None):
+        """Totals, H/J/N/L per row, contributions and the headline E3/N3 for
+        already-resolved ingredients (updated in place). Pass contributions
+        to reuse entries that cannot have moved (no weight changed)."""
+        total_weight = sum(ing.row['weight'] for ing in ingredients)  # ΣG
+        total_pure = sum(ing.row['weight'] * get_concentration(ing.row['dilution']) for ing in ingredients)  # ΣI
+        active_ratio = (total_pure / total_weight * 100) if total_weight > 0 else 0
+
+        n_values = []  # (N, binding name)
+        l_values = []  # (L, binding name)
+        for ing in ingredients:
+            r = ing.row
+            ing.concentration = get_concentration(r['dilution'])
+            ing.pure_weight = r['weight'] * ing.concentration
+            ing.weight_pct = (r['weight'] / total_weight) if total_weight > 0 else 0
+            ing.pure_pct = (ing.pure_weight / total_pure) if total_pure > 0 else 0
+            limit = ing.ifra_limit
+
+            calc_limit = limit if limit is not None and limit > 0 else 0  # None / -1 → no limit
+            ing.design_calc = (calc_limit / ing.weight_pct) if (calc_limit > 0 and ing.weight_pct > 0) else None
+            ing.final_calc = (calc_limit / ing.pure_pct) if (calc_limit > 0 and ing.pure_pct > 0) else None
+            if ing.design_calc is not None:
+                n_values.append((ing.design_calc, r['name']))
+            if ing.final_calc is not None:
+                l_values.append((ing.final_calc, r['name']))
+            ing.design_exceeded = limit is not None and limit > 0 and ing.weight_pct * 100 > limit
+            ing.final_exceeded = limit is not None and limit > 0 and ing.pure_pct * 100 > limit
+
+        if contributions is None:
+            contributions = self._contributions(ingredients, cat_key)
+        warnings = self._fold_contributions(contributions, cat_key, n_values, l_values)
+
+        # Headline E3 / N3 come last so per-row, composition-derived and
+        # cumulative constraints all feed in.
+        n_best = min(n_values, key=lambda v: v[0]) if n_values else None
+        l_best = min(l_values, key=lambda v: v[0]) if l_values else None
+
+        olfactive = {c: 0 for c in OLFACTIVE_CATEGORIES}
+        for ing in ingredients:
+            olf = self.olfactive.get(ing.row['material_id'])
+            if olf:
+                for c in OLFACTIVE_CATEGORIES:
+                    olfactive[c] += (olf[c] or 0) * ing.pure_pct
+        olfactive = {c: round(v, 1) for c, v in olfactive.items()}
+
+        return FormulaEvaluation(
+            category=cat_key,
+            ingredients=ingredients,
+            total_weight=total_weight,
+            total_pure=total_pure,
+            active_ratio=active_ratio,
+            design_limit=n_best[0] * 0.99 if n_best else 0,
+            final_limit=l_best[0] * 0.99 if l_best else 0,
+            design_bound=n_best[0] if n_best else None,
+            final_bound=l_best[0] if l_best else None,
+            design_binding=n_best[1] if n_best else None,
+            final_binding=l_best[1] if l_best else None,
+            contributions=contributions,
+            contribution_warnings=warnings,
+            olfactive=olfactive,
+        )
+
+    def evaluate_all(self, rows):
+        """Evaluate ingredient rows for all 18 categories in one pass.
+
+        Limits form an ingredients × 18 matrix (one ingredient_limits() call
+        per row); N/L quotients and the cumulative CAS constraints are reduced
+        column-wise into flat per-category arrays. The per-CAS exposure is
+        category independent, so it is built once."""
+        rows = [dict(r) for r in rows]
+        total_weight = sum(r['weight'] for r in rows)
+        total_pure = sum(r['weight'] * get_concentration(r['dilution']) for r in rows)
+        ncat = len(IFRA_CAT_KEYS)
+        inf = float('inf')
+        n_best = [inf] * ncat
+        l_best = [inf] * ncat
+        n_name = [None] * ncat
+        l_name = [None] * ncat
+        prohibited = [[] for _ in range(ncat)]
+        regulated = []
+
+        ingredients = []
+        for r in rows:
+            conc = get_concentration(r['dilution'])
+            pure_weight = r['weight'] * conc
+            weight_pct = (r['weight'] / total_weight) if total_weight > 0 else 0
+            pure_pct = (pure_weight / total_pure) if total_pure > 0 else 0
+            ingredients.append(IngredientEvaluation(
+                row=r, concentration=conc, pure_weight=pure_weight,
+                weight_pct=weight_pct, pure_pct=pure_pct, ifra_limit=None))
+
+            limits = self.ingredient_limits(r)
+            has_source = False
+            for slot, (limit, std_name, _type, _key, banned) in enumerate(limits):
+                if std_name is not None:
+                    has_source = True
+                if banned:
+                    prohibited[slot].append(r['name'])
+                if limit is not None and limit > 0:
+                    if weight_pct > 0 and limit / weight_pct < n_best[slot]:
+                        n_best[slot] = limit / weight_pct
+                        n_name[slot] = r['name']
+                    if pure_pct > 0 and limit / pure_pct < l_best[slot]:
+                        l_best[slot] = limit / pure_pct
+                        l_name[slot] = r['name']
+            if has_source:
+                regulated.append(r.get('id'))
+
+        for c_cas, cdata in self._exposure(ingredients).items():
+            entry = self.ifra.get(c_cas)
+            if not entry:
+                continue
+            total = cdata['total_pct']
+            name = cdata['constituent_name']
+            for slot, lim in enumerate(entry['limits']):
+                if lim == 0:
+                    prohibited[slot].append(name)
+                if not total or total <= 0 or lim is None or lim < 0:
+                    continue
+                cum_l = lim / (total / 100.0) if lim > 0 else 0
+                if cum_l < n_best[slot]:
+                    n_best[slot] = cum_l
+                    n_name[slot] = name
+                if cum_l < l_best[slot]:
+                    l_best[slot] = cum_l
+                    l_name[slot] = name
+
+        categories = {}
+        for slot, cat_key in enumerate(IFRA_CAT_KEYS):
+            n = n_best[slot] if n_best[slot] != inf else None
+            l = l_best[slot] if l_best[slot] != inf else None
+            categories[cat_key] = CategoryEvaluation(
+                category=cat_key,
+                design_limit=n * 0.99 if n is not None else 0,
+                final_limit=l * 0.99 if l is not None else 0,
+                design_bound=n,
+                final_bound=l,
+                design_binding=n_name[slot],
+                final_binding=l_name[slot],
+                prohibited=prohibited[slot],
+            )
+        return AllCategoriesEvaluation(
+            total_weight=total_weight,
+            total_pure=total_pure,
+            categories=categories,
+            regulated_ids=regulated,
+        )
+
+    def _exposure(self, ingredients):
+        """Per-CAS exposure in the formula (naturals + mixture components +
+        direct use of the same molecule). Independent of the IFRA category."""
+        contribution_map = {}
+
+        def entry_for(c_cas, name):
+            if c_cas not in contribution_map:
+                contribution_map[c_cas] = {
+                    'constituent_name': name,
+                    'constituent_cas': c_cas,
+                    'sources': [],
+                    'total_pct': 0,
+                    'ifra_limit': None,
+                    'exceeded': False,
+                    'no_restriction': False,
+                }
+            return contribution_map[c_cas]
+
+        # Naturals / Schiff bases
+        for ing in ingredients:
+            cas = ing.row.get('cas_number') or ''
+            centry = self.contribs.get(cas) if cas else None
+            if not centry:
+                continue
+            weight_pct_100 = ing.weight_pct * 100
+            for c in centry['constituents']:
+                contributed_pct = weight_pct_100 * c['concentration_pct'] / 100
+                cdata = entry_for(c['constituent_cas'], c['constituent_name'])
+                cdata['sources'].append({
+                    'material_name': ing.row['name'],
+                    'ncs_cas': cas,
+                    'ncs_name': c['ncs_name'],
+                    'source_type': c['source_type'],
+                    'concentration_in_ncs': c['concentration_pct'],
+                    'material_pct_in_formula': round(weight_pct_100, 4),
+                    'contributed_pct': round(contributed_pct, 6),
+                })
+                cdata['total_pct'] += contributed_pct
+
+        # Mixture components (user-defined composition, recursive)
+        for ing in ingredients:
+            weight_pct_100 = ing.weight_pct * 100
+            if weight_pct_100 <= 0:
+                continue
+            for sub in self.composition.expand(ing.row['material_id'], weight_pct_100):
+                c_cas = sub['cas']
+                if not c_cas:
+                    continue  # only IFRA-relevant if we can match by CAS
+                cdata = entry_for(c_cas, sub['name'])
+                cdata['sources'].append({
+                    'material_name': ing.row['name'],
+                    'ncs_cas': c_cas,
+                    'ncs_name': sub['name'],
+                    'source_type': 'mixture',
+                    'concentration_in_ncs': sub['pct_in_parent'],
+                    'material_pct_in_formula': round(weight_pct_100, 4),
+                    'contributed_pct': round(sub['effective_pct'], 6),
+                })
+                cdata['total_pct'] += sub['effective_pct']
+
+        for c_cas, cdata in contribution_map.items():
+            # Direct usage of the same molecule counts towards the total
+            for ing in ingredients:
+                if ing.row.get('cas_number') == c_cas:
+                    h = ing.weight_pct * 100
+                    cdata['total_pct'] += h
+                    cdata['sources'].insert(0, {
+                        'material_name': ing.row['name'],
+                        'ncs_cas': c_cas,
+                        'ncs_name': ing.row['name'],
+                        'source_type': 'direct',
+                        'concentration_in_ncs': 100,
+                        'material_pct_in_formula': h,
+                        'contributed_pct': h,
+                    })
+                    break
+            cdata['total_pct'] = round(cdata['total_pct'], 6)
+        return contribution_map
+
+    def _contributions(self, ingredients, cat_key):
+        """The per-CAS exposure checked against IFRA for cat_key."""
+        results = []
+        for c_cas, cdata in self._exposure(ingredients).items():
+            entry, cat_val = self._std_value(c_cas, cat_key)
+            if entry and cat_val is not None:
+                if cat_val == -1:
+                    cdata['no_restriction'] = True
+                elif cat_val == 0:
+                    cdata['ifra_limit'] = 0
+                    cdata['exceeded'] = True
+                else:
+                    cdata['ifra_limit'] = cat_val
+                    if cdata['total_pct'] > cat_val:
+                        cdata['exceeded'] = True
+            results.append(cdata)
+        return results
+
+    @staticmethod
+    def _fold_contributions(contributions, cat_key, n_values, l_values):
+        """Fold cumulative CAS limits into n/l_values and return the warnings."""
+        warnings = []
+        for cdata in contributions:
+            # Cumulative CAS constraint: without it the formula could show a
+            # green E3 while a regulated molecule is violated in aggregate
+            # across several mixtures / naturals.
+            total = cdata['total_pct']
+            lim = cdata['ifra_limit']
+            if total and total > 0:
+                if lim == 0:
+                    l_values.append((0, cdata['constituent_name']))
+                    n_values.append((0, cdata['constituent_name']))
+                elif lim is not None and lim > 0:
+                    cum_l = lim / (total / 100.0)
+                    l_values.append((cum_l, cdata['constituent_name']))
+                    n_values.append((cum_l, cdata['constituent_name']))
+
+            if cdata['exceeded']:
+                if cdata['ifra_limit'] == 0:
+                    warnings.append(f"⛔ {cdata['constituent_name']}: PROHIBITED in {cat_key}")
+                else:
+                    warnings.append(f"⚠️ {cdata['constituent_name']}: {cdata['total_pct']:.4f}% exceeds IFRA limit {cdata['ifra_limit']}%")
+        return warnings
+
+
+FORMULA_ROWS_SELECT = '''
+    SELECT fi.*, m.name, m.name_ar, m.cas_number, m.ifra_limit, m.manual_ifra_cats,
+           m.price_per_gram, m.profile
+    FROM formula_ingredients fi
+    JOIN materials m ON fi.material_id = m.id
+'''
+
+FORMULA_ROWS_SQL = FORMULA_ROWS_SELECT + '''    WHERE fi.formula_id = ?
+'''
+
+DRAFT_ROWS_SQL = '''
+    SELECT di.*, m.name, m.name_ar, m.cas_number, m.ifra_limit, m.manual_ifra_cats,
+           m.price_per_gram, m.profile
+    FROM draft_ingredients di
+    JOIN materials m ON di.material_id = m.id
+    WHERE di.draft_id = ?
+'''
+
+def formula_evaluator(conn, rows):
+    """FormulaEvaluator wired to the shared indices for these ingredient rows."""
+    mat_ids = {r['material_id'] for r in rows}
+    return FormulaEvaluator(
+        get_ifra_index(),
+        get_contributions_index(),
+        load_composition_index(conn, mat_ids),
+        load_olfactive_map(conn, mat_ids),
+        limit_cache=_mixture_limit_cache,
+    )
+
+
+# ===== Incremental formula state =====
+# The last evaluation of each open formula, kept so that a single-row edit
+# (action=update) re-resolves nothing: only the arithmetic is redone and the
+# response is a delta. States are dropped on any other change to the
+# formula and go stale with the mixture-limit generation / IFRA indices.
+_formula_states = {}  # fid -> FormulaState
+_formula_states_lock = threading.Lock()
+MAX_FORMULA_STATES = 64
+
+class FormulaState:
+    def __init__(self, evaluator, rows, cat_key):
+        self.evaluator = evaluator
+        self.cat_key = cat_key
+        self.generation = evaluator._generation
+        self.lock = threading.Lock()
+        self.evaluation = evaluator.evaluate(rows, cat_key)
+        self.by_id = {ing.row['id']: ing for ing in self.evaluation.ingredients}
+
+    def is_current(self, cat_key):
+        return (cat_key == self.cat_key
+                and self.generation == _mixture_limit_generation
+                and self.evaluator.ifra is _ifra_index
+                and self.evaluator.contribs is _contrib_index)
+
+    def apply_update(self, ing_id, changes):
+        """Apply a one-row edit ({weight, dilution, diluent, diluent_other,
+        ifra_override}) and return the delta, or None if the row is unknown.
+
+        Dilution / override / diluent edits leave every H untouched, so the
+        contribution entries are reused as is. A weight edit changes ΣG and
+        therefore rescales every exposure total; those entries are recomputed
+        in memory and only the ones whose total moved are returned, or all of
+        them when a constituent appeared or dropped out."""
+        ing = self.by_id.get(ing_id)
+        if ing is None:
+            return None
+        before = self.evaluation
+        weight_changed = ing.row['weight'] != changes['weight']
+        override_changed = ing.row.get('ifra_override') != changes['ifra_override']
+        ing.row.update(changes)
+        if override_changed:
+            (ing.ifra_limit, ing.ifra_std_name, ing.ifra_std_type,
+             ing.ifra_key, ing.prohibited) = self.evaluator.ingredient_limit(ing.row, self.cat_key)
+
+        old_totals = {c['constituent_cas']: c['total_pct'] for c in before.contributions}
+        after = self.evaluator.finish(before.ingredients, self.cat_key,
+                                      contributions=None if weight_changed else before.contributions)
+        self.evaluation = after
+        if set(old_totals) != {c['constituent_cas'] for c in after.contributions}:
+            return formula_delta(after, ing, after.contributions, complete=True)
+        moved = [c for c in after.contributions if old_totals.get(c['constituent_cas']) != c['total_pct']]
+        return formula_delta(after, ing, moved)
+
+
+def formula_delta(evaluation, ing, contributions, complete=False):
+    """Response body for an incremental update of one ingredient row.
+    complete: contributions is the whole list, not only the moved entries."""
+    return {
+        'row': ing.to_dict(),
+        'total_weight': evaluation.total_weight,
+        'total_pure': evaluation.total_pure,
+        'active_ratio': evaluation.active_ratio,
+        'ifra_design_limit': evaluation.design_limit,
+        'ifra_final_limit': evaluation.final_limit,
+        'ifra_design_binding': evaluation.design_binding,
+        'ifra_final_binding': evaluation.final_binding,
+        'contributions': contributions,
+        'contributions_complete': complete,
+        'contribution_warnings': evaluation.contribution_warnings,
+        'olfactive_profile': evaluation.olfactive,
+    }
+
+
+def remember_formula_state(fid, state):
+    with _formula_states_lock:
+        _formula_states.pop(fid, None)
+        _formula_states[fid] = state
+        while len(_formula_states) > MAX_FORMULA_STATES:
+            _formula_states.pop(next(iter(_formula_states)))
+
+
+def drop_formula_state(fid):
+    with _formula_states_lock:
+        _formula_states.pop(int(fid), None)
+
+
+# ===== IFRA portfolio sweep =====
+# Evaluates many formulas against their category (or all 18) on one set of
+# shared, read-only inputs: the IFRA/contributions indices, one composition
+# index for every material and all ingredient rows loaded in a single query.
+# Workers only do in-memory maths, so the pool never touches SQLite.
+SWEEP_FIELDS = ('id', 'name', 'status', 'ifra_category')
+
+_sweep_shared = None  # (evaluator, {fid: formula}, {fid: [rows]}, all_categories) for the workers
+
+def load_sweep_inputs(conn, formula_ids=None, status=None, category=None):
+    """Formulas matching the filters and their ingredient rows, grouped by formula."""
+    sql = "SELECT id, name, status, ifra_category FROM formulas WHERE 1=1"
+    params = []
+    if formula_ids:
+        sql += f" AND id IN ({','.join('?' * len(formula_ids))})"
+        params += list(formula_ids)
+    if status:
+        sql += " AND status=?"
+        params.append(status)
+    formulas = {f['id']: dict(f) for f in conn.execute(sql + " ORDER BY id", params).fetchall()
+                if not category or ifra_cat_key(f['ifra_category']) == category}
+    rows = {fid: [] for fid in formulas}
+    if formulas:
+        sql, params = FORMULA_ROWS_SELECT, []
+        if formula_ids:
+            sql += f" WHERE fi.formula_id IN ({','.join('?' * len(formulas))})"
+            params = list(formulas)
+        for r in conn.execute(sql + " ORDER BY fi.formula_id, fi.id", params):
+            if r['formula_id'] in rows:
+                rows[r['formula_id']].append(r)
+    return formulas, rows
+
+def sweep_formula(evaluator, formula, rows, all_categories=False):
+    """Compliance record for one formula: E3/N3, binding material and violations."""
+    cat_key = ifra_cat_key(formula['ifra_category'])
+    evaluation = evaluator.evaluate(rows, cat_key)
+    violations = []
+    for ing in evaluation.ingredients:
+        if ing.prohibited or ing.design_exceeded:
+            violations.append({
+                'type': 'ingredient',
+                'name': ing.row['name'],
+                'cas_number': ing.row['cas_number'] or '',
+                'pct': round(ing.weight_pct * 100, 4),
+                'limit': ing.ifra_limit,
+                'prohibited': ing.prohibited,
+            })
+    for c in evaluation.contributions:
+        if c['exceeded']:
+            violations.append({
+                'type': 'constituent',
+                'name': c['constituent_name'],
+                'cas_number': c['constituent_cas'],
+                'pct': c['total_pct'],
+                'limit': c['ifra_limit'],
+                'prohibited': c['ifra_limit'] == 0,
+            })
+    record = {
+        'type': 'formula',
+        'formula_id': formula['id'],
+        'name': formula['name'],
+        'status': formula['status'],
+        'category': cat_key,
+        'ingredient_count': len(rows),
+        'total_weight': evaluation.total_weight,
+        'ifra_design_limit': evaluation.design_limit,
+        'ifra_final_limit': evaluation.final_limit,
+        'binding': evaluation.final_binding,
+        'violations': violations,
+        'compliant': not violations,
+    }
+    if all_categories:
+        record['categories'] = evaluator.evaluate_all(rows).to_dict()
+    return record
+
+def _sweep_worker(fid, shared=None):
+    evaluator, formulas, rows, all_categories = shared or _sweep_shared
+    try:
+        return sweep_formula(evaluator, formulas[fid], rows[fid], all_categories)
+    except Exception as e:
+        log(f"[SWEEP] formula {fid}: {e}")
+        return {'type': 'error', 'formula_id': fid, 'message': str(e)}
+
+def run_ifra_sweep(formula_ids=None, status=None, category=None, all_categories=False,
+                   workers=None, use_processes=False):
+    """Yield one record per formula (in id order) and a final summary.
+
+    Threads by default (safe inside the web server); use_processes forks a
+    process pool that inherits the loaded indices, for CLI runs on POSIX."""
+    global _sweep_shared
+    started = time.time()
+    conn = get_db()
+    formulas, rows = load_sweep_inputs(conn, formula_ids, status, category)
+    composition = load_composition_index(conn)
+    conn.close()
+    shared = (FormulaEvaluator(get_ifra_index(), get_contributions_index(), composition),
+              formulas, {fid: [dict(r) for r in rs] for fid, rs in rows.items()}, all_categories)
+
+    workers = workers or min(8, os.cpu_count() or 1)
+    if use_processes and 'fork' in multiprocessing.get_all_start_methods():
+        # Forked children inherit the module global, nothing is pickled
+        _sweep_shared = shared
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+        work = _sweep_worker
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        work = lambda fid: _sweep_worker(fid, shared)
+    failing = errors = 0
+    with pool:
+        for record in pool.map(work, list(formulas), chunksize=16):
+            if record['type'] == 'error':
+                errors += 1
+            elif not record['compliant']:
+                failing += 1
+            yield record
+    yield {
+        'type': 'summary',
+        'formulas': len(formulas),
+        'failing': failing,
+        'errors': errors,
+        'elapsed_ms': round((time.time() - started) * 1000, 1),
+    }
+
+def _parse_ids(raw):
+    ids = []
+    for part in (raw or '').split(','):
+        part = part.strip()
+        if part.isdigit():
+            ids.append(int(part))
+    return ids
+
+# ===== IFRA amendment impact =====
+# A new standards workbook is staged next to the live one and compared with
+# the loaded index one category column at a time. Only formulas that reach a
+# changed CAS in their own category — directly, through a mixture's closure
+# or as a constituent of a natural — are re-evaluated, once against the live
+# indices and once against the staged ones.
+
+def stage_ifra_amendment(conn, xlsx_path, label='', filename=''):
+    """Parse a standards workbook into the ifra_amendment_* tables and return
+    the new amendment id. Caller commits."""
+    records = parse_ifra_standards_xlsx(xlsx_path)
+    if not records:
+        raise ValueError('no IFRA_STD rows found in workbook')
+    amendment = max(r['amendment'] for r in records)
+    aid = conn.execute(
+        "INSERT INTO ifra_amendments (label, filename, amendment, standards_count) VALUES (?,?,?,?)",
+        (label or f'Amendment {amendment}', filename, amendment, len(records))).lastrowid
+    cols = ('amendment_id',) + IFRA_STANDARD_FIELDS
+    conn.executemany(
+        f"INSERT OR REPLACE INTO ifra_amendment_standards ({', '.join(cols)}) VALUES ({','.join('?' * len(cols))})",
+        [(aid,) + tuple(r[k] for k in IFRA_STANDARD_FIELDS) for r in records])
+    conn.executemany(
+        "INSERT INTO ifra_amendment_cas (amendment_id, cas_number, ifra_key) VALUES (?,?,?)",
+        [(aid, cas, r['ifra_key']) for r in records for cas in r['cas_list']])
+    return aid
+
+def load_amendment_indices(conn, amendment_id):
+    """(ifra index, contributions index) as they would be with the staged
+    amendment live — same shapes as get_ifra_index()/get_contributions_index()."""
+    rows = conn.execute('''
+        SELECT l.cas_number AS lookup_cas, s.*
+        FROM ifra_amendment_cas l
+        JOIN ifra_amendment_standards s ON s.amendment_id = l.amendment_id AND s.ifra_key = l.ifra_key
+        WHERE l.amendment_id = ?
+        ORDER BY l.id
+    ''', (amendment_id,)).fetchall()
+    ifra = build_ifra_index(rows)
+    return ifra, build_contributions_index(conn.execute(CONTRIBUTION_ROWS_SQL).fetchall(), ifra)
+
+def _limit_strictness(value):
+    """Sortable strictness of a raw category value: prohibited (0) < any
+    positive limit < unrestricted (None / -1)."""
+    return float('inf') if value is None or value < 0 else value
+
+def classify_limit_change(old, new):
+    """'prohibited', 'tightened', 'loosened' or None when equally strict."""
+    o, n = _limit_strictness(old), _limit_strictness(new)
+    if o == n:
+        return None
+    if n == 0:
+        return 'prohibited'
+    return 'tightened' if n < o else 'loosened'
+
+def diff_ifra_indices(old_index, new_index):
+    """Per-CAS list of category changes between two IFRA indices, sorted by CAS."""
+    empty = (None,) * len(IFRA_CAT_KEYS)
+    changes = []
+    for cas in sorted(set(old_index) | set(new_index)):
+        old, new = old_index.get(cas), new_index.get(cas)
+        old_limits = old['limits'] if old else empty
+        new_limits = new['limits'] if new else empty
+        if old_limits == new_limits:
+            continue
+        categories = []
+        for slot, cat_key in enumerate(IFRA_CAT_KEYS):
+            kind = classify_limit_change(old_limits[slot], new_limits[slot])
+            if kind:
+                categories.append({'category': cat_key, 'old': old_limits[slot],
+                                   'new': new_limits[slot], 'change': kind})
+        if categories:
+            std = (new or old)['standard']
+            changes.append({
+                'cas_number': cas,
+                'name': std.get('name') or '',
+                'ifra_key': std.get('ifra_key') or '',
+                'status': 'added' if not old else 'removed' if not new else 'changed',
+                'categories': categories,
+            })
+    return changes
+
+def summarise_ifra_diff(changes):
+    """Counts per change kind and per category for a diff_ifra_indices() result."""
+    by_change = {'prohibited': 0, 'tightened': 0, 'loosened': 0}
+    by_category = {k: 0 for k in IFRA_CAT_KEYS}
+    for c in changes:
+        for cat in c['categories']:
+            by_change[cat['change']] += 1
+            by_category[cat['category']] += 1
+    return {'cas_count': len(changes), 'by_change': by_change,
+            'by_category': {k: v for k, v in by_category.items() if v}}
+
+def cas_formula_index(conn, contrib_index):
+    """Inverted index CAS -> {formula ids} over every CAS a formula reaches:
+    its ingredients, the components of mixture ingredients (closure) and the
+    constituents of naturals / Schiff bases among either."""
+    index = {}
+    rows = conn.execute('''
+        SELECT fi.formula_id, m.cas_number
+        FROM formula_ingredients fi JOIN materials m ON m.id = fi.material_id
+        UNION
+        SELECT fi.formula_id, m.cas_number
+        FROM formula_ingredients fi
+        JOIN material_composition_closure c ON c.ancestor_id = fi.material_id
+        JOIN materials m ON m.id = c.descendant_id
+    ''').fetchall()
+    for fid, cas in rows:
+        if not cas:
+            continue
+        index.setdefault(cas, set()).add(fid)
+        entry = contrib_index.get(cas)
+        for c in (entry['constituents'] if entry else ()):
+            index.setdefault(c['constituent_cas'], set()).add(fid)
+    return index
+
+def ifra_amendment_impact(amendment_id):
+    """Diff a staged amendment against the live standards and re-evaluate the
+    formulas it touches. Returns {diff summary, changes, ranked formulas}."""
+    started = time.time()
+    old_ifra, old_contribs = get_ifra_index(), get_contributions_index()
+    conn = get_db()
+    new_ifra, new_contribs = load_amendment_indices(conn, amendment_id)
+    changes = diff_ifra_indices(old_ifra, new_ifra)
+
+    changed_cats = {c['cas_number']: {cat['category'] for cat in c['categories']} for c in changes}
+    formula_cats = {r[0]: ifra_cat_key(r[1]) for r in conn.execute(
+        "SELECT id, ifra_category FROM formulas").fetchall()}
+    reached = {}  # fid -> changed CAS numbers it reaches in its own category
+    if changes:
+        for cas, fids in cas_formula_index(conn, old_contribs).items():
+            cats = changed_cats.get(cas)
+            if not cats:
+                continue
+            for fid in fids:
+                if formula_cats.get(fid) in cats:
+                    reached.setdefault(fid, set()).add(cas)
+
+    formulas, rows = load_sweep_inputs(conn, sorted(reached)) if reached else ({}, {})
+    composition = load_composition_index(conn, {r['material_id'] for rs in rows.values() for r in rs})
+    conn.close()
+
+    before_eval = FormulaEvaluator(old_ifra, old_contribs, composition)
+    after_eval = FormulaEvaluator(new_ifra, new_contribs, composition)
+    report = []
+    for fid, formula in formulas.items():
+        before = sweep_formula(before_eval, formula, rows[fid])
+        after = sweep_formula(after_eval, formula, rows[fid])
+        old_e3, new_e3 = before['ifra_final_limit'], after['ifra_final_limit']
+        known = {(v['type'], v['cas_number'], v['name']) for v in before['violations']}
+        new_violations = [v for v in after['violations'] if (v['type'], v['cas_number'], v['name']) not in known]
+        if old_e3 == new_e3 and before['ifra_design_limit'] == after['ifra_design_limit'] and not new_violations \
+                and before['compliant'] == after['compliant']:
+            continue
+        report.append({
+            'formula_id': fid,
+            'name': formula['name'],
+            'status': formula['status'],
+            'category': before['category'],
+            'changed_cas': sorted(reached[fid]),
+            'before': {k: before[k] for k in ('ifra_design_limit', 'ifra_final_limit', 'binding', 'compliant')},
+            'after': {k: after[k] for k in ('ifra_design_limit', 'ifra_final_limit', 'binding', 'compliant')},
+            'final_limit_change_pct': round((new_e3 - old_e3) / old_e3 * 100, 2) if old_e3 else None,
+            'newly_non_compliant': before['compliant'] and not after['compliant'],
+            'new_violations': new_violations,
+        })
+    # Worst first: newly failing, then most new violations, then biggest E3 drop
+    report.sort(key=lambda r: (not r['newly_non_compliant'], -len(r['new_violations']),
+                               r['final_limit_change_pct'] if r['final_limit_change_pct'] is not None else 0,
+                               r['formula_id']))
+    for rank, r in enumerate(report, 1):
+        r['rank'] = rank
+    return {
+        'amendment_id': amendment_id,
+        'summary': summarise_ifra_diff(changes),
+        'formulas_checked': len(formulas),
+        'formulas_impacted': len(report),
+        'newly_non_compliant': sum(1 for r in report if r['newly_non_compliant']),
+        'changes': changes,
+        'formulas': report,
+        'elapsed_ms': round((time.time() - started) * 1000, 1),
+    }
+
+
+
 # ===== المصادقة =====
 def login_required(f):
     @wraps(f)
@@ -1156,6 +3781,56 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated
 
+# ===== Conditional GETs =====
+# An endpoint that only reads `tables` tags its GET answers with an ETag made
+# from the request URL and their table_versions counters; a request whose
+# If-None-Match still matches gets 304 before the view runs a single query of
+# its own. The salt covers what the counters can't see: new code after a
+# restart, and a restored file whose counters repeat values already handed
+# out. Views that also use the in-memory IFRA indices add the mixture-limit
+# generation, which moves when those are reloaded.
+_etag_salt = uuid.uuid4().hex
+
+def invalidate_etags():
+    """Make every ETag handed out so far stale (the database was replaced)."""
+    global _etag_salt
+    _etag_salt = uuid.uuid4().hex
+
+def tables_etag(tables, url, ifra_indices=False):
+    conn = get_db(readonly=True)
+    try:
+        rows = conn.execute(f"""SELECT name, version FROM table_versions
+            WHERE name IN ({','.join('?' * len(tables))}) ORDER BY name""", tables).fetchall()
+    finally:
+        conn.close()
+    key = _etag_salt + ':' + url + ':' + ','.join(f"{r['name']}={r['version']}" for r in rows)
+    if ifra_indices:
+        key += f":{_mixture_limit_generation}"
+    return hashlib.sha1(key.encode()).hexdigest()[:24]
+
+def conditional_get(*tables, ifra_indices=False):
+    """ETag / If-None-Match for a view whose GET answers depend only on `tables`
+    (all of them in VERSIONED_TABLES), the request URL and, with
+    ifra_indices=True, the loaded IFRA indices."""
+    def decorate(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if request.method != 'GET':
+                return f(*args, **kwargs)
+            # Read before the view: a write in between only makes the tag older
+            etag = tables_etag(tables, request.full_path, ifra_indices)
+            if request.if_none_match.contains(etag):
+                resp = make_response('', 304)
+            else:
+                resp = make_response(f(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+            resp.set_etag(etag)
+            resp.headers['Cache-Control'] = 'no-cache'  # keep it, but ask every time
+            return resp
+        return decorated
+    return decorate
+
 # ===== الصفحات الأساسية =====
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -1168,11 +3843,8 @@ def login():
         if user:
             session['user_id'] = user['id']
             session['user_name'] = user['name']
-            # Auto-backup on login
-            try:
-                create_backup('login')
-            except Exception as e:
-                log(f"[BACKUP] Auto-backup failed: {e}")
+            # Auto-backup on login, taken by the scheduler thread
+            _backup_scheduler.request('login')
             return redirect('/')
         error = 'خطأ في اسم المستخدم أو كلمة المرور'
     return render_template('login.html', error=error)
@@ -1218,11 +3890,10 @@ def formulas():
 def formula_detail(id):
     conn = get_db()
     formula = conn.execute("SELECT * FROM formulas WHERE id=?", (id,)).fetchone()
-    materials = conn.execute("SELECT id, name, name_ar, cas_number FROM materials ORDER BY name").fetchall()
     conn.close()
     if not formula:
         return redirect('/formulas')
-    return render_template('formula.html', formula=formula, materials=materials, ifra_categories=IFRA_CATEGORIES)
+    return render_template('formula.html', formula=formula, ifra_categories=IFRA_CATEGORIES)
 
 @app.route('/formula/<int:id>/print')
 @login_required
@@ -1237,14 +3908,16 @@ def formula_print(id):
         (id,)
     ).fetchall()
     company = conn.execute("SELECT * FROM company_info WHERE id=1").fetchone()
+    snapshot = formula_snapshot(conn, formula)
     conn.close()
-    cat_key = formula['ifra_category'] or 'cat4'
+    cat_key = ifra_cat_key(formula['ifra_category'])
     cat = next((c for c in IFRA_CATEGORIES if c['id'] == cat_key), None)
     return render_template(
         'formula_print.html',
         formula=formula,
         notes=notes,
         company=company,
+        evaluation=snapshot['evaluation'] if snapshot else None,
         category_name=(cat['name'] if cat else ''),
         category_desc=(cat['desc'] if cat else ''),
         today=datetime.now().strftime('%Y-%m-%d')
@@ -1264,17 +3937,79 @@ def production():
 def notebook():
     return render_template('notebook.html')
 
+# GET /api/notebook/entries lists entries, last edited first, without their
+# body and profile (action=get&id= returns one whole entry):
+#   q=  words in title / tags / body (notebook_fts)   category=   tag=
+#   limit=  cursor=   keyset pages: `cursor` is the previous page's next_cursor
+#   facets=1          entries per category and per tag, whole notebook (or action=facets)
+NOTEBOOK_PAGE = 50
+NOTEBOOK_PAGE_MAX = 200
+NOTEBOOK_EXCERPT = 120  # characters of the body shown in the list
+
+def notebook_facets(conn):
+    categories = {r['category']: r['n'] for r in conn.execute(
+        "SELECT category, COUNT(*) AS n FROM notebook_entries GROUP BY category")}
+    tags = {r['tag']: r['n'] for r in conn.execute(
+        "SELECT tag, COUNT(*) AS n FROM notebook_tags GROUP BY tag ORDER BY tag")}
+    return {'total': sum(categories.values()), 'categories': categories, 'tags': tags}
+
+def query_notebook(conn, args):
+    """A page of the notebook list `args` asks for (see above). Raises
+    ValueError on a malformed cursor."""
+    where, params = [], []
+    if args.get('category'):
+        where.append("e.category = ?")
+        params.append(args['category'])
+    if args.get('tag'):
+        where.append("e.id IN (SELECT entry_id FROM notebook_tags WHERE tag = ?)")
+        params.append(args['tag'])
+    match = search_match_expr(args.get('q', ''))
+    if match:
+        where.append("e.id IN (SELECT rowid FROM notebook_fts WHERE notebook_fts MATCH ?)")
+        params.append(match)
+    if args.get('cursor'):
+        updated_at, last_id = _decode_cursor(args['cursor'], 2)
+        # The single-column bound is what lets SQLite seek into the index
+        where.append("e.updated_at <= ? AND (e.updated_at, e.id) < (?, ?)")
+        params += [updated_at, updated_at, last_id]
+    limit = max(1, min(args.get('limit', NOTEBOOK_PAGE, type=int), NOTEBOOK_PAGE_MAX))
+    rows = conn.execute(f'''
+        SELECT e.id, e.title, e.category, e.tags, e.updated_at, substr(e.body, 1, {NOTEBOOK_EXCERPT}) AS excerpt
+        FROM notebook_entries e
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY e.updated_at DESC, e.id DESC
+        LIMIT {limit + 1}''', params).fetchall()  # one more: is there a next page?
+    more = len(rows) > limit
+    rows = rows[:limit]
+    result = {'success': True, 'data': [dict(r) for r in rows],
+              'next_cursor': _encode_cursor([rows[-1]['updated_at'], rows[-1]['id']]) if more else None}
+    if args.get('facets') in ('1', 'true'):
+        result['facets'] = notebook_facets(conn)
+    return result
+
 @app.route('/api/notebook/entries', methods=['GET', 'POST'])
 @login_required
+@conditional_get('notebook_entries')
 def api_notebook_entries():
     conn = get_db()
     if request.method == 'GET':
-        rows = conn.execute('''
-            SELECT id, title, category, tags, body, profile, created_at, updated_at
-            FROM notebook_entries ORDER BY updated_at DESC
-        ''').fetchall()
+        action = request.args.get('action', 'list')
+        if action == 'get':
+            row = conn.execute('SELECT * FROM notebook_entries WHERE id=?', (request.args.get('id'),)).fetchone()
+            conn.close()
+            if not row:
+                return jsonify({'success': False, 'message': 'غير موجودة'}), 404
+            return jsonify({'success': True, 'data': dict(row)})
+        if action == 'facets':
+            result = {'success': True, 'data': notebook_facets(conn)}
+        else:
+            try:
+                result = query_notebook(conn, request.args)
+            except (ValueError, TypeError) as e:
+                conn.close()
+                return jsonify({'success': False, 'message': str(e)}), 400
         conn.close()
-        return jsonify({'success': True, 'data': [dict(r) for r in rows]})
+        return jsonify(result)
 
     action = request.form.get('action', 'create')
 
@@ -1284,12 +4019,10 @@ def api_notebook_entries():
         tags = request.form.get('tags', '')
         body = request.form.get('body', '')
         profile = request.form.get('profile', '{}')
-        cur = conn.execute('''
+        new_id = db_write(lambda w: w.execute('''
             INSERT INTO notebook_entries (title, category, tags, body, profile)
             VALUES (?, ?, ?, ?, ?)
-        ''', (title, category, tags, body, profile))
-        new_id = cur.lastrowid
-        conn.commit()
+        ''', (title, category, tags, body, profile)).lastrowid)
         row = conn.execute('SELECT * FROM notebook_entries WHERE id=?', (new_id,)).fetchone()
         conn.close()
         return jsonify({'success': True, 'data': dict(row)})
@@ -1305,15 +4038,13 @@ def api_notebook_entries():
         if fields:
             fields.append("updated_at=CURRENT_TIMESTAMP")
             params.append(eid)
-            conn.execute(f"UPDATE notebook_entries SET {', '.join(fields)} WHERE id=?", params)
-            conn.commit()
+            db_write(lambda w: w.execute(f"UPDATE notebook_entries SET {', '.join(fields)} WHERE id=?", params))
         conn.close()
         return jsonify({'success': True})
 
     if action == 'delete':
         eid = request.form.get('id')
-        conn.execute('DELETE FROM notebook_entries WHERE id=?', (eid,))
-        conn.commit()
+        db_write(lambda w: w.execute('DELETE FROM notebook_entries WHERE id=?', (eid,)))
         conn.close()
         return jsonify({'success': True, 'message': 'تم الحذف'})
 
@@ -1323,12 +4054,10 @@ def api_notebook_entries():
         if not src:
             conn.close()
             return jsonify({'success': False, 'message': 'غير موجودة'})
-        cur = conn.execute('''
+        new_id = db_write(lambda w: w.execute('''
             INSERT INTO notebook_entries (title, category, tags, body, profile)
             VALUES (?, ?, ?, ?, ?)
-        ''', ((src['title'] or '') + ' (نسخة)', src['category'], src['tags'], src['body'], src['profile']))
-        new_id = cur.lastrowid
-        conn.commit()
+        ''', ((src['title'] or '') + ' (نسخة)', src['category'], src['tags'], src['body'], src['profile'])).lastrowid)
         row = conn.execute('SELECT * FROM notebook_entries WHERE id=?', (new_id,)).fetchone()
         conn.close()
         return jsonify({'success': True, 'data': dict(row)})
@@ -1339,10 +4068,7 @@ def api_notebook_entries():
 @app.route('/calculator')
 @login_required
 def calculator():
-    conn = get_db()
-    materials = conn.execute("SELECT * FROM materials ORDER BY name").fetchall()
-    conn.close()
-    return render_template('calculator.html', materials=materials)
+    return render_template('calculator.html')
 
 @app.route('/suppliers')
 @login_required
@@ -1363,10 +4089,9 @@ def ifra_certificate():
 def msds_generator():
     conn = get_db()
     formulas = conn.execute("SELECT id, name FROM formulas ORDER BY name").fetchall()
-    materials = conn.execute("SELECT id, name FROM materials ORDER BY name").fetchall()
     company = conn.execute("SELECT * FROM company_info WHERE id=1").fetchone()
     conn.close()
-    return render_template('msds_generator.html', formulas=formulas, materials=materials, company=company,
+    return render_template('msds_generator.html', formulas=formulas, company=company,
                           h_codes=GHS_H_CODES, p_codes=GHS_P_CODES, pictograms=GHS_PICTOGRAMS,
                           signal_words=GHS_SIGNAL_WORDS, classifications=GHS_CLASSIFICATIONS)
 
@@ -1895,14 +4620,7 @@ def api_ifra_lookup():
     if not cas:
         return jsonify({'success': False, 'message': 'CAS required'})
 
-    conn = get_db()
-    row = conn.execute('''
-        SELECT s.* FROM ifra_standards s
-        JOIN ifra_cas_lookup l ON l.ifra_standard_id = s.id
-        WHERE l.cas_number = ?
-    ''', (cas,)).fetchone()
-    conn.close()
-
+    row = ifra_standard_for_cas(cas)
     if not row:
         return jsonify({'success': False, 'message': f'No IFRA standard found for CAS {cas}'})
 
@@ -1931,7 +4649,7 @@ def api_ifra_contributions_calc(fid):
         conn.close()
         return jsonify({'success': False, 'message': 'Formula not found'})
 
-    cat_key = formula['ifra_category'] or 'cat4'
+    cat_key = ifra_cat_key(formula['ifra_category'])
 
     ingredients = conn.execute('''
         SELECT fi.*, m.name, m.cas_number, m.ifra_limit
@@ -1947,10 +4665,7 @@ def api_ifra_contributions_calc(fid):
         if not cas:
             continue
 
-        contribs = conn.execute(
-            'SELECT * FROM ifra_contributions WHERE ncs_cas = ?', (cas,)
-        ).fetchall()
-
+        contribs = contributions_for_cas(cas)
         if not contribs:
             continue
 
@@ -1963,18 +4678,12 @@ def api_ifra_contributions_calc(fid):
             c_cas = c['constituent_cas']
             conc_pct = c['concentration_pct']
 
-            # Look up IFRA limit for the constituent
-            row = conn.execute('''
-                SELECT s.* FROM ifra_standards s
-                JOIN ifra_cas_lookup l ON l.ifra_standard_id = s.id
-                WHERE l.cas_number = ?
-            ''', (c_cas,)).fetchone()
-
             constituent_ifra_limit = None
             derived_limit = None
 
-            if row:
-                cat_val = row[cat_key]
+            # Constituent limits were resolved when the index was built
+            if c['limits'] is not None:
+                cat_val = c['limits'][IFRA_CAT_SLOT[cat_key]]
                 if cat_val is not None:
                     if cat_val == 0:
                         # Constituent is prohibited → material effectively prohibited
@@ -2016,6 +4725,84 @@ def api_ifra_contributions_calc(fid):
         'material_limits': material_limits,
     })
 
+@app.route('/api/ifra/sweep')
+@login_required
+def api_ifra_sweep():
+    """Portfolio IFRA check, streamed as NDJSON (one formula per line, then a summary).
+    Filters: ids=1,2,3  status=final  category=cat4  all_categories=1.
+    The pool size is the default one; `flask ifra-sweep --workers` sets it."""
+    records = run_ifra_sweep(
+        formula_ids=_parse_ids(request.args.get('ids')),
+        status=request.args.get('status') or None,
+        category=request.args.get('category') or None,
+        all_categories=request.args.get('all_categories') in ('1', 'true'),
+    )
+    body = (json.dumps(r, ensure_ascii=False) + '\n' for r in records)
+    return Response(body, mimetype='application/x-ndjson')
+
+@app.route('/api/ifra/amendments', methods=['GET', 'POST'])
+@login_required
+def api_ifra_amendments():
+    """GET: staged standards workbooks. POST (file, label): stage a new one
+    and return its diff summary against the live standards."""
+    conn = get_db()
+    if request.method == 'GET':
+        rows = conn.execute("SELECT * FROM ifra_amendments ORDER BY id DESC").fetchall()
+        conn.close()
+        return jsonify({'success': True, 'data': [dict(r) for r in rows]})
+
+    f = request.files.get('file')
+    if not f or not f.filename.lower().endswith('.xlsx'):
+        conn.close()
+        return jsonify({'success': False, 'message': 'ارفع ملف معايير IFRA بصيغة xlsx'})
+    os.makedirs(IMPORT_TEMP_DIR, exist_ok=True)
+    save_path = os.path.join(IMPORT_TEMP_DIR, f'{uuid.uuid4()}.xlsx')
+    f.save(save_path)
+    try:
+        with import_running():
+            aid = stage_ifra_amendment(conn, save_path, request.form.get('label', '').strip(), f.filename)
+            conn.commit()
+        new_ifra, _ = load_amendment_indices(conn, aid)
+    except Exception as e:
+        conn.close()
+        log(f"[IFRA] Amendment staging failed: {e}")
+        return jsonify({'success': False, 'message': f'خطأ في قراءة ملف المعايير: {e}'})
+    finally:
+        os.remove(save_path)
+    conn.close()
+    summary = summarise_ifra_diff(diff_ifra_indices(get_ifra_index(), new_ifra))
+    return jsonify({'success': True, 'id': aid, 'summary': summary})
+
+@app.route('/api/ifra/amendments/<int:aid>', methods=['GET', 'POST'])
+@login_required
+def api_ifra_amendment(aid):
+    """GET: the columnar diff (?impact=1 adds the ranked formula report).
+    POST action=delete: drop the staged workbook."""
+    conn = get_db()
+    row = conn.execute("SELECT * FROM ifra_amendments WHERE id=?", (aid,)).fetchone()
+    if not row:
+        conn.close()
+        return jsonify({'success': False, 'message': 'التعديل غير موجود'}), 404
+    if request.method == 'POST':
+        if request.form.get('action') == 'delete':
+            conn.execute("DELETE FROM ifra_amendment_cas WHERE amendment_id=?", (aid,))
+            conn.execute("DELETE FROM ifra_amendment_standards WHERE amendment_id=?", (aid,))
+            conn.execute("DELETE FROM ifra_amendments WHERE id=?", (aid,))
+            conn.commit()
+        conn.close()
+        return jsonify({'success': True})
+
+    if request.args.get('impact') in ('1', 'true'):
+        conn.close()
+        result = ifra_amendment_impact(aid)
+    else:
+        new_ifra, _ = load_amendment_indices(conn, aid)
+        conn.close()
+        changes = diff_ifra_indices(get_ifra_index(), new_ifra)
+        result = {'amendment_id': aid, 'summary': summarise_ifra_diff(changes), 'changes': changes}
+    result['amendment'] = dict(row)
+    return jsonify(result)
+
 @app.route('/api/ifra/formula-check/<int:fid>', methods=['GET'])
 @login_required
 def api_ifra_formula_check(fid):
@@ -2027,215 +4814,457 @@ def api_ifra_formula_check(fid):
         conn.close()
         return jsonify({'success': False, 'message': 'Formula not found'})
 
-    cat_key = formula['ifra_category'] or 'cat4'
-
-    # Get all ingredients with their materials
-    ingredients = conn.execute('''
-        SELECT fi.*, m.name, m.cas_number, m.ifra_limit
-        FROM formula_ingredients fi
-        JOIN materials m ON fi.material_id = m.id
-        WHERE fi.formula_id = ?
-    ''', (fid,)).fetchall()
+    cat_key = ifra_cat_key(formula['ifra_category'])
 
+    ingredients = conn.execute(FORMULA_ROWS_SQL, (fid,)).fetchall()
     total_weight = sum(i['weight'] for i in ingredients)
     if total_weight == 0:
         conn.close()
         return jsonify({'success': True, 'results': [], 'total_weight': 0})
 
-    # For each ingredient, find IFRA limit for the selected category
+    # Same priority chain and contribution map as the formula page
+    evaluation = formula_evaluator(conn, ingredients).evaluate(ingredients, cat_key)
+    conn.close()
+
     results = []
     warnings = []
-
-    for i in ingredients:
-        cas = i['cas_number'] or ''
-        conc = get_concentration(i['dilution'])
-        pure_weight = i['weight'] * conc
-        weight_pct = (i['weight'] / total_weight * 100) if total_weight > 0 else 0
-        pure_pct = (pure_weight / sum(ing['weight'] * get_concentration(ing['dilution']) for ing in ingredients) * 100) if total_weight > 0 else 0
-
-        # Get IFRA limit for this category
-        ifra_data = None
-        ifra_limit = None
-        if cas:
-            row = conn.execute('''
-                SELECT s.* FROM ifra_standards s
-                JOIN ifra_cas_lookup l ON l.ifra_standard_id = s.id
-                WHERE l.cas_number = ?
-            ''', (cas,)).fetchone()
-            if row:
-                ifra_data = dict(row)
-                cat_val = row[cat_key]
-                if cat_val is not None:
-                    if cat_val == -1:
-                        ifra_limit = None  # No restriction
-                    elif cat_val == 0:
-                        ifra_limit = 0  # Prohibited
-                    else:
-                        ifra_limit = cat_val
-
-        # Fallback to manual ifra_limit if no IFRA standard found
-        if ifra_limit is None and ifra_data is None and i['ifra_limit']:
-            ifra_limit = i['ifra_limit']
-
-        exceeded = False
-        if ifra_limit is not None and ifra_limit >= 0:
-            if ifra_limit == 0:
-                exceeded = True  # Prohibited
-            elif weight_pct > ifra_limit:
-                exceeded = True
-
-        result_item = {
-            'material_name': i['name'],
-            'cas_number': cas,
+    for ing in evaluation.ingredients:
+        weight_pct = ing.weight_pct * 100
+        ifra_limit = ing.ifra_limit if (ing.prohibited or (ing.ifra_limit or 0) > 0) else None
+        exceeded = ing.prohibited or (ifra_limit is not None and weight_pct > ifra_limit)
+        results.append({
+            'material_name': ing.row['name'],
+            'cas_number': ing.row['cas_number'] or '',
             'weight_pct': round(weight_pct, 4),
-            'pure_pct': round(pure_pct, 4),
+            'pure_pct': round(ing.pure_pct * 100, 4),
             'ifra_limit': ifra_limit,
-            'ifra_type': ifra_data['standard_type'] if ifra_data else None,
-            'ifra_key': ifra_data['ifra_key'] if ifra_data else None,
+            'ifra_type': ing.ifra_std_type,
+            'ifra_key': ing.ifra_key,
             'exceeded': exceeded,
-            'no_restriction': (ifra_data and ifra_data.get(cat_key) == -1) if ifra_data else False,
-        }
-        results.append(result_item)
-
+            'no_restriction': ing.no_restriction,
+        })
         if exceeded:
-            if ifra_limit == 0:
-                warnings.append(f"⛔ {i['name']}: PROHIBITED in {cat_key}")
+            if ing.prohibited:
+                warnings.append(f"⛔ {ing.row['name']}: PROHIBITED in {cat_key}")
             else:
-                warnings.append(f"⚠️ {i['name']}: {weight_pct:.4f}% exceeds IFRA limit {ifra_limit}%")
-
-    # === Contributions from other sources ===
-    # For each ingredient, check if it contains restricted IFRA constituents
-    # (from naturals or Schiff bases), sum contributions per constituent, check limits
-    contribution_map = {}  # constituent_cas -> {name, sources: [{material, ncs_cas, contributed_pct}], total_pct, ifra_limit, exceeded}
-
-    for i in ingredients:
-        cas = i['cas_number'] or ''
-        if not cas:
-            continue
-
-        weight_pct = (i['weight'] / total_weight * 100) if total_weight > 0 else 0
-
-        # Look up contributions where this material's CAS matches ncs_cas
-        contribs = conn.execute('''
-            SELECT * FROM ifra_contributions WHERE ncs_cas = ?
-        ''', (cas,)).fetchall()
-
-        for c in contribs:
-            c_cas = c['constituent_cas']
-            contributed_pct = weight_pct * c['concentration_pct'] / 100
-
-            if c_cas not in contribution_map:
-                contribution_map[c_cas] = {
-                    'constituent_name': c['constituent_name'],
-                    'constituent_cas': c_cas,
-                    'sources': [],
-                    'total_pct': 0,
-                    'ifra_limit': None,
-                    'exceeded': False,
-                    'no_restriction': False,
-                }
-
-            contribution_map[c_cas]['sources'].append({
-                'material_name': i['name'],
-                'ncs_cas': cas,
-                'ncs_name': c['ncs_name'],
-                'source_type': c['source_type'],
-                'concentration_in_ncs': c['concentration_pct'],
-                'material_pct_in_formula': round(weight_pct, 4),
-                'contributed_pct': round(contributed_pct, 6),
-            })
-            contribution_map[c_cas]['total_pct'] += contributed_pct
-
-    # Now check IFRA limits for each contributed constituent
-    contribution_results = []
-    for c_cas, data in contribution_map.items():
-        # Also add any direct usage of this constituent from Layer 1
-        for r in results:
-            if r['cas_number'] == c_cas:
-                data['total_pct'] += r['weight_pct']
-                data['sources'].insert(0, {
-                    'material_name': r['material_name'],
-                    'ncs_cas': c_cas,
-                    'ncs_name': r['material_name'],
-                    'source_type': 'direct',
-                    'concentration_in_ncs': 100,
-                    'material_pct_in_formula': r['weight_pct'],
-                    'contributed_pct': r['weight_pct'],
-                })
-                break
-
-        data['total_pct'] = round(data['total_pct'], 6)
-
-        # Look up IFRA limit for the constituent
-        row = conn.execute('''
-            SELECT s.* FROM ifra_standards s
-            JOIN ifra_cas_lookup l ON l.ifra_standard_id = s.id
-            WHERE l.cas_number = ?
-        ''', (c_cas,)).fetchone()
-
-        if row:
-            cat_val = row[cat_key]
-            if cat_val is not None:
-                if cat_val == -1:
-                    data['ifra_limit'] = None
-                    data['no_restriction'] = True
-                elif cat_val == 0:
-                    data['ifra_limit'] = 0
-                    data['exceeded'] = True
-                else:
-                    data['ifra_limit'] = cat_val
-                    if data['total_pct'] > cat_val:
-                        data['exceeded'] = True
+                warnings.append(f"⚠️ {ing.row['name']}: {weight_pct:.4f}% exceeds IFRA limit {ifra_limit}%")
 
+    for data in evaluation.contributions:
         if data['exceeded']:
             if data['ifra_limit'] == 0:
                 warnings.append(f"⛔ {data['constituent_name']} (from contributions): PROHIBITED in {cat_key}")
             else:
                 warnings.append(f"⚠️ {data['constituent_name']} (from contributions): {data['total_pct']:.4f}% exceeds IFRA limit {data['ifra_limit']}%")
 
-        contribution_results.append(data)
-
-    conn.close()
     return jsonify({
         'success': True,
         'category': cat_key,
         'results': results,
-        'contributions': contribution_results,
+        'contributions': evaluation.contributions,
         'warnings': warnings,
         'total_weight': total_weight
     })
 
 # ===== API المواد =====
+# ===== Materials catalogue query =====
+# GET /api/materials?action=list filters, sorts and pages in SQL:
+#   q=            text in name / Arabic name / CAS / synonyms / odour / family / supplier / profile
+#   family=1,2  profile=Top,Base  supplier=3  stock=in|out  ifra=has|none
+#   mixture=mix|atom  cas=has|none  (each a comma list of MATERIAL_FACETS values)
+#   ppg_min= ppg_max=   sort=<MATERIAL_SORTS key>  dir=asc|desc
+#   limit=  cursor=     keyset pages: `cursor` is the previous page's next_cursor
+#   fields=id,name,…    only these (materials columns or MATERIAL_EXTRA_FIELDS)
+#   facets=1            per-facet counts under the other filters, for the chips
+# Without any of them the answer is what it always was: every material, every field.
+MATERIAL_FACETS = {
+    'family': "m.family_id",
+    'profile': "COALESCE(NULLIF(m.profile, ''), 'Heart')",
+    'supplier': "m.supplier_id",
+    'stock': "CASE WHEN COALESCE(m.in_stock, 0) > 0 THEN 'in' ELSE 'out' END",
+    # Own limit, manual per-category overrides, or a CAS the IFRA lookup can match
+    'ifra': """CASE WHEN COALESCE(m.ifra_limit, 0) > 0 OR COALESCE(m.manual_ifra_cats, '') NOT IN ('', '{}')
+                 OR COALESCE(m.cas_number, '') != '' THEN 'has' ELSE 'none' END""",
+    'mixture': """CASE WHEN EXISTS (SELECT 1 FROM material_composition mc WHERE mc.parent_material_id = m.id)
+                    THEN 'mix' ELSE 'atom' END""",
+    'cas': "CASE WHEN COALESCE(m.cas_number, '') != '' THEN 'has' ELSE 'none' END",
+}
+MATERIAL_SORTS = {
+    'name': "COALESCE(m.name, '')",
+    'name_ar': "COALESCE(m.name_ar, '')",
+    'cas_number': "COALESCE(m.cas_number, '')",
+    'price_per_gram': "COALESCE(m.price_per_gram, 0)",
+    'in_stock': "COALESCE(m.in_stock, 0)",
+    'ifra_limit': "COALESCE(m.ifra_limit, 0)",
+}
+MATERIAL_EXTRA_FIELDS = {
+    'family_name': "f.name AS family_name",
+    'family_icon': "f.icon AS family_icon",
+    'supplier_name': "s.name AS supplier_name",
+    'composition_count': "(SELECT COUNT(*) FROM material_composition mc WHERE mc.parent_material_id = m.id) AS composition_count",
+    'olfactive': "o.material_id AS olf_id, " + ', '.join(f"o.{cat} AS olf_{cat}" for cat in OLFACTIVE_CATEGORIES),
+}
+MATERIALS_PAGE_MAX = 500
+_MATERIAL_SEARCH_TEXT = " || ' ' || ".join(f"COALESCE({c}, '')" for c in (
+    'm.name', 'm.name_ar', 'm.cas_number', 'm.synonyms', 'm.odor_description', 'f.name', 's.name', 'm.profile'))
+_MATERIAL_JOINS = (  # (join, fields that read it); the text search reads both
+    ('LEFT JOIN families f ON m.family_id = f.id', ('family_name', 'family_icon')),
+    ('LEFT JOIN suppliers s ON m.supplier_id = s.id', ('supplier_name',)),
+)
+
+def _materials_from(fields=None, q=False):
+    """FROM materials m and the joins `fields` (None: every field) or a text
+    search need — no lookup per row into a table nothing reads."""
+    joins = [join for join, reads in _MATERIAL_JOINS if q or fields is None or set(fields) & set(reads)]
+    return '\n    '.join(['FROM materials m'] + joins)
+
+def _materials_where(args, skip=None):
+    """WHERE clauses and params for the filters in `args`, leaving out the
+    `skip` facet (its own counts are taken with it unset)."""
+    where, params = [], []
+    for facet, expr in MATERIAL_FACETS.items():
+        values = [v for v in args.get(facet, '').split(',') if v]
+        if values and facet != skip:
+            where.append(f"{expr} IN ({','.join('?' * len(values))})")
+            params += values
+    q = args.get('q', '').strip()
+    if q:
+        where.append(f"({_MATERIAL_SEARCH_TEXT}) LIKE ? ESCAPE '\\'")
+        params.append('%' + re.sub(r'([%_\\])', r'\\\1', q) + '%')
+    for arg, op in (('ppg_min', '>='), ('ppg_max', '<=')):
+        if args.get(arg, '') != '':
+            where.append(f"COALESCE(m.price_per_gram, 0) {op} ?")
+            params.append(float(args[arg]))
+    return where, params
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _decode_cursor(cursor, length):
+    """The list _encode_cursor packed: `length` items, the last a row id.
+    Raises ValueError on anything else, tampered or truncated cursors included."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError('Invalid cursor')
+    if (not isinstance(values, list) or len(values) != length
+            or type(values[-1]) is not int
+            or not all(v is None or isinstance(v, (str, int, float)) for v in values)):
+        raise ValueError('Invalid cursor')
+    return values
+
+def _material_select(conn, fields):
+    """SELECT list for a `fields=` value (everything when empty) and whether
+    it joins the olfactive scores. Raises ValueError on an unknown field."""
+    columns = [r['name'] for r in conn.execute("PRAGMA table_info(materials)")]
+    fields = [f for f in fields.split(',') if f]
+    for name in fields:
+        if name not in columns and name not in MATERIAL_EXTRA_FIELDS:
+            raise ValueError(f'Unknown field: {name}')
+    if fields:
+        select = ['m.id'] + [f"m.{name}" for name in fields if name in columns and name != 'id']
+        select += [MATERIAL_EXTRA_FIELDS[name] for name in fields if name in MATERIAL_EXTRA_FIELDS]
+    else:
+        select = ['m.*'] + list(MATERIAL_EXTRA_FIELDS.values())
+    return select, not fields or 'olfactive' in fields
+
+def _material_item(item, olfactive):
+    """Fold the olf_* columns of a catalogue row (a dict) into `olfactive`."""
+    if olfactive:
+        olf_id = item.pop('olf_id')
+        sums = {cat: item.pop(f'olf_{cat}') for cat in OLFACTIVE_CATEGORIES}
+        item['olfactive'] = {cat: v or 0 for cat, v in sums.items()} if olf_id is not None else None
+    return item
+
+def query_materials(conn, args):
+    """The catalogue page `args` asks for (see above). Raises ValueError on
+    an unknown sort / field or a cursor from another sort."""
+    sort = args.get('sort', 'name')
+    descending = args.get('dir', 'asc') == 'desc'
+    if sort not in MATERIAL_SORTS:
+        raise ValueError(f'Unknown sort: {sort}')
+    select, olfactive = _material_select(conn, args.get('fields', ''))
+    searching = bool(args.get('q', '').strip())
+    from_ = _materials_from([f for f in args.get('fields', '').split(',') if f] or None, searching)
+
+    where, params = _materials_where(args)
+    order = MATERIAL_SORTS[sort]
+    direction = 'DESC' if descending else 'ASC'
+    page_where, page_params = list(where), list(params)
+    cursor = args.get('cursor')
+    if cursor:
+        cursor_sort, cursor_direction, value, last_id = _decode_cursor(cursor, 4)
+        if (cursor_sort, cursor_direction) != (sort, direction):
+            raise ValueError('Cursor belongs to another sort order')
+        op = '<' if descending else '>'
+        # The single-column bound is what lets SQLite seek into the index
+        page_where.append(f"{order} {op}= ? AND ({order}, m.id) {op} (?, ?)")
+        page_params += [value, value, last_id]
+    limit = args.get('limit', type=int)
+    sql = f'''SELECT {', '.join(select)}, {order} AS sort_key {from_}
+        {'LEFT JOIN material_olfactive o ON o.material_id = m.id' if olfactive else ''}
+        {'WHERE ' + ' AND '.join(page_where) if page_where else ''}
+        ORDER BY {order} {direction}, m.id {direction}'''
+    if limit:
+        limit = max(1, min(limit, MATERIALS_PAGE_MAX))
+        sql += f" LIMIT {limit + 1}"  # one more: is there a next page?
+    rows = conn.execute(sql, page_params).fetchall()
+    more = bool(limit) and len(rows) > limit
+    rows = rows[:limit] if limit else rows
+
+    data = []
+    for row in rows:
+        item = dict(row)
+        sort_key = item.pop('sort_key')
+        data.append(_material_item(item, olfactive))
+    result = {'success': True, 'data': data}
+    if limit:
+        result['next_cursor'] = _encode_cursor([sort, direction, sort_key, rows[-1]['id']]) if more else None
+        result['total'] = conn.execute(
+            f"SELECT COUNT(*) {_materials_from([], searching)} {'WHERE ' + ' AND '.join(where) if where else ''}", params).fetchone()[0]
+    if args.get('facets') in ('1', 'true'):
+        result['facets'] = material_facets(conn, args)
+    return result
+
+def material_facets(conn, args):
+    """{facet: {value: count}} — each facet counted under every filter but its own."""
+    facets = {}
+    from_ = _materials_from([], bool(args.get('q', '').strip()))
+    for facet, expr in MATERIAL_FACETS.items():
+        where, params = _materials_where(args, skip=facet)
+        rows = conn.execute(f'''SELECT {expr} AS value, COUNT(*) AS n {from_}
+            {'WHERE ' + ' AND '.join(where) if where else ''} GROUP BY 1''', params).fetchall()
+        facets[facet] = {str(r['value']): r['n'] for r in rows if r['value'] is not None}
+    # The overview wheel: average score and materials scoring, per axis, over the whole catalogue
+    olf = conn.execute(f'''SELECT COUNT(*) AS n, {', '.join(f"SUM(COALESCE(o.{c}, 0)) AS sum_{c}, SUM(o.{c} > 0) AS n_{c}" for c in OLFACTIVE_CATEGORIES)}
+        FROM material_olfactive o JOIN materials m ON m.id = o.material_id''').fetchone()
+    facets['olfactive'] = {'materials': olf['n'],
+                           'sum': {c: olf[f'sum_{c}'] or 0 for c in OLFACTIVE_CATEGORIES},
+                           'scoring': {c: olf[f'n_{c}'] or 0 for c in OLFACTIVE_CATEGORIES}}
+    return facets
+
+# ===== Materials search =====
+# GET /api/materials/search?q=&limit=&offset= — ranked full-text search
+# (materials_fts). Every word matches as a prefix ("lim" finds limonene,
+# "ورد" finds الورد / وردة); a CAS number matches only that CAS exactly.
+# Ranked results page by offset: a rank has no stable key to seek to.
+SEARCH_PAGE_MAX = 100
+SEARCH_WEIGHTS = (10.0, 8.0, 4.0, 10.0, 1.0)  # bm25, per SEARCH_COLUMNS
+CAS_RE = re.compile(r'^\s*(\d{2,7})-(\d{2})-(\d)\s*$')
+
+def search_match_expr(q):
+    """FTS5 MATCH expression for a search box query, or None if it has no words."""
+    cas = CAS_RE.match(q or '')
+    if cas:
+        return 'cas_number : "%s"' % ' '.join(cas.groups())
+    words = re.findall(r'\w+', fold_search_text(q))
+    return ' '.join(f'"{w}"*' for w in words) or None
+
+def search_materials(conn, q, limit=20, offset=0):
+    match = search_match_expr(q)
+    if not match:
+        return {'success': True, 'data': [], 'total': 0}
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+    rows = conn.execute(f'''
+        SELECT m.id, m.name, m.name_ar, m.cas_number, m.profile, m.family_id,
+               f.name AS family_name, f.icon AS family_icon
+        FROM materials_fts
+        JOIN materials m ON m.id = materials_fts.rowid
+        LEFT JOIN families f ON m.family_id = f.id
+        WHERE materials_fts MATCH ?
+        ORDER BY bm25(materials_fts, {', '.join(map(str, SEARCH_WEIGHTS))}), m.id
+        LIMIT ? OFFSET ?''', (match, limit, offset)).fetchall()
+    total = conn.execute("SELECT COUNT(*) FROM materials_fts WHERE materials_fts MATCH ?", (match,)).fetchone()[0]
+    return {'success': True, 'data': [dict(r) for r in rows], 'total': total}
+
+@app.route('/api/materials/search')
+@login_required
+def api_materials_search():
+    conn = get_db()
+    try:
+        result = search_materials(conn, request.args.get('q', ''),
+                                  request.args.get('limit', 20, type=int), max(0, request.args.get('offset', 0, type=int)))
+    except sqlite3.OperationalError as e:
+        log(f"[SEARCH] {request.args.get('q', '')!r}: {e}")
+        result = {'success': False, 'message': 'تعذر تنفيذ البحث'}
+    conn.close()
+    return jsonify(result)
+
+# ===== Materials delta sync =====
+# GET /api/materials/changes?since=&epoch=&fields= — what a client holding a
+# copy of the catalogue needs to catch up after change `since` (the
+# `version` of its last answer): the current rows, shaped as action=list
+# with the same `fields=`, of the materials changed since, and the ids of
+# those deleted. `epoch` is the one that answer carried; from another epoch
+# (a restored backup) or with since=0 the answer is the whole catalogue and
+# reset=true: drop the copy first.
+def material_changes(conn, since=0, epoch=None, fields=''):
+    select, olfactive = _material_select(conn, fields)
+    current = conn.execute("SELECT epoch FROM material_changes_epoch").fetchone()['epoch']
+    reset = not since or epoch != current
+    if reset:
+        since = 0
+    # Read first: a write landing meanwhile is sent now and again next time
+    version = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM material_changes").fetchone()[0]
+    rows = conn.execute(f'''SELECT c.material_id AS changed_id, {', '.join(select)}
+        FROM (SELECT DISTINCT material_id FROM material_changes WHERE seq > ?) c
+        LEFT JOIN materials m ON m.id = c.material_id
+        LEFT JOIN families f ON m.family_id = f.id
+        LEFT JOIN suppliers s ON m.supplier_id = s.id
+        {'LEFT JOIN material_olfactive o ON o.material_id = m.id' if olfactive else ''}
+        ORDER BY COALESCE(m.name, ''), c.material_id''', (since,)).fetchall()
+    data, deleted = [], []
+    for row in rows:
+        item = dict(row)
+        changed_id = item.pop('changed_id')
+        if item['id'] is None:
+            if not reset:
+                deleted.append(changed_id)
+        else:
+            data.append(_material_item(item, olfactive))
+    return {'success': True, 'epoch': current, 'version': version, 'reset': reset,
+            'data': data, 'deleted': deleted}
+
+@app.route('/api/materials/changes')
+@login_required
+def api_materials_changes():
+    conn = get_db()
+    try:
+        result = material_changes(conn, max(0, request.args.get('since', 0, type=int)),
+                                  request.args.get('epoch'), request.args.get('fields', ''))
+    except ValueError as e:
+        conn.close()
+        return jsonify({'success': False, 'message': str(e)}), 400
+    conn.close()
+    return jsonify(result)
+
+# ===== Material typeahead =====
+# The material pickers ask GET /api/materials/typeahead?q= instead of having
+# the whole catalogue rendered into the page. Answers come from an in-memory
+# sorted list of (key, id): each word start of the name and Arabic name, each
+# synonym and the CAS, folded like the full-text search plus Latin case and
+# accents. A prefix is a bisect and a short scan. Material writes refresh the
+# rows they touched; a restore or an import drops the index, and it is
+# rebuilt on next use (also when the pool moves to another database file).
+TYPEAHEAD_LIMIT = 20
+TYPEAHEAD_SCAN = 2000  # index entries looked at for one prefix, at most
+_typeahead_keys = []   # sorted [(key, material id)]
+_typeahead_items = {}  # material id -> ({'id', 'name', 'name_ar', 'cas_number'}, its keys, folded name)
+_typeahead_lock = threading.Lock()
+_typeahead_source = None  # (DB_PATH, pool generation) the index was built from
+
+_LATIN_ACCENTS = re.compile('[\u0300-\u036f]')
+_WORD = re.compile(r'\w+')
+
+def typeahead_fold(text):
+    text = fold_search_text(text).casefold()
+    if not text.isascii():
+        text = _LATIN_ACCENTS.sub('', unicodedata.normalize('NFKD', text))
+    return ' '.join(_WORD.findall(text))
+
+def _typeahead_entry(row):
+    item = {'id': row['id'], 'name': row['name'], 'name_ar': row['name_ar'], 'cas_number': row['cas_number']}
+    name = typeahead_fold(row['name'])
+    keys = set()
+    for folded in (name, typeahead_fold(row['name_ar'])):
+        words = folded.split()
+        keys.update(' '.join(words[i:]) for i in range(len(words)))
+    for text in re.split(r'[;\n]', row['synonyms'] or '') + [row['cas_number']]:
+        keys.add(typeahead_fold(text))
+    keys.discard('')
+    return item, sorted(keys), name
+
+def _typeahead_add(row):
+    item, keys, name = _typeahead_entry(row)
+    _typeahead_items[item['id']] = (item, keys, name)
+    for key in keys:
+        bisect.insort(_typeahead_keys, (key, item['id']))
+
+def _typeahead_remove(material_id):
+    _, keys, _ = _typeahead_items.pop(material_id, (None, (), None))
+    for key in keys:
+        i = bisect.bisect_left(_typeahead_keys, (key, material_id))
+        if i < len(_typeahead_keys) and _typeahead_keys[i] == (key, material_id):
+            del _typeahead_keys[i]
+
+_TYPEAHEAD_SQL = "SELECT id, name, name_ar, cas_number, synonyms FROM materials"
+
+def _typeahead_ready():
+    """Build the index if it is missing or belongs to another database.
+    Caller holds _typeahead_lock."""
+    global _typeahead_keys, _typeahead_source
+    source = (DB_PATH, _db_pool_generation)
+    if _typeahead_source == source:
+        return
+    conn = get_db(readonly=True)
+    try:
+        _typeahead_items.clear()
+        keys = []
+        for row in conn.execute(_TYPEAHEAD_SQL):
+            item, item_keys, name = _typeahead_entry(row)
+            _typeahead_items[item['id']] = (item, item_keys, name)
+            keys.extend((key, item['id']) for key in item_keys)
+        keys.sort()
+        _typeahead_keys = keys
+    finally:
+        conn.close()
+    _typeahead_source = source
+
+def refresh_material_typeahead(conn, material_ids=None):
+    """Re-read material_ids (saved or deleted) into the index; None drops it."""
+    global _typeahead_source
+    with _typeahead_lock:
+        if material_ids is None or _typeahead_source != (DB_PATH, _db_pool_generation):
+            _typeahead_source = None
+            return
+        ids = [int(m) for m in material_ids]
+        for mid in ids:
+            _typeahead_remove(mid)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for row in conn.execute(f"{_TYPEAHEAD_SQL} WHERE id IN ({','.join('?' * len(chunk))})", chunk):
+                _typeahead_add(row)
+
+def material_typeahead(q, limit=TYPEAHEAD_LIMIT):
+    """Materials with a key starting with q: those whose name starts with it
+    first, then by name."""
+    prefix = typeahead_fold(q)
+    if not prefix:
+        return []
+    with _typeahead_lock:
+        _typeahead_ready()
+        found = {}
+        start = bisect.bisect_left(_typeahead_keys, (prefix,))
+        for key, mid in _typeahead_keys[start:start + TYPEAHEAD_SCAN]:
+            if not key.startswith(prefix):
+                break
+            item, _, name = _typeahead_items[mid]
+            found[mid] = (not name.startswith(prefix), name, mid, item)
+    return [entry[-1] for entry in sorted(found.values())[:limit]]
+
+@app.route('/api/materials/typeahead')
+@login_required
+def api_materials_typeahead():
+    limit = max(1, min(request.args.get('limit', TYPEAHEAD_LIMIT, type=int), SEARCH_PAGE_MAX))
+    return jsonify({'success': True, 'data': material_typeahead(request.args.get('q', ''), limit)})
+
 @app.route('/api/materials', methods=['GET', 'POST'])
 @login_required
+@conditional_get('materials', 'families', 'suppliers', 'material_olfactive', 'material_msds',
+                 'material_composition', 'material_composition_closure',
+                 'ifra_standards', 'ifra_cas_lookup', 'ifra_contributions', ifra_indices=True)
 def api_materials():
     conn = get_db()
     
     if request.method == 'GET':
         action = request.args.get('action', 'list')
         if action == 'list':
-            data = conn.execute('''
-                SELECT m.*, f.name as family_name, f.icon as family_icon, s.name as supplier_name
-                FROM materials m
-                LEFT JOIN families f ON m.family_id = f.id
-                LEFT JOIN suppliers s ON m.supplier_id = s.id
-                ORDER BY m.name
-            ''').fetchall()
-            # جلب البروفايل العطري لكل مادة
-            olfactive_data = conn.execute("SELECT * FROM material_olfactive").fetchall()
-            olf_map = {row['material_id']: {cat: row[cat] or 0 for cat in OLFACTIVE_CATEGORIES} for row in olfactive_data}
-            # عدد مكوّنات كل خلطة (لإظهار شارة "خليط")
-            comp_counts = {r['parent_material_id']: r['n'] for r in conn.execute(
-                "SELECT parent_material_id, COUNT(*) as n FROM material_composition GROUP BY parent_material_id"
-            ).fetchall()}
-            result = []
-            for d in data:
-                item = dict(d)
-                item['olfactive'] = olf_map.get(item['id'], None)
-                item['composition_count'] = comp_counts.get(item['id'], 0)
-                result.append(item)
+            try:
+                result = query_materials(conn, request.args)
+            except (ValueError, TypeError) as e:
+                conn.close()
+                return jsonify({'success': False, 'message': str(e)}), 400
             conn.close()
-            return jsonify({'success': True, 'data': result})
+            return jsonify(result)
         elif action == 'get':
             mid = request.args.get('id')
             data = conn.execute("SELECT * FROM materials WHERE id=?", (mid,)).fetchone()
@@ -2256,11 +5285,7 @@ def api_materials():
                     result['olfactive'] = {cat: 0 for cat in OLFACTIVE_CATEGORIES}
                 # IFRA standard data
                 if result.get('cas_number'):
-                    ifra_row = conn.execute('''
-                        SELECT s.* FROM ifra_standards s
-                        JOIN ifra_cas_lookup l ON l.ifra_standard_id = s.id
-                        WHERE l.cas_number = ?
-                    ''', (result['cas_number'],)).fetchone()
+                    ifra_row = ifra_standard_for_cas(result['cas_number'])
                     if ifra_row:
                         result['ifra_standard'] = dict(ifra_row)
                 # Composition-derived per-category IFRA limits (only if mixture)
@@ -2297,79 +5322,89 @@ def api_materials():
                             pass
                 manual_cats_json = json.dumps(manual_cats) if manual_cats else None
 
-                if id and id != '':
-                    conn.execute('''UPDATE materials SET name=?, name_ar=?, cas_number=?, family_id=?,
-                        profile=?, supplier_id=?, ifra_limit=?, manual_ifra_cats=?, purchase_price=?, purchase_quantity=?,
-                        price_per_gram=?, odor_description=?, notes=?, flash_point=?, specific_gravity=?,
-                        color=?, physical_state=?, ph=?, melting_point=?, boiling_point=?,
-                        solubility=?, vapor_density=?, appearance=?, refractive_index=?,
-                        synonyms=?, lot=?, strength_odor=?, vapor_pressure=?,
-                        effect=?, recommended_smell_pct=?, properties=?, in_stock=? WHERE id=?''',
-                        (name, request.form.get('name_ar'), request.form.get('cas_number'),
-                         request.form.get('family_id') or None, request.form.get('profile', 'Heart'),
-                         request.form.get('supplier_id') or None, request.form.get('ifra_limit') or None,
-                         manual_cats_json,
-                         price, qty, ppg, request.form.get('odor_description'), request.form.get('notes'),
-                         request.form.get('flash_point'), request.form.get('specific_gravity'),
-                         request.form.get('color'), request.form.get('physical_state'),
-                         request.form.get('ph'), request.form.get('melting_point'),
-                         request.form.get('boiling_point'), request.form.get('solubility'),
-                         request.form.get('vapor_density'), request.form.get('appearance'),
-                         request.form.get('refractive_index'),
-                         request.form.get('synonyms'), request.form.get('lot'),
-                         request.form.get('strength_odor'), request.form.get('vapor_pressure'),
-                         request.form.get('effect'), request.form.get('recommended_smell_pct'),
-                         request.form.get('properties'),
-                         float(request.form.get('in_stock') or 0), id))
-                    mat_id = id
-                    msg = 'تم التحديث'
-                else:
-                    cur = conn.execute('''INSERT INTO materials (name, name_ar, cas_number, family_id, profile,
-                        supplier_id, ifra_limit, manual_ifra_cats, purchase_price, purchase_quantity, price_per_gram,
-                        odor_description, notes, flash_point, specific_gravity, color, physical_state,
-                        ph, melting_point, boiling_point, solubility, vapor_density, appearance, refractive_index,
-                        synonyms, lot, strength_odor, vapor_pressure, effect, recommended_smell_pct, properties, in_stock)
-                        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
-                        (name, request.form.get('name_ar'), request.form.get('cas_number'),
-                         request.form.get('family_id') or None, request.form.get('profile', 'Heart'),
-                         request.form.get('supplier_id') or None, request.form.get('ifra_limit') or None,
-                         manual_cats_json,
-                         price, qty, ppg, request.form.get('odor_description'), request.form.get('notes'),
-                         request.form.get('flash_point'), request.form.get('specific_gravity'),
-                         request.form.get('color'), request.form.get('physical_state'),
-                         request.form.get('ph'), request.form.get('melting_point'),
-                         request.form.get('boiling_point'), request.form.get('solubility'),
-                         request.form.get('vapor_density'), request.form.get('appearance'),
-                         request.form.get('refractive_index'),
-                         request.form.get('synonyms'), request.form.get('lot'),
-                         request.form.get('strength_odor'), request.form.get('vapor_pressure'),
-                         request.form.get('effect'), request.form.get('recommended_smell_pct'),
-                         request.form.get('properties'),
-                         float(request.form.get('in_stock') or 0)))
-                    mat_id = cur.lastrowid
-                    msg = f'تم الإضافة (ID: {mat_id})'
+                form = request.form  # read here: the job runs on the writer thread
+
+                def write(w):
+                    if id and id != '':
+                        w.execute('''UPDATE materials SET name=?, name_ar=?, cas_number=?, family_id=?,
+                            profile=?, supplier_id=?, ifra_limit=?, manual_ifra_cats=?, purchase_price=?, purchase_quantity=?,
+                            price_per_gram=?, odor_description=?, notes=?, flash_point=?, specific_gravity=?,
+                            color=?, physical_state=?, ph=?, melting_point=?, boiling_point=?,
+                            solubility=?, vapor_density=?, appearance=?, refractive_index=?,
+                            synonyms=?, lot=?, strength_odor=?, vapor_pressure=?,
+                            effect=?, recommended_smell_pct=?, properties=?, in_stock=? WHERE id=?''',
+                            (name, form.get('name_ar'), form.get('cas_number'),
+                             form.get('family_id') or None, form.get('profile', 'Heart'),
+                             form.get('supplier_id') or None, form.get('ifra_limit') or None,
+                             manual_cats_json,
+                             price, qty, ppg, form.get('odor_description'), form.get('notes'),
+                             form.get('flash_point'), form.get('specific_gravity'),
+                             form.get('color'), form.get('physical_state'),
+                             form.get('ph'), form.get('melting_point'),
+                             form.get('boiling_point'), form.get('solubility'),
+                             form.get('vapor_density'), form.get('appearance'),
+                             form.get('refractive_index'),
+                             form.get('synonyms'), form.get('lot'),
+                             form.get('strength_odor'), form.get('vapor_pressure'),
+                             form.get('effect'), form.get('recommended_smell_pct'),
+                             form.get('properties'),
+                             float(form.get('in_stock') or 0), id))
+                        mat_id = id
+                        msg = 'تم التحديث'
+                        # Name / CAS / IFRA fields feed the limits of every mixture containing it
+                        stale = composition_ancestors(w, [mat_id])
+                    else:
+                        cur = w.execute('''INSERT INTO materials (name, name_ar, cas_number, family_id, profile,
+                            supplier_id, ifra_limit, manual_ifra_cats, purchase_price, purchase_quantity, price_per_gram,
+                            odor_description, notes, flash_point, specific_gravity, color, physical_state,
+                            ph, melting_point, boiling_point, solubility, vapor_density, appearance, refractive_index,
+                            synonyms, lot, strength_odor, vapor_pressure, effect, recommended_smell_pct, properties, in_stock)
+                            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+                            (name, form.get('name_ar'), form.get('cas_number'),
+                             form.get('family_id') or None, form.get('profile', 'Heart'),
+                             form.get('supplier_id') or None, form.get('ifra_limit') or None,
+                             manual_cats_json,
+                             price, qty, ppg, form.get('odor_description'), form.get('notes'),
+                             form.get('flash_point'), form.get('specific_gravity'),
+                             form.get('color'), form.get('physical_state'),
+                             form.get('ph'), form.get('melting_point'),
+                             form.get('boiling_point'), form.get('solubility'),
+                             form.get('vapor_density'), form.get('appearance'),
+                             form.get('refractive_index'),
+                             form.get('synonyms'), form.get('lot'),
+                             form.get('strength_odor'), form.get('vapor_pressure'),
+                             form.get('effect'), form.get('recommended_smell_pct'),
+                             form.get('properties'),
+                             float(form.get('in_stock') or 0)))
+                        mat_id = cur.lastrowid
+                        msg = f'تم الإضافة (ID: {mat_id})'
+                        stale = set()
                 
-                # حفظ بيانات MSDS
-                h_codes = request.form.get('h_codes', '')
-                p_codes = request.form.get('p_codes', '')
-                pictograms = request.form.get('pictograms', '')
-                signal_word = request.form.get('signal_word', '')
-                ghs_classification = request.form.get('ghs_classification', '')
+                    # حفظ بيانات MSDS
+                    h_codes = form.get('h_codes', '')
+                    p_codes = form.get('p_codes', '')
+                    pictograms = form.get('pictograms', '')
+                    signal_word = form.get('signal_word', '')
+                    ghs_classification = form.get('ghs_classification', '')
                 
-                conn.execute("""INSERT OR REPLACE INTO material_msds
-                    (material_id, h_codes, p_codes, pictograms, signal_word, ghs_classification)
-                    VALUES (?,?,?,?,?,?)""",
-                    (mat_id, h_codes, p_codes, pictograms, signal_word, ghs_classification))
+                    w.execute("""INSERT OR REPLACE INTO material_msds
+                        (material_id, h_codes, p_codes, pictograms, signal_word, ghs_classification)
+                        VALUES (?,?,?,?,?,?)""",
+                        (mat_id, h_codes, p_codes, pictograms, signal_word, ghs_classification))
 
-                # حفظ البروفايل العطري
-                olf_values = {cat: int(request.form.get(f'olf_{cat}', 0) or 0) for cat in OLFACTIVE_CATEGORIES}
-                conn.execute("""INSERT OR REPLACE INTO material_olfactive
-                    (material_id, citrus, aldehydic, aromatic, green, marine, floral, fruity,
-                     spicy, balsamic, woody, ambery, musky, leathery, animal)
-                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                    (mat_id, *[olf_values[cat] for cat in OLFACTIVE_CATEGORIES]))
+                    # حفظ البروفايل العطري
+                    olf_values = {cat: int(form.get(f'olf_{cat}', 0) or 0) for cat in OLFACTIVE_CATEGORIES}
+                    w.execute("""INSERT OR REPLACE INTO material_olfactive
+                        (material_id, citrus, aldehydic, aromatic, green, marine, floral, fruity,
+                         spicy, balsamic, woody, ambery, musky, leathery, animal)
+                        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+                        (mat_id, *[olf_values[cat] for cat in OLFACTIVE_CATEGORIES]))
+                    return mat_id, msg, stale
 
-                conn.commit()
+                mat_id, msg, stale = db_write(write)
+                # Only now: a read between an earlier drop and the commit re-caches old limits
+                invalidate_mixture_limits(stale)
+                refresh_material_typeahead(conn, [mat_id])
                 conn.close()
                 return jsonify({'success': True, 'message': msg, 'id': mat_id})
             except Exception as e:
@@ -2383,12 +5418,18 @@ def api_materials():
             if used > 0:
                 conn.close()
                 return jsonify({'success': False, 'message': f'مستخدمة في {used} تركيبة'})
-            conn.execute("DELETE FROM material_msds WHERE material_id=?", (id,))
-            conn.execute("DELETE FROM material_olfactive WHERE material_id=?", (id,))
-            conn.execute("DELETE FROM material_files WHERE material_id=?", (id,))
-            conn.execute("DELETE FROM material_composition WHERE parent_material_id=? OR component_material_id=?", (id, id))
-            conn.execute("DELETE FROM materials WHERE id=?", (id,))
-            conn.commit()
+
+            def write(w):
+                w.execute("DELETE FROM material_msds WHERE material_id=?", (id,))
+                w.execute("DELETE FROM material_olfactive WHERE material_id=?", (id,))
+                w.execute("DELETE FROM material_files WHERE material_id=?", (id,))
+                w.execute("DELETE FROM material_composition WHERE parent_material_id=? OR component_material_id=?", (id, id))
+                stale = rebuild_composition_closure(w, [id])
+                w.execute("DELETE FROM materials WHERE id=?", (id,))
+                return stale
+
+            invalidate_mixture_limits(db_write(write))
+            refresh_material_typeahead(conn, [id])
             conn.close()
             return jsonify({'success': True, 'message': 'تم الحذف'})
 
@@ -2404,12 +5445,18 @@ def api_materials():
             skipped = total - len(unused_ids)
             if unused_ids:
                 placeholders = ','.join('?' * len(unused_ids))
-                conn.execute(f"DELETE FROM material_msds WHERE material_id IN ({placeholders})", unused_ids)
-                conn.execute(f"DELETE FROM material_olfactive WHERE material_id IN ({placeholders})", unused_ids)
-                conn.execute(f"DELETE FROM material_files WHERE material_id IN ({placeholders})", unused_ids)
-                conn.execute(f"DELETE FROM material_composition WHERE parent_material_id IN ({placeholders}) OR component_material_id IN ({placeholders})", unused_ids + unused_ids)
-                conn.execute(f"DELETE FROM materials WHERE id IN ({placeholders})", unused_ids)
-                conn.commit()
+
+                def write(w):
+                    w.execute(f"DELETE FROM material_msds WHERE material_id IN ({placeholders})", unused_ids)
+                    w.execute(f"DELETE FROM material_olfactive WHERE material_id IN ({placeholders})", unused_ids)
+                    w.execute(f"DELETE FROM material_files WHERE material_id IN ({placeholders})", unused_ids)
+                    w.execute(f"DELETE FROM material_composition WHERE parent_material_id IN ({placeholders}) OR component_material_id IN ({placeholders})", unused_ids + unused_ids)
+                    stale = rebuild_composition_closure(w, unused_ids)
+                    w.execute(f"DELETE FROM materials WHERE id IN ({placeholders})", unused_ids)
+                    return stale
+
+                invalidate_mixture_limits(db_write(write))
+                refresh_material_typeahead(conn, unused_ids)
             conn.close()
             msg = f'تم حذف {len(unused_ids)} مادة'
             if skipped:
@@ -2442,26 +5489,27 @@ def api_material_files(mid):
         if not uploaded:
             conn.close()
             return jsonify({'success': False, 'message': 'لم يتم اختيار أي ملف'})
-        saved = 0
+        rows = []
         for f in uploaded:
             if not f or not f.filename:
                 continue
-            content = f.read()
-            if not content:
+            # Streamed to the store chunk by chunk, never held in memory whole
+            sha256, size = store_file(iter(lambda: f.stream.read(FILE_CHUNK), b''))
+            if not size:
                 continue
-            conn.execute('''
-                INSERT INTO material_files (material_id, filename, mime_type, size, content)
+            rows.append((mid, f.filename, (f.mimetype or 'application/octet-stream'), size, sha256))
+        if rows:
+            db_write(lambda w: w.executemany('''
+                INSERT INTO material_files (material_id, filename, mime_type, size, sha256)
                 VALUES (?,?,?,?,?)
-            ''', (mid, f.filename, (f.mimetype or 'application/octet-stream'), len(content), content))
-            saved += 1
-        conn.commit()
+            ''', rows))
         conn.close()
-        return jsonify({'success': True, 'message': f'تم رفع {saved} ملف', 'count': saved})
+        return jsonify({'success': True, 'message': f'تم رفع {len(rows)} ملف', 'count': len(rows)})
 
     if action == 'delete':
         fid = request.form.get('id')
-        conn.execute("DELETE FROM material_files WHERE id=? AND material_id=?", (fid, mid))
-        conn.commit()
+        # The stored blob stays until prune_file_store(): backups may use it
+        db_write(lambda w: w.execute("DELETE FROM material_files WHERE id=? AND material_id=?", (fid, mid)))
         conn.close()
         return jsonify({'success': True, 'message': 'تم الحذف'})
 
@@ -2474,11 +5522,11 @@ def api_material_file_serve(mid, fid):
     """يرجع محتوى الملف للعرض / التنزيل."""
     conn = get_db()
     row = conn.execute('''
-        SELECT filename, mime_type, content FROM material_files
+        SELECT filename, mime_type, sha256 FROM material_files
         WHERE id=? AND material_id=?
     ''', (fid, mid)).fetchone()
     conn.close()
-    if not row:
+    if not row or not row['sha256'] or not os.path.exists(file_store_path(row['sha256'])):
         return 'Not found', 404
     inline = request.args.get('inline') == '1'
     mime = row['mime_type'] or 'application/octet-stream'
@@ -2487,210 +5535,72 @@ def api_material_file_serve(mid, fid):
     import urllib.parse
     safe_name = (row['filename'] or 'file').encode('ascii', 'ignore').decode('ascii') or 'file'
     utf8_name = urllib.parse.quote(row['filename'] or 'file')
-    resp = Response(row['content'], mimetype=mime)
+    # Streamed from disk; conditional=True answers Range (206) and
+    # If-None-Match / If-Range against the content hash
+    resp = send_file(file_store_path(row['sha256']), mimetype=mime, conditional=True, etag=row['sha256'])
     resp.headers['Content-Disposition'] = f'{disp}; filename="{safe_name}"; filename*=UTF-8\'\'{utf8_name}'
     return resp
 
 # ===== تركيب المواد (الخلطات / الميكسجر) =====
-def _expand_mixture_components(conn, mat_id, accumulated_pct, depth=0, max_depth=5, visited=None):
-    """Walk the composition tree of a mixture material, yielding each
-    direct/indirect component along with its effective percentage of the
-    *outer* context (caller-supplied accumulated_pct is in the same unit as
-    the value yielded — pass weight_pct_in_formula as a percentage like 5.0).
-
-    Stops at max_depth (default 5) and at cycles (visited tracking)."""
-    if depth >= max_depth or accumulated_pct <= 0:
-        return
-    if visited is None:
-        visited = set()
-    if mat_id in visited:
-        return
-    visited = visited | {mat_id}
-    rows = conn.execute('''
-        SELECT mc.component_material_id, mc.pct, m.cas_number, m.name
-        FROM material_composition mc
-        JOIN materials m ON mc.component_material_id = m.id
-        WHERE mc.parent_material_id = ?
-    ''', (mat_id,)).fetchall()
-    for r in rows:
-        pct_in_parent = r['pct'] or 0
-        if pct_in_parent <= 0:
-            continue
-        effective = accumulated_pct * pct_in_parent / 100.0
-        yield {
-            'mat_id': r['component_material_id'],
-            'cas': r['cas_number'] or '',
-            'name': r['name'] or '',
-            'effective_pct': effective,
-            'pct_in_parent': pct_in_parent,
-        }
-        for sub in _expand_mixture_components(conn, r['component_material_id'], effective, depth + 1, max_depth, visited):
-            yield sub
-
-
-def _effective_ppg(conn, mat_id, own_ppg, depth=0, max_depth=5, visited=None):
-    """Compute the effective price-per-gram for a mixture material.
-    Returns own_ppg if it's > 0; otherwise weighted-average of component ppg
-    from material_composition (recursive). Unspecified remainder is ignored
-    (treated as zero-cost carrier)."""
-    if own_ppg and own_ppg > 0:
-        return own_ppg
-    if depth >= max_depth:
-        return 0
-    if visited is None:
-        visited = set()
-    if mat_id in visited:
-        return 0
-    visited = visited | {mat_id}
-    rows = conn.execute('''
-        SELECT mc.pct, m.id, m.price_per_gram
-        FROM material_composition mc
-        JOIN materials m ON mc.component_material_id = m.id
-        WHERE mc.parent_material_id = ?
-    ''', (mat_id,)).fetchall()
-    weighted = 0.0
-    for r in rows:
-        p = r['pct'] or 0
-        if p <= 0:
-            continue
-        c_ppg = _effective_ppg(conn, r['id'], r['price_per_gram'] or 0, depth + 1, max_depth, visited)
-        weighted += c_ppg * p / 100.0
-    return weighted
-
-
-def _resolve_material_ifra_for_cat(conn, mat_id, cat_key, depth=0, max_depth=5, visited=None):
-    """Return the IFRA limit (% in formula) for a material in a given category,
-    using the same priority chain we use at ingredient time:
-      1. manual_ifra_cats[cat_key]
-      2. blanket ifra_limit
-      3. CAS lookup in ifra_standards
-      4. composition-derived (recursive — for nested mixtures)
-    Returns one of: positive float (limit %), 0 (prohibited), -1 (no restriction),
-    or None (not applicable / unknown)."""
-    if depth >= max_depth:
-        return None
-    if visited is None:
-        visited = set()
-    if mat_id in visited:
-        return None
-    visited = visited | {mat_id}
-
-    row = conn.execute("SELECT cas_number, ifra_limit, manual_ifra_cats FROM materials WHERE id=?", (mat_id,)).fetchone()
-    if not row:
-        return None
-
-    # 1. Per-category manual override
-    raw = row['manual_ifra_cats']
-    if raw:
-        try:
-            manual = json.loads(raw) or {}
-            v = manual.get(cat_key)
-            if v is not None and v != '':
-                vf = float(v)
-                if vf > 0:
-                    return vf
-        except Exception:
-            pass
-
-    # 2. Blanket manual ifra_limit
-    if row['ifra_limit'] and row['ifra_limit'] > 0:
-        return float(row['ifra_limit'])
-
-    # 3. CAS lookup in IFRA standards
-    cas = row['cas_number'] or ''
-    if cas:
-        std = conn.execute('''
-            SELECT s.* FROM ifra_standards s
-            JOIN ifra_cas_lookup l ON l.ifra_standard_id = s.id
-            WHERE l.cas_number = ?
-        ''', (cas,)).fetchone()
-        if std and std[cat_key] is not None:
-            return std[cat_key]  # may be -1, 0, or positive
-
-    # 4. Composition-derived (recurse into the material's own composition)
-    comp_rows = conn.execute('''
-        SELECT mc.component_material_id, mc.pct
-        FROM material_composition mc
-        WHERE mc.parent_material_id = ?
-    ''', (mat_id,)).fetchall()
-    if not comp_rows:
-        return None
-
-    min_derived = None
-    for cr in comp_rows:
-        c_pct = cr['pct'] or 0
-        if c_pct <= 0:
-            continue
-        sub = _resolve_material_ifra_for_cat(conn, cr['component_material_id'], cat_key, depth + 1, max_depth, visited)
-        if sub is None or sub == -1:
-            continue
-        if sub == 0:
-            return 0  # any prohibited component prohibits the whole mixture
-        derived = sub / (c_pct / 100.0)
-        if min_derived is None or derived < min_derived:
-            min_derived = derived
-    # A derived limit > 100% is meaningless (you can never use more than 100%
-    # of a mixture in a formula), so collapse it to IFRA's "No Restriction"
-    # sentinel (-1) for consistent handling downstream.
-    if min_derived is not None and min_derived > 100:
-        return -1
-    return min_derived
+def _closure_rows(children, root, max_depth=5):
+    """Depth-first walk of the composition graph from root, yielding one
+    (descendant, depth, effective_pct, pct_in_parent, path) per path. Same
+    traversal rules as CompositionIndex.expand (skip pct <= 0, stop at cycles
+    and at max_depth)."""
+    def walk(mat_id, accumulated, depth, path):
+        if depth >= max_depth or accumulated <= 0 or mat_id in path:
+            return
+        path = path + (mat_id,)
+        for comp_id, pct in children.get(mat_id, ()):
+            p = pct or 0
+            if p <= 0:
+                continue
+            effective = accumulated * p / 100.0
+            yield comp_id, depth + 1, effective, p, '/'.join(str(x) for x in path + (comp_id,))
+            yield from walk(comp_id, effective, depth + 1, path)
+    yield from walk(root, 100.0, 0, ())
+
+
+def rebuild_composition_closure(conn, material_ids=None):
+    """Refresh material_composition_closure. With material_ids, only those
+    materials and every mixture that contains them (per the current closure)
+    are rebuilt; None rebuilds the whole table. Caller commits, then passes
+    the return value — the materials rebuilt, None for all — to
+    invalidate_mixture_limits(): dropped any earlier, a request still reading
+    the old snapshot would cache its limits again."""
+    children = {}
+    for e in conn.execute("SELECT parent_material_id, component_material_id, pct FROM material_composition ORDER BY id"):
+        children.setdefault(e[0], []).append((e[1], e[2]))
+
+    if material_ids is None:
+        conn.execute("DELETE FROM material_composition_closure")
+        affected = set(children)
+    else:
+        affected = composition_ancestors(conn, material_ids)
+        placeholders = ','.join('?' * len(affected))
+        conn.execute(f"DELETE FROM material_composition_closure WHERE ancestor_id IN ({placeholders})", list(affected))
+
+    rows = []
+    for ancestor in affected:
+        for seq, (desc, depth, eff, pct, path) in enumerate(_closure_rows(children, ancestor)):
+            rows.append((ancestor, desc, depth, eff, pct, path, seq))
+    conn.executemany('''INSERT INTO material_composition_closure
+        (ancestor_id, descendant_id, depth, effective_pct, pct_in_parent, path, seq)
+        VALUES (?,?,?,?,?,?,?)''', rows)
+    return None if material_ids is None else affected
 
 
 def _derive_mixture_ifra_limits(conn, mat_id, max_depth=5):
-    """Compute the per-category derived IFRA limit for a mixture material,
-    based on its composition. Returns {cat_key: {limit, binding_name, binding_cas,
-    prohibited}} for each of the 18 categories. Empty dict if no composition."""
-    comp = conn.execute('''
-        SELECT mc.component_material_id, mc.pct, m.name, m.cas_number
-        FROM material_composition mc
-        JOIN materials m ON mc.component_material_id = m.id
-        WHERE mc.parent_material_id = ?
-    ''', (mat_id,)).fetchall()
-    if not comp:
-        return {}
-
-    derived = {}
-    for cat in IFRA_CATEGORIES:
-        ck = cat['id']
-        binding_limit = None  # mixture's max % in formula for this category
-        binding_name = None
-        binding_cas = None
-        prohibited = False
-        for cr in comp:
-            c_pct = cr['pct'] or 0
-            if c_pct <= 0:
-                continue
-            comp_limit = _resolve_material_ifra_for_cat(conn, cr['component_material_id'], ck, depth=1, max_depth=max_depth)
-            if comp_limit is None or comp_limit == -1:
-                continue
-            if comp_limit == 0:
-                prohibited = True
-                binding_name = cr['name']
-                binding_cas = cr['cas_number'] or ''
-                binding_limit = 0
-                break
-            d = comp_limit / (c_pct / 100.0)
-            if binding_limit is None or d < binding_limit:
-                binding_limit = d
-                binding_name = cr['name']
-                binding_cas = cr['cas_number'] or ''
-        if binding_limit is not None:
-            # A derived limit > 100% in practice means no constraint (you can
-            # never use more than 100% of a mixture in a formula). Encode it
-            # as the No-Restriction sentinel so the UI can render "غير مقيّد".
-            if binding_limit > 100 and not prohibited:
-                limit_out = -1
-            else:
-                limit_out = round(binding_limit, 4) if binding_limit > 0 else 0
-            derived[ck] = {
-                'limit': limit_out,
-                'binding_name': binding_name,
-                'binding_cas': binding_cas,
-                'prohibited': prohibited,
-                'no_restriction': (limit_out == -1),
-            }
-    return derived
+    """Per-category derived IFRA limit for a mixture material, based on its
+    composition. Returns {cat_key: {limit, binding_name, binding_cas,
+    prohibited, no_restriction}}. Empty dict if no composition."""
+    entry = _mixture_limit_cache.get(mat_id)
+    if entry and ('mixture', max_depth) in entry:
+        return entry[('mixture', max_depth)]
+    evaluator = FormulaEvaluator(get_ifra_index(), get_contributions_index(),
+                                 load_composition_index(conn, [mat_id]),
+                                 limit_cache=_mixture_limit_cache)
+    return evaluator.mixture_limits(mat_id, max_depth=max_depth)
 
 
 def _composition_descendants(conn, parent_id, max_depth=5):
@@ -2765,13 +5675,15 @@ def api_material_composition(mid):
                         'message': f'دائرة في التركيب: المكوّن (ID {row["cid"]}) يحتوي هذه المادة بشكل غير مباشر'
                     }), 400
 
-            conn.execute("DELETE FROM material_composition WHERE parent_material_id=?", (mid,))
-            for row in clean:
-                conn.execute('''INSERT INTO material_composition
+            def write(w):
+                w.execute("DELETE FROM material_composition WHERE parent_material_id=?", (mid,))
+                w.executemany('''INSERT INTO material_composition
                     (parent_material_id, component_material_id, pct, note)
                     VALUES (?,?,?,?)''',
-                    (mid, row['cid'], row['pct'], row['note']))
-            conn.commit()
+                    [(mid, row['cid'], row['pct'], row['note']) for row in clean])
+                return rebuild_composition_closure(w, [mid])
+
+            invalidate_mixture_limits(db_write(write))
             conn.close()
             return jsonify({'success': True, 'message': f'تم حفظ التركيب ({len(clean)} مكوّن)'})
         except Exception as e:
@@ -2791,64 +5703,36 @@ def api_auto_classify():
     return jsonify({'success': True, 'scores': scores})
 
 # ===== API التركيبات =====
+FORMULAS_LIST_SQL = f'''
+    SELECT f.*, COALESCE(s.ingredients_count, 0) AS ingredients_count,
+           COALESCE(s.total_weight, 0) AS total_weight, COALESCE(s.total_cost, 0) AS total_cost,
+           COALESCE(s.ingredient_names, '[]') AS ingredient_names, COALESCE(s.pure_weight, 0) AS pure_weight,
+           {', '.join(f's.{cat} AS olf_{cat}' for cat in OLFACTIVE_CATEGORIES)}
+    FROM formulas f
+    LEFT JOIN formula_summary s ON s.formula_id = f.id
+    ORDER BY f.created_at DESC, f.id'''
+
+def formula_list_item(row):
+    """A FORMULAS_LIST_SQL row as the formulas page expects it."""
+    r = dict(row)
+    pure = r.pop('pure_weight')
+    sums = {cat: r.pop(f'olf_{cat}') for cat in OLFACTIVE_CATEGORIES}
+    r['ingredient_names'] = json.loads(r['ingredient_names'])
+    r['olfactive_profile'] = {cat: round(v / pure, 1) if v is not None else 0
+                              for cat, v in sums.items()} if pure > 0 else {}
+    return r
+
 @app.route('/api/formulas', methods=['GET', 'POST'])
 @login_required
+@conditional_get('formulas', 'formula_summary')
 def api_formulas():
     conn = get_db()
 
     if request.method == 'GET':
         try:
-            data = conn.execute('''
-                SELECT f.*, COUNT(fi.id) as ingredients_count,
-                       COALESCE(SUM(fi.weight), 0) as total_weight
-                FROM formulas f
-                LEFT JOIN formula_ingredients fi ON f.id = fi.formula_id
-                GROUP BY f.id ORDER BY f.created_at DESC
-            ''').fetchall()
-
-            result = []
-            for f in data:
-                total_cost = conn.execute('''
-                    SELECT COALESCE(SUM(fi.weight * m.price_per_gram), 0)
-                    FROM formula_ingredients fi
-                    JOIN materials m ON fi.material_id = m.id
-                    WHERE fi.formula_id = ?
-                ''', (f['id'],)).fetchone()[0]
-
-                # Get ingredient names
-                ingredients = conn.execute('''
-                    SELECT m.name FROM formula_ingredients fi
-                    JOIN materials m ON fi.material_id = m.id
-                    WHERE fi.formula_id = ?
-                ''', (f['id'],)).fetchall()
-                ingredient_names = [i['name'] for i in ingredients]
-
-                # Calculate olfactive profile
-                olf_cats = ['citrus','aldehydic','aromatic','green','marine','floral','fruity','spicy','balsamic','woody','ambery','musky','leathery','animal']
-                olf_profile = {}
-                fi_rows = conn.execute('''
-                    SELECT fi.weight, fi.dilution, fi.material_id
-                    FROM formula_ingredients fi
-                    WHERE fi.formula_id = ?
-                ''', (f['id'],)).fetchall()
-                total_pure = sum((row['weight'] * (row['dilution'] or 1)) for row in fi_rows)
-                if total_pure > 0:
-                    for cat in olf_cats:
-                        val = 0
-                        for row in fi_rows:
-                            olf = conn.execute('SELECT * FROM material_olfactive WHERE material_id=?',
-                                (row['material_id'],)).fetchone()
-                            if olf and olf[cat]:
-                                pure_w = row['weight'] * (row['dilution'] or 1)
-                                val += olf[cat] * (pure_w / total_pure)
-                        olf_profile[cat] = round(val, 1)
-
-                r = dict(f)
-                r['total_cost'] = total_cost
-                r['ingredient_names'] = ingredient_names
-                r['olfactive_profile'] = olf_profile
-                result.append(r)
-
+            # One read of formula_summary (kept current by triggers) instead
+            # of cost, names and 14 olfactive queries per ingredient per formula
+            result = [formula_list_item(r) for r in conn.execute(FORMULAS_LIST_SQL).fetchall()]
             conn.close()
             return jsonify({'success': True, 'data': result})
         except Exception as e:
@@ -2861,451 +5745,92 @@ def api_formulas():
         action = request.form.get('action')
         
         if action == 'create':
-            cur = conn.execute("INSERT INTO formulas (name, description, ifra_category) VALUES (?,?,?)",
-                (request.form.get('name'), request.form.get('description'), request.form.get('ifra_category', 'cat4')))
-            conn.commit()
-            fid = cur.lastrowid
+            params = (request.form.get('name'), request.form.get('description'), request.form.get('ifra_category', 'cat4'))
+            fid = db_write(lambda w: w.execute(
+                "INSERT INTO formulas (name, description, ifra_category) VALUES (?,?,?)", params).lastrowid)
             conn.close()
             return jsonify({'success': True, 'message': 'تم الإنشاء', 'id': fid})
         
         elif action == 'delete':
             id = request.form.get('id')
-            # Delete draft ingredients first
-            draft_ids = [d['id'] for d in conn.execute("SELECT id FROM formula_drafts WHERE formula_id=?", (id,)).fetchall()]
-            for did in draft_ids:
-                conn.execute("DELETE FROM draft_ingredients WHERE draft_id=?", (did,))
-            conn.execute("DELETE FROM formula_drafts WHERE formula_id=?", (id,))
-            conn.execute("DELETE FROM formula_ingredients WHERE formula_id=?", (id,))
-            conn.execute("DELETE FROM formulas WHERE id=?", (id,))
-            conn.commit()
+
+            def write(w):
+                # Delete draft ingredients first
+                draft_ids = [d['id'] for d in w.execute("SELECT id FROM formula_drafts WHERE formula_id=?", (id,)).fetchall()]
+                for did in draft_ids:
+                    w.execute("DELETE FROM draft_ingredients WHERE draft_id=?", (did,))
+                w.execute("DELETE FROM formula_drafts WHERE formula_id=?", (id,))
+                w.execute("DELETE FROM formula_ingredients WHERE formula_id=?", (id,))
+                w.execute("DELETE FROM formula_snapshots WHERE formula_id=?", (id,))
+                w.execute("DELETE FROM formulas WHERE id=?", (id,))
+
+            db_write(write)
+            drop_formula_state(id)
             conn.close()
             return jsonify({'success': True, 'message': 'تم الحذف'})
         
         elif action == 'duplicate':
             id = request.form.get('id')
-            f = conn.execute("SELECT * FROM formulas WHERE id=?", (id,)).fetchone()
-            if f:
-                cur = conn.execute("INSERT INTO formulas (name, description, ifra_category) VALUES (?,?,?)",
+
+            def write(w):
+                f = w.execute("SELECT * FROM formulas WHERE id=?", (id,)).fetchone()
+                if not f:
+                    return None
+                cur = w.execute("INSERT INTO formulas (name, description, ifra_category) VALUES (?,?,?)",
                     (f['name'] + ' (نسخة)', f['description'], f['ifra_category']))
                 new_id = cur.lastrowid
-                for i in conn.execute("SELECT * FROM formula_ingredients WHERE formula_id=?", (id,)).fetchall():
-                    conn.execute("""INSERT INTO formula_ingredients 
+                for i in w.execute("SELECT * FROM formula_ingredients WHERE formula_id=?", (id,)).fetchall():
+                    w.execute("""INSERT INTO formula_ingredients 
                         (formula_id, material_id, weight, dilution, diluent, diluent_other) 
                         VALUES (?,?,?,?,?,?)""",
                         (new_id, i['material_id'], i['weight'], i['dilution'], 
                          i['diluent'] if 'diluent' in i.keys() else '', 
                          i['diluent_other'] if 'diluent_other' in i.keys() else ''))
-                conn.commit()
+                return new_id
+
+            new_id = db_write(write)
+            if new_id:
                 conn.close()
                 return jsonify({'success': True, 'message': 'تم النسخ', 'id': new_id})
     
     conn.close()
     return jsonify({'success': False})
 
-# ===== API مكونات التركيبة =====
-@app.route('/api/formula/<int:fid>/ingredients', methods=['GET', 'POST'])
-@login_required
-def api_formula_ingredients(fid):
-    conn = get_db()
-    
-    if request.method == 'GET':
-        # Get formula's IFRA category
-        formula = conn.execute("SELECT ifra_category FROM formulas WHERE id=?", (fid,)).fetchone()
-        cat_key = formula['ifra_category'] or 'cat4' if formula else 'cat4'
-
-        data = conn.execute('''
-            SELECT fi.*, m.name, m.name_ar, m.cas_number, m.ifra_limit, m.manual_ifra_cats,
-                   m.price_per_gram, m.profile
-            FROM formula_ingredients fi
-            JOIN materials m ON fi.material_id = m.id
-            WHERE fi.formula_id = ?
-        ''', (fid,)).fetchall()
-
-        # الحسابات مطابقة للإكسل:
-        # G = وزن الزيت (weight)
-        # E = التخفيف (dilution) - 1=صافي، 0.1=10%
-        # I = وزن صافي = G × E
-        # H = نسبة الزيت = G / ΣG
-        # J = نسبة الصافي = I / ΣI
-        # N = F / H (حساب IFRA للتصميم)
-        # L = F / J (حساب IFRA النهائي)
-
-        total_weight = sum(i['weight'] for i in data)  # ΣG
-        total_pure = sum(i['weight'] * get_concentration(i['dilution']) for i in data)  # ΣI
-
-        # J2 = نسبة المادة الفعالة = ΣI / ΣG × 100
-        active_ratio = (total_pure / total_weight * 100) if total_weight > 0 else 0
-
-        # حساب N و L لكل مادة أولاً
-        temp_results = []
-        n_values = []  # قيم N للمواد التي لها IFRA
-        l_values = []  # قيم L للمواد التي لها IFRA
-
-        for i in data:
-            conc = get_concentration(i['dilution'])  # E
-            pure_weight = i['weight'] * conc  # I = G × E
-            weight_pct = (i['weight'] / total_weight) if total_weight > 0 else 0  # H (كنسبة 0-1)
-            pure_pct = (pure_weight / total_pure) if total_pure > 0 else 0  # J (كنسبة 0-1)
-
-            # F - IFRA limit lookup, priority order:
-            #   1. manual_ifra_cats[cat_key]      — per-category manual value
-            #   2. materials.ifra_limit           — blanket manual (all cats)
-            #   3. IFRA standards table by CAS + category
-            #   4. IFRA contributions (derived from constituents of naturals)
-            ifra_limit = 0
-            ifra_std_name = None
-            ifra_std_type = None
-            cas = i['cas_number'] or ''
-            ifra_contrib_name = None
-
-            # Per-category manual (JSON column on materials)
-            manual_cats_raw = i['manual_ifra_cats'] if 'manual_ifra_cats' in i.keys() else None
-            manual_cat_value = None
-            if manual_cats_raw:
-                try:
-                    manual_cats = json.loads(manual_cats_raw) or {}
-                    v = manual_cats.get(cat_key)
-                    if v is not None and v != '' and float(v) > 0:
-                        manual_cat_value = float(v)
-                except Exception:
-                    pass
-
-            manual_mat_ifra = (i['ifra_limit'] or 0)
-            if manual_cat_value is not None:
-                ifra_limit = manual_cat_value
-                ifra_std_name = f'Manual ({cat_key})'
-                ifra_std_type = 'manual_category'
-            elif manual_mat_ifra > 0:
-                # Blanket manual IFRA (all categories) overrides the standards lookup.
-                ifra_limit = manual_mat_ifra
-                ifra_std_name = 'Manual (material)'
-                ifra_std_type = 'manual_material'
-            elif cas:
-                ifra_row = conn.execute('''
-                    SELECT s.* FROM ifra_standards s
-                    JOIN ifra_cas_lookup l ON l.ifra_standard_id = s.id
-                    WHERE l.cas_number = ?
-                ''', (cas,)).fetchone()
-                if ifra_row:
-                    cat_val = ifra_row[cat_key]
-                    ifra_std_name = ifra_row['name']
-                    ifra_std_type = ifra_row['standard_type']
-                    if cat_val is not None:
-                        if cat_val == -1:
-                            ifra_limit = -1  # No restriction
-                        elif cat_val == 0:
-                            ifra_limit = 0  # Prohibited
-                        else:
-                            ifra_limit = cat_val
-                # No direct IFRA standard — derive from contributions (constituents inside naturals/Schiff bases)
-                if ifra_limit == 0 and ifra_std_name is None:
-                    contribs = conn.execute(
-                        'SELECT * FROM ifra_contributions WHERE ncs_cas = ?', (cas,)
-                    ).fetchall()
-                    min_derived = None
-                    for c in contribs:
-                        c_row = conn.execute('''
-                            SELECT s.* FROM ifra_standards s
-                            JOIN ifra_cas_lookup l ON l.ifra_standard_id = s.id
-                            WHERE l.cas_number = ?
-                        ''', (c['constituent_cas'],)).fetchone()
-                        if c_row:
-                            c_val = c_row[cat_key]
-                            if c_val is not None and c_val >= 0 and c['concentration_pct'] > 0:
-                                if c_val == 0:
-                                    derived = 0
-                                else:
-                                    derived = c_val / (c['concentration_pct'] / 100)
-                                if min_derived is None or derived < min_derived:
-                                    min_derived = derived
-                                    ifra_contrib_name = c['constituent_name']
-                    if min_derived is not None:
-                        ifra_limit = round(min_derived, 6)
-                        ifra_std_name = f"Contrib: {ifra_contrib_name}"
-                        ifra_std_type = 'contribution'
-
-            # Composition-derived fallback (mixture / base / accord without its
-            # own IFRA limit). Runs for any material with composition rows when
-            # no manual / CAS / annex source set a limit. This makes E3 shrink
-            # when a hidden component inside the mixture is restricted.
-            if ifra_limit == 0 and ifra_std_name is None:
-                derived_for_cat = _resolve_material_ifra_for_cat(
-                    conn, i['material_id'], cat_key, depth=1)
-                if derived_for_cat is not None:
-                    binding = _derive_mixture_ifra_limits(conn, i['material_id']).get(cat_key)
-                    if binding:
-                        if derived_for_cat == -1:
-                            # Components exist but derived limit > 100% → effectively no restriction.
-                            ifra_limit = -1
-                        else:
-                            ifra_limit = derived_for_cat if derived_for_cat > 0 else 0
-                        ifra_std_name = f"Mix: {binding['binding_name']}"
-                        ifra_std_type = 'composition'
-
-            # Per-ingredient IFRA override (highest priority)
-            ifra_override = i['ifra_override'] if 'ifra_override' in i.keys() and i['ifra_override'] is not None else None
-            if ifra_override is not None:
-                ifra_limit = ifra_override
-                ifra_std_name = ifra_std_name or 'Manual'
-                ifra_std_type = 'override'
-
-            # For calculations, treat -1 (no restriction) as no limit
-            calc_limit = ifra_limit if ifra_limit > 0 else 0
-
-            # N = F / H (للتصميم)
-            ifra_design_calc = (calc_limit / weight_pct) if (calc_limit > 0 and weight_pct > 0) else None
-            if ifra_design_calc is not None:
-                n_values.append(ifra_design_calc)
-
-            # L = F / J (النهائي)
-            ifra_final_calc = (calc_limit / pure_pct) if (calc_limit > 0 and pure_pct > 0) else None
-            if ifra_final_calc is not None:
-                l_values.append(ifra_final_calc)
-
-            # Get constituents for this material
-            constituents = []
-            if cas:
-                const_rows = conn.execute(
-                    'SELECT constituent_name, constituent_cas, concentration_pct FROM ifra_contributions WHERE ncs_cas = ?', (cas,)
-                ).fetchall()
-                for cr in const_rows:
-                    constituents.append({
-                        'name': cr['constituent_name'],
-                        'cas': cr['constituent_cas'],
-                        'pct': cr['concentration_pct']
-                    })
-
-            temp_results.append({
-                'data': i,
-                'conc': conc,
-                'pure_weight': pure_weight,
-                'weight_pct': weight_pct,
-                'pure_pct': pure_pct,
-                'ifra_limit': ifra_limit,
-                'constituents': constituents,
-                'ifra_std_name': ifra_std_name,
-                'ifra_std_type': ifra_std_type,
-                'ifra_design_calc': ifra_design_calc,
-                'ifra_final_calc': ifra_final_calc
-            })
-        
-        # NOTE: E3/N3 (ifra_design_limit, ifra_final_limit) are computed BELOW
-        # after the contribution_map is built — we fold cumulative CAS
-        # constraints into l_values/n_values first so the headline shrinks
-        # when the same regulated molecule shows up across multiple mixtures
-        # or naturals.
-
-        # الآن نحدد التجاوز ونبني النتيجة النهائية
-        result = []
-        for t in temp_results:
-            i = t['data']
-            
-            # M = تجاوز إذا نسبة الزيت (H%) أكبر من حد IFRA (F%)
-            ifra_design_exceeded = False
-            if t['ifra_limit'] is not None and t['ifra_limit'] > 0:
-                ifra_design_exceeded = (t['weight_pct'] * 100) > t['ifra_limit']
-
-            # K = تجاوز إذا نسبة الصافي (J%) أكبر من حد IFRA (F%)
-            ifra_final_exceeded = False
-            if t['ifra_limit'] is not None and t['ifra_limit'] > 0:
-                ifra_final_exceeded = (t['pure_pct'] * 100) > t['ifra_limit']
-            
-            # Roll up price_per_gram from composition when the mixture itself
-            # has no own ppg set (common for in-house bases / accords).
-            eff_ppg = _effective_ppg(conn, i['material_id'], i['price_per_gram'] or 0)
-            result.append({
-                **dict(i),
-                'concentration': t['conc'],
-                'pure_weight': t['pure_weight'],
-                'weight_percentage': t['weight_pct'] * 100,  # H بالنسبة المئوية
-                'percentage': t['pure_pct'] * 100,  # J بالنسبة المئوية
-                'ifra_cat_limit': t['ifra_limit'],  # F from IFRA standards (category-specific)
-                'ifra_std_name': t.get('ifra_std_name'),
-                'ifra_std_type': t.get('ifra_std_type'),
-                'ifra_design_calc': t['ifra_design_calc'],  # N
-                'ifra_design_exceeded': ifra_design_exceeded,  # M
-                'ifra_final_calc': t['ifra_final_calc'],  # L
-                'ifra_final_exceeded': ifra_final_exceeded,  # K
-                'constituents': t.get('constituents', []),
-                'effective_ppg': eff_ppg,
-                'cost': i['weight'] * eff_ppg
-            })
-        
-        # === IFRA Contributions from other sources ===
-        contribution_map = {}
-        for t in temp_results:
-            cas = t['data']['cas_number'] or ''
-            if not cas:
-                continue
-            weight_pct_100 = t['weight_pct'] * 100  # H as percentage
-
-            contribs = conn.execute(
-                'SELECT * FROM ifra_contributions WHERE ncs_cas = ?', (cas,)
-            ).fetchall()
-
-            for c in contribs:
-                c_cas = c['constituent_cas']
-                contributed_pct = weight_pct_100 * c['concentration_pct'] / 100
-
-                if c_cas not in contribution_map:
-                    contribution_map[c_cas] = {
-                        'constituent_name': c['constituent_name'],
-                        'constituent_cas': c_cas,
-                        'sources': [],
-                        'total_pct': 0,
-                        'ifra_limit': None,
-                        'exceeded': False,
-                        'no_restriction': False,
-                    }
-
-                contribution_map[c_cas]['sources'].append({
-                    'material_name': t['data']['name'],
-                    'ncs_name': c['ncs_name'],
-                    'source_type': c['source_type'],
-                    'concentration_in_ncs': c['concentration_pct'],
-                    'material_pct_in_formula': round(weight_pct_100, 4),
-                    'contributed_pct': round(contributed_pct, 6),
-                })
-                contribution_map[c_cas]['total_pct'] += contributed_pct
-
-        # === Mixture composition contributions (user-defined per material) ===
-        # Walk the composition tree of every ingredient that's a blend, and
-        # add each component's effective formula-% to the same contribution_map.
-        # The downstream limit-check loop then enforces IFRA against the merged
-        # totals — direct usage + naturals contributions + mixture components.
-        for t in temp_results:
-            mat_id = t['data']['material_id']
-            weight_pct_100 = t['weight_pct'] * 100
-            if weight_pct_100 <= 0:
-                continue
-            for sub in _expand_mixture_components(conn, mat_id, weight_pct_100):
-                c_cas = sub['cas']
-                if not c_cas:
-                    continue  # only IFRA-relevant if we can match by CAS
-                contributed_pct = sub['effective_pct']
-                if c_cas not in contribution_map:
-                    contribution_map[c_cas] = {
-                        'constituent_name': sub['name'],
-                        'constituent_cas': c_cas,
-                        'sources': [],
-                        'total_pct': 0,
-                        'ifra_limit': None,
-                        'exceeded': False,
-                        'no_restriction': False,
-                    }
-                contribution_map[c_cas]['sources'].append({
-                    'material_name': t['data']['name'],
-                    'ncs_name': sub['name'],
-                    'source_type': 'mixture',
-                    'concentration_in_ncs': sub['pct_in_parent'],
-                    'material_pct_in_formula': round(weight_pct_100, 4),
-                    'contributed_pct': round(contributed_pct, 6),
-                })
-                contribution_map[c_cas]['total_pct'] += contributed_pct
-
-        # Check IFRA limits for each contributed constituent
-        contribution_warnings = []
-        contribution_results = []
-        for c_cas, cdata in contribution_map.items():
-            # Add direct usage if this constituent is also used directly
-            for r in result:
-                if r.get('cas_number') == c_cas:
-                    cdata['total_pct'] += r.get('weight_percentage', 0)
-                    cdata['sources'].insert(0, {
-                        'material_name': r['name'],
-                        'ncs_name': r['name'],
-                        'source_type': 'direct',
-                        'concentration_in_ncs': 100,
-                        'material_pct_in_formula': r.get('weight_percentage', 0),
-                        'contributed_pct': r.get('weight_percentage', 0),
-                    })
-                    break
-
-            cdata['total_pct'] = round(cdata['total_pct'], 6)
-
-            row = conn.execute('''
-                SELECT s.* FROM ifra_standards s
-                JOIN ifra_cas_lookup l ON l.ifra_standard_id = s.id
-                WHERE l.cas_number = ?
-            ''', (c_cas,)).fetchone()
-
-            if row:
-                cat_val = row[cat_key]
-                if cat_val is not None:
-                    if cat_val == -1:
-                        cdata['ifra_limit'] = None
-                        cdata['no_restriction'] = True
-                    elif cat_val == 0:
-                        cdata['ifra_limit'] = 0
-                        cdata['exceeded'] = True
-                    else:
-                        cdata['ifra_limit'] = cat_val
-                        if cdata['total_pct'] > cat_val:
-                            cdata['exceeded'] = True
-
-            # Fold cumulative CAS constraints into l_values/n_values so the
-            # headline E3/N3 reflects cross-ingredient exposure. Without this
-            # step, the formula could show a "green" E3 while iso-e-super (or
-            # any regulated molecule) is violated in aggregate across several
-            # mixtures / naturals — the per-ingredient L alone can't see the
-            # sum.
-            total = cdata['total_pct']
-            lim  = cdata.get('ifra_limit')
-            if total and total > 0:
-                if lim == 0:
-                    # Any presence of a prohibited constituent → forbid the formula.
-                    l_values.append(0)
-                    n_values.append(0)
-                elif lim is not None and lim > 0:
-                    cum_L = lim / (total / 100.0)
-                    l_values.append(cum_L)
-                    n_values.append(cum_L)
-
-            if cdata['exceeded']:
-                if cdata['ifra_limit'] == 0:
-                    contribution_warnings.append(f"⛔ {cdata['constituent_name']}: PROHIBITED in {cat_key}")
-                else:
-                    contribution_warnings.append(f"⚠️ {cdata['constituent_name']}: {cdata['total_pct']:.4f}% exceeds IFRA limit {cdata['ifra_limit']}%")
-
-            contribution_results.append(cdata)
-
-        # Compute headline E3 / N3 AFTER cumulative-contribution constraints
-        # have been folded into l_values / n_values. This is the last step
-        # so every path (per-row, composition-derived, cumulative) feeds in.
-        ifra_design_limit = min(n_values) * 0.99 if n_values else 0
-        ifra_final_limit  = min(l_values) * 0.99 if l_values else 0
-
-        # Calculate combined olfactive profile
-        olf_cats = ['citrus','aldehydic','aromatic','green','marine','floral','fruity','spicy','balsamic','woody','ambery','musky','leathery','animal']
-        formula_olfactive = {c: 0 for c in olf_cats}
-        for t in temp_results:
-            mat_id = t['data']['material_id']
-            olf = conn.execute("SELECT * FROM material_olfactive WHERE material_id=?", (mat_id,)).fetchone()
-            if olf:
-                pct = t['pure_pct']  # J (0-1)
-                for c in olf_cats:
-                    formula_olfactive[c] += (olf[c] or 0) * pct
-        # Round values
-        for c in olf_cats:
-            formula_olfactive[c] = round(formula_olfactive[c], 1)
+# ===== API مكونات التركيبة =====
+@app.route('/api/formula/<int:fid>/ingredients', methods=['GET', 'POST'])
+@login_required
+@conditional_get('formulas', 'formula_ingredients', 'materials', 'material_olfactive',
+                 'material_composition', 'material_composition_closure',
+                 'ifra_standards', 'ifra_cas_lookup', 'ifra_contributions', ifra_indices=True)
+def api_formula_ingredients(fid):
+    conn = get_db()
+    
+    if request.method == 'GET':
+        # Get formula's IFRA category
+        formula = conn.execute("SELECT ifra_category FROM formulas WHERE id=?", (fid,)).fetchone()
+        cat_key = ifra_cat_key(formula['ifra_category'] if formula else None)
+
+        data = conn.execute(FORMULA_ROWS_SQL, (fid,)).fetchall()
+
+        # الحسابات مطابقة للإكسل (انظر FormulaEvaluator):
+        # G = وزن الزيت، E = التخفيف، I = G × E، H = G / ΣG، J = I / ΣI
+        # N = F / H (حساب IFRA للتصميم)، L = F / J (حساب IFRA النهائي)
+        evaluator = formula_evaluator(conn, data)
+        state = FormulaState(evaluator, data, cat_key)
+        remember_formula_state(fid, state)
+        payload = state.evaluation.to_dict()
+        # ?all_categories=1 → E3/N3 + binding for all 18 categories, so the
+        # category picker can switch without another round trip
+        if request.args.get('all_categories') in ('1', 'true'):
+            payload['categories'] = evaluator.evaluate_all(data).to_dict()
 
         conn.close()
-        return jsonify({
-            'success': True,
-            'data': result,
-            'total_weight': total_weight,
-            'total_pure': total_pure,
-            'active_ratio': active_ratio,  # J2 محسوب
-            'ifra_category': cat_key,
-            'ifra_design_limit': ifra_design_limit,  # N3 محسوب
-            'ifra_final_limit': ifra_final_limit,  # E3 محسوب
-            'olfactive_profile': formula_olfactive,
-            'contributions': contribution_results,
-            'contribution_warnings': contribution_warnings
-        })
+        return jsonify({'success': True, **payload})
 
     elif request.method == 'POST':
         action = request.form.get('action')
+        if action not in ('update', 'scale'):
+            drop_formula_state(fid)
         
         if action == 'add':
             mid = request.form.get('material_id')
@@ -3316,11 +5841,16 @@ def api_formula_ingredients(fid):
             dilution = float(request.form.get('dilution', 0))
             diluent = request.form.get('diluent', '')
             diluent_other = request.form.get('diluent_other', '')
-            conn.execute("""INSERT INTO formula_ingredients 
-                (formula_id, material_id, weight, dilution, diluent, diluent_other) 
-                VALUES (?,?,?,?,?,?)""",
-                (fid, mid, request.form.get('weight', 0), dilution, diluent, diluent_other))
-            conn.commit()
+            weight = request.form.get('weight', 0)
+
+            def write(w):
+                release_formula_snapshot(w, fid)
+                w.execute("""INSERT INTO formula_ingredients 
+                    (formula_id, material_id, weight, dilution, diluent, diluent_other) 
+                    VALUES (?,?,?,?,?,?)""",
+                    (fid, mid, weight, dilution, diluent, diluent_other))
+
+            db_write(write)
             conn.close()
             return jsonify({'success': True, 'message': 'تم الإضافة'})
         
@@ -3330,48 +5860,100 @@ def api_formula_ingredients(fid):
             diluent_other = request.form.get('diluent_other', '')
             ifra_ov = request.form.get('ifra_override', '')
             ifra_override = float(ifra_ov) if ifra_ov and ifra_ov.strip() else None
-            conn.execute("""UPDATE formula_ingredients
-                SET weight=?, dilution=?, diluent=?, diluent_other=?, ifra_override=?
-                WHERE id=?""",
-                (request.form.get('weight'), dilution, diluent, diluent_other, ifra_override, request.form.get('ing_id')))
-            conn.commit()
+            ing_id = request.form.get('ing_id')
+            with _formula_states_lock:
+                state = _formula_states.get(fid)
+            lock = state.lock if state else threading.Lock()
+            weight = request.form.get('weight')
+
+            def write(w):
+                release_formula_snapshot(w, fid)
+                w.execute("""UPDATE formula_ingredients
+                    SET weight=?, dilution=?, diluent=?, diluent_other=?, ifra_override=?
+                    WHERE id=?""",
+                    (weight, dilution, diluent, diluent_other, ifra_override, ing_id))
+
+            with lock:
+                db_write(write)
+
+                # Answer with a delta (changed row, totals, E3/N3, moved
+                # contributions) instead of making the page re-GET everything.
+                formula = conn.execute("SELECT ifra_category FROM formulas WHERE id=?", (fid,)).fetchone()
+                cat_key = ifra_cat_key(formula['ifra_category'] if formula else None)
+                delta = None
+                try:
+                    changes = {
+                        'weight': float(request.form.get('weight')),
+                        'dilution': dilution,
+                        'diluent': diluent,
+                        'diluent_other': diluent_other,
+                        'ifra_override': ifra_override,
+                    }
+                    if state and state.is_current(cat_key):
+                        delta = state.apply_update(int(ing_id), changes)
+                except (TypeError, ValueError):
+                    pass
+                if delta is None:
+                    data = conn.execute(FORMULA_ROWS_SQL, (fid,)).fetchall()
+                    state = FormulaState(formula_evaluator(conn, data), data, cat_key)
+                    remember_formula_state(fid, state)
+                    ing = state.by_id.get(int(ing_id)) if str(ing_id).isdigit() else None
+                    if ing is not None:
+                        delta = formula_delta(state.evaluation, ing, state.evaluation.contributions, complete=True)
             conn.close()
-            return jsonify({'success': True})
+            if delta is None:
+                return jsonify({'success': True})
+            return jsonify({'success': True, 'delta': delta})
         
         elif action == 'delete':
-            conn.execute("DELETE FROM formula_ingredients WHERE id=?", (request.form.get('ing_id'),))
-            conn.commit()
+            ing_id = request.form.get('ing_id')
+
+            def write(w):
+                release_formula_snapshot(w, fid)
+                w.execute("DELETE FROM formula_ingredients WHERE id=?", (ing_id,))
+
+            db_write(write)
             conn.close()
             return jsonify({'success': True, 'message': 'تم الحذف'})
 
         elif action == 'delete_all':
-            cur = conn.execute("DELETE FROM formula_ingredients WHERE formula_id=?", (fid,))
-            affected = cur.rowcount
-            conn.commit()
+            def write(w):
+                release_formula_snapshot(w, fid)
+                return w.execute("DELETE FROM formula_ingredients WHERE formula_id=?", (fid,)).rowcount
+
+            affected = db_write(write)
             conn.close()
             return jsonify({'success': True, 'message': f'تم حذف {affected} مادة', 'affected': affected})
 
         elif action == 'reset_ifra':
             # Clear all manual ifra_override values for this formula, reverting to standard IFRA limits
-            cur = conn.execute(
-                "UPDATE formula_ingredients SET ifra_override=NULL WHERE formula_id=? AND ifra_override IS NOT NULL",
-                (fid,))
-            affected = cur.rowcount
-            conn.commit()
+            def write(w):
+                release_formula_snapshot(w, fid)
+                return w.execute(
+                    "UPDATE formula_ingredients SET ifra_override=NULL WHERE formula_id=? AND ifra_override IS NOT NULL",
+                    (fid,)).rowcount
+
+            affected = db_write(write)
             conn.close()
             return jsonify({'success': True, 'message': f'تم إعادة ضبط {affected} قيمة IFRA', 'affected': affected})
         
         elif action == 'update_formula':
-            conn.execute("""UPDATE formulas SET name=?, description=?, status=?, ifra_category=?,
-                target_audience=?, age_group=?, gender=?, season=?, occasion=?, scent_type=?, review_notes=?
-                WHERE id=?""",
-                (request.form.get('name'), request.form.get('description'),
-                 request.form.get('status'), request.form.get('ifra_category'),
-                 request.form.get('target_audience', ''), request.form.get('age_group', ''),
-                 request.form.get('gender', ''), request.form.get('season', ''),
-                 request.form.get('occasion', ''), request.form.get('scent_type', ''),
-                 request.form.get('review_notes', ''), fid))
-            conn.commit()
+            params = (request.form.get('name'), request.form.get('description'),
+                      request.form.get('status'), request.form.get('ifra_category'),
+                      request.form.get('target_audience', ''), request.form.get('age_group', ''),
+                      request.form.get('gender', ''), request.form.get('season', ''),
+                      request.form.get('occasion', ''), request.form.get('scent_type', ''),
+                      request.form.get('review_notes', ''), fid)
+
+            def write(w):
+                current = w.execute("SELECT ifra_category FROM formulas WHERE id=?", (fid,)).fetchone()
+                if current and current['ifra_category'] != params[3]:
+                    release_formula_snapshot(w, fid)
+                w.execute("""UPDATE formulas SET name=?, description=?, status=?, ifra_category=?,
+                    target_audience=?, age_group=?, gender=?, season=?, occasion=?, scent_type=?, review_notes=?
+                    WHERE id=?""", params)
+
+            db_write(write)
             conn.close()
             return jsonify({'success': True, 'message': 'تم الحفظ'})
         
@@ -3414,13 +5996,13 @@ def api_formula_notes(fid):
             if not title:
                 conn.close()
                 return jsonify({'success': False, 'message': 'العنوان مطلوب'})
-            conn.execute("INSERT INTO formula_notes (formula_id, title, content) VALUES (?,?,?)", (fid, title, content))
-            conn.commit()
+            db_write(lambda w: w.execute("INSERT INTO formula_notes (formula_id, title, content) VALUES (?,?,?)",
+                                         (fid, title, content)))
             conn.close()
             return jsonify({'success': True, 'message': 'تم إضافة الملاحظة'})
         elif action == 'delete':
-            conn.execute("DELETE FROM formula_notes WHERE id=? AND formula_id=?", (request.form.get('id'), fid))
-            conn.commit()
+            note_id = request.form.get('id')
+            db_write(lambda w: w.execute("DELETE FROM formula_notes WHERE id=? AND formula_id=?", (note_id, fid)))
             conn.close()
             return jsonify({'success': True, 'message': 'تم الحذف'})
     conn.close()
@@ -3448,30 +6030,34 @@ def api_formula_drafts(fid):
         action = request.form.get('action')
 
         if action == 'save':
-            # Get next draft number
-            last = conn.execute("SELECT MAX(draft_number) as mx FROM formula_drafts WHERE formula_id=?", (fid,)).fetchone()
-            next_num = (last['mx'] or 0) + 1
-            draft_name = request.form.get('name', '').strip() or f'Draft {next_num}'
+            name = request.form.get('name', '').strip()
             draft_notes = request.form.get('notes', '').strip()
 
-            # Create draft record
-            cur = conn.execute("INSERT INTO formula_drafts (formula_id, draft_number, name, notes) VALUES (?,?,?,?)",
-                (fid, next_num, draft_name, draft_notes))
-            draft_id = cur.lastrowid
-
-            # Copy current ingredients to draft
-            ingredients = conn.execute("SELECT * FROM formula_ingredients WHERE formula_id=?", (fid,)).fetchall()
-            for ing in ingredients:
-                conn.execute("""INSERT INTO draft_ingredients
-                    (draft_id, material_id, weight, dilution, diluent, diluent_other, notes, ifra_override)
-                    VALUES (?,?,?,?,?,?,?,?)""",
-                    (draft_id, ing['material_id'], ing['weight'], ing['dilution'],
-                     ing['diluent'] if 'diluent' in ing.keys() else '',
-                     ing['diluent_other'] if 'diluent_other' in ing.keys() else '',
-                     ing['notes'] if 'notes' in ing.keys() else '',
-                     ing['ifra_override'] if 'ifra_override' in ing.keys() and ing['ifra_override'] is not None else None))
-
-            conn.commit()
+            def write(w):
+                # Get next draft number
+                last = w.execute("SELECT MAX(draft_number) as mx FROM formula_drafts WHERE formula_id=?", (fid,)).fetchone()
+                next_num = (last['mx'] or 0) + 1
+                draft_name = name or f'Draft {next_num}'
+
+                # Create draft record
+                cur = w.execute("INSERT INTO formula_drafts (formula_id, draft_number, name, notes) VALUES (?,?,?,?)",
+                    (fid, next_num, draft_name, draft_notes))
+                draft_id = cur.lastrowid
+
+                # Copy current ingredients to draft
+                ingredients = w.execute("SELECT * FROM formula_ingredients WHERE formula_id=?", (fid,)).fetchall()
+                for ing in ingredients:
+                    w.execute("""INSERT INTO draft_ingredients
+                        (draft_id, material_id, weight, dilution, diluent, diluent_other, notes, ifra_override)
+                        VALUES (?,?,?,?,?,?,?,?)""",
+                        (draft_id, ing['material_id'], ing['weight'], ing['dilution'],
+                         ing['diluent'] if 'diluent' in ing.keys() else '',
+                         ing['diluent_other'] if 'diluent_other' in ing.keys() else '',
+                         ing['notes'] if 'notes' in ing.keys() else '',
+                         ing['ifra_override'] if 'ifra_override' in ing.keys() and ing['ifra_override'] is not None else None))
+                return draft_id, next_num, draft_name
+
+            draft_id, next_num, draft_name = db_write(write)
             conn.close()
             return jsonify({'success': True, 'message': f'تم حفظ {draft_name}', 'draft_id': draft_id, 'draft_number': next_num})
 
@@ -3482,20 +6068,23 @@ def api_formula_drafts(fid):
                 conn.close()
                 return jsonify({'success': False, 'message': 'المسودة غير مو��ودة'})
 
-            # Clear current ingredients
-            conn.execute("DELETE FROM formula_ingredients WHERE formula_id=?", (fid,))
-
-            # Copy draft ingredients back to formula
-            draft_ings = conn.execute("SELECT * FROM draft_ingredients WHERE draft_id=?", (draft_id,)).fetchall()
-            for di in draft_ings:
-                conn.execute("""INSERT INTO formula_ingredients
-                    (formula_id, material_id, weight, dilution, diluent, diluent_other, notes, ifra_override)
-                    VALUES (?,?,?,?,?,?,?,?)""",
-                    (fid, di['material_id'], di['weight'], di['dilution'],
-                     di['diluent'] or '', di['diluent_other'] or '',
-                     di['notes'] or '', di['ifra_override']))
-
-            conn.commit()
+            def write(w):
+                # Clear current ingredients
+                w.execute("DELETE FROM formula_ingredients WHERE formula_id=?", (fid,))
+                release_formula_snapshot(w, fid)
+
+                # Copy draft ingredients back to formula
+                draft_ings = w.execute("SELECT * FROM draft_ingredients WHERE draft_id=?", (draft_id,)).fetchall()
+                for di in draft_ings:
+                    w.execute("""INSERT INTO formula_ingredients
+                        (formula_id, material_id, weight, dilution, diluent, diluent_other, notes, ifra_override)
+                        VALUES (?,?,?,?,?,?,?,?)""",
+                        (fid, di['material_id'], di['weight'], di['dilution'],
+                         di['diluent'] or '', di['diluent_other'] or '',
+                         di['notes'] or '', di['ifra_override']))
+
+            db_write(write)
+            drop_formula_state(fid)
             conn.close()
             return jsonify({'success': True, 'message': f'تم تحميل {draft["name"]}'})
 
@@ -3508,9 +6097,11 @@ def api_formula_drafts(fid):
             if draft['is_final']:
                 conn.close()
                 return jsonify({'success': False, 'message': 'لا يمكن حذف المسودة المعتمدة'})
-            conn.execute("DELETE FROM draft_ingredients WHERE draft_id=?", (draft_id,))
-            conn.execute("DELETE FROM formula_drafts WHERE id=?", (draft_id,))
-            conn.commit()
+            def write(w):
+                w.execute("DELETE FROM draft_ingredients WHERE draft_id=?", (draft_id,))
+                w.execute("DELETE FROM formula_drafts WHERE id=?", (draft_id,))
+
+            db_write(write)
             conn.close()
             return jsonify({'success': True, 'message': 'تم ح��ف المسودة'})
 
@@ -3521,25 +6112,33 @@ def api_formula_drafts(fid):
                 conn.close()
                 return jsonify({'success': False, 'message': 'ال��سودة غير موجودة'})
 
-            # Remove previous final flag
-            conn.execute("UPDATE formula_drafts SET is_final=0 WHERE formula_id=?", (fid,))
-            # Set this draft as final
-            conn.execute("UPDATE formula_drafts SET is_final=1 WHERE id=?", (draft_id,))
-            # Update formula status to final
-            conn.execute("UPDATE formulas SET status='final' WHERE id=?", (fid,))
-
-            # Load this draft's ingredients as current
-            conn.execute("DELETE FROM formula_ingredients WHERE formula_id=?", (fid,))
-            draft_ings = conn.execute("SELECT * FROM draft_ingredients WHERE draft_id=?", (draft_id,)).fetchall()
-            for di in draft_ings:
-                conn.execute("""INSERT INTO formula_ingredients
-                    (formula_id, material_id, weight, dilution, diluent, diluent_other, notes, ifra_override)
-                    VALUES (?,?,?,?,?,?,?,?)""",
-                    (fid, di['material_id'], di['weight'], di['dilution'],
-                     di['diluent'] or '', di['diluent_other'] or '',
-                     di['notes'] or '', di['ifra_override']))
-
-            conn.commit()
+            def write(w):
+                # Remove previous final flag
+                w.execute("UPDATE formula_drafts SET is_final=0 WHERE formula_id=?", (fid,))
+                # Set this draft as final
+                w.execute("UPDATE formula_drafts SET is_final=1 WHERE id=?", (draft_id,))
+                # Update formula status to final
+                w.execute("UPDATE formulas SET status='final' WHERE id=?", (fid,))
+
+                # Load this draft's ingredients as current
+                w.execute("DELETE FROM formula_ingredients WHERE formula_id=?", (fid,))
+                draft_ings = w.execute("SELECT * FROM draft_ingredients WHERE draft_id=?", (draft_id,)).fetchall()
+                for di in draft_ings:
+                    w.execute("""INSERT INTO formula_ingredients
+                        (formula_id, material_id, weight, dilution, diluent, diluent_other, notes, ifra_override)
+                        VALUES (?,?,?,?,?,?,?,?)""",
+                        (fid, di['material_id'], di['weight'], di['dilution'],
+                         di['diluent'] or '', di['diluent_other'] or '',
+                         di['notes'] or '', di['ifra_override']))
+
+                # Freeze what the reports will show from now on
+                freeze_formula_snapshot(w, fid, draft_id)
+
+            # Loaded here: the job must not open connections of its own
+            get_ifra_index()
+            get_contributions_index()
+            db_write(write)
+            drop_formula_state(fid)
             conn.close()
             return jsonify({'success': True, 'message': 'تم اعتماد التركيبة النهائية'})
 
@@ -3549,8 +6148,8 @@ def api_formula_drafts(fid):
             if not new_name:
                 conn.close()
                 return jsonify({'success': False, 'message': 'الاسم م��لوب'})
-            conn.execute("UPDATE formula_drafts SET name=? WHERE id=? AND formula_id=?", (new_name, draft_id, fid))
-            conn.commit()
+            db_write(lambda w: w.execute("UPDATE formula_drafts SET name=? WHERE id=? AND formula_id=?",
+                                         (new_name, draft_id, fid)))
             conn.close()
             return jsonify({'success': True, 'message': 'تم التحديث'})
 
@@ -3567,140 +6166,129 @@ def api_draft_ingredients(draft_id):
         conn.close()
         return jsonify({'success': False, 'message': 'ا��مسودة غير موجودة'})
 
-    data = conn.execute('''
-        SELECT di.*, m.name, m.cas_number, m.ifra_limit, m.price_per_gram, m.profile
-        FROM draft_ingredients di
-        JOIN materials m ON di.material_id = m.id
-        WHERE di.draft_id = ?
-    ''', (draft_id,)).fetchall()
+    formula = conn.execute("SELECT ifra_category FROM formulas WHERE id=?", (draft['formula_id'],)).fetchone()
+    cat_key = ifra_cat_key(formula['ifra_category'] if formula else None)
+    data = conn.execute(DRAFT_ROWS_SQL, (draft_id,)).fetchall()
+    evaluation = formula_evaluator(conn, data).evaluate(data, cat_key)
+    conn.close()
 
     result = []
-    total_weight = sum(i['weight'] for i in data)
-    for i in data:
-        conc = i['dilution'] if i['dilution'] and i['dilution'] > 0 else 1
-        pure_weight = i['weight'] * conc
+    for ing in evaluation.ingredients:
+        i = ing.row
         result.append({
             'name': i['name'],
             'cas_number': i['cas_number'],
             'weight': i['weight'],
             'dilution': i['dilution'],
             'diluent': i['diluent'],
-            'weight_pct': (i['weight'] / total_weight * 100) if total_weight > 0 else 0,
-            'pure_weight': pure_weight,
-            'cost': i['weight'] * (i['price_per_gram'] or 0)
+            'weight_pct': ing.weight_pct * 100,
+            'pure_weight': ing.pure_weight,
+            'ifra_cat_limit': ing.ifra_limit,
+            'ifra_std_name': ing.ifra_std_name,
+            'ifra_final_exceeded': ing.final_exceeded,
+            'cost': ing.cost
         })
 
-    conn.close()
-    return jsonify({'success': True, 'data': result, 'total_weight': total_weight})
-
-# ===== API شهادة IFRA =====
-@app.route('/api/ifra-certificate/<int:fid>')
-@login_required
-def api_ifra_certificate(fid):
-    conn = get_db()
-    formula = conn.execute("SELECT * FROM formulas WHERE id=?", (fid,)).fetchone()
-    if not formula:
-        conn.close()
-        return jsonify({'success': False, 'message': 'التركيبة غير موجودة'})
-    if formula['status'] != 'final':
-        conn.close()
-        return jsonify({'success': False, 'message': 'شهادة IFRA متاحة فقط للتركيبات المعتمدة (Final). اعتمد مسودة أولاً.'})
+    return jsonify({
+        'success': True,
+        'data': result,
+        'total_weight': evaluation.total_weight,
+        'ifra_category': cat_key,
+        'ifra_design_limit': evaluation.design_limit,
+        'ifra_final_limit': evaluation.final_limit,
+    })
 
-    ingredients = conn.execute('''
-        SELECT fi.*, m.name, m.cas_number, m.ifra_limit
-        FROM formula_ingredients fi
-        JOIN materials m ON fi.material_id = m.id
-        WHERE fi.formula_id = ?
-    ''', (fid,)).fetchall()
+# ===== Approved formula snapshots =====
+# Approving a draft freezes everything the certificate, MSDS, print page and
+# card derive from materials / IFRA data: per-ingredient percentages and
+# resolved limits, the per-category maximum dosage, aggregated GHS data and
+# the olfactive vector. Those views read the snapshot while the formula is
+# final and untouched, so a later edit to a material record (or an IFRA
+# update) cannot silently change an issued certificate. Editing the
+# formula's ingredients or category releases the snapshot.
+SNAPSHOT_VERSION = 2  # bump when the payload or the limits behind it change
+
+def build_formula_snapshot(conn, fid):
+    """Everything the final-formula reports need, computed from live tables."""
+    formula = conn.execute("SELECT ifra_category FROM formulas WHERE id=?", (fid,)).fetchone()
+    cat_key = ifra_cat_key(formula['ifra_category'] if formula else None)
+    rows = conn.execute(FORMULA_ROWS_SQL, (fid,)).fetchall()
+    evaluator = formula_evaluator(conn, rows)
+    return {
+        'version': SNAPSHOT_VERSION,
+        'category': cat_key,
+        'evaluation': evaluator.evaluate(rows, cat_key).to_dict(),
+        'certificate': certificate_report(rows, evaluator.evaluate_all(rows)),
+        'msds': msds_report(conn, fid),
+        'card': card_report(conn, fid),
+    }
 
-    total_weight = sum(i['weight'] for i in ingredients)
-    total_pure = sum(i['weight'] * get_concentration(i['dilution']) for i in ingredients)
-
-    # Mark which ingredients are IFRA-regulated (match in ifra_standards or manual ifra_limit > 0)
-    regulated_ids = set()
-    for ing in ingredients:
-        cas = ing['cas_number'] or ''
-        if cas:
-            hit = conn.execute('SELECT 1 FROM ifra_cas_lookup WHERE cas_number = ?', (cas,)).fetchone()
-            if hit:
-                regulated_ids.add(ing['id'])
-                continue
-        if ing['ifra_limit'] and ing['ifra_limit'] > 0:
-            regulated_ids.add(ing['id'])
+def freeze_formula_snapshot(conn, fid, draft_id=None):
+    """Store the current evaluation of fid and point the formula at it.
+    Returns the snapshot id. Caller commits."""
+    body = json.dumps(build_formula_snapshot(conn, fid), ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha256(body.encode('utf-8')).hexdigest()
+    conn.execute("INSERT OR IGNORE INTO formula_snapshots (formula_id, draft_id, content_hash, payload) VALUES (?,?,?,?)",
+                 (fid, draft_id, digest, body))
+    sid = conn.execute("SELECT id FROM formula_snapshots WHERE formula_id=? AND content_hash=?",
+                       (fid, digest)).fetchone()['id']
+    conn.execute("UPDATE formulas SET snapshot_id=? WHERE id=?", (sid, fid))
+    return sid
+
+def release_formula_snapshot(conn, fid):
+    """Detach the snapshot so reports go back to live data (kept for history)."""
+    conn.execute("UPDATE formulas SET snapshot_id=NULL WHERE id=? AND snapshot_id IS NOT NULL", (fid,))
+
+def formula_snapshot(conn, formula):
+    """Frozen payload for a final formula row, or None to compute live."""
+    if formula['status'] != 'final' or not formula['snapshot_id']:
+        return None
+    row = conn.execute("SELECT id, content_hash, created_at, payload FROM formula_snapshots WHERE id=?",
+                       (formula['snapshot_id'],)).fetchone()
+    if not row:
+        return None
+    payload = json.loads(row['payload'])
+    if payload.get('version') != SNAPSHOT_VERSION:
+        return None
+    payload['meta'] = {'id': row['id'], 'content_hash': row['content_hash'], 'created_at': row['created_at']}
+    return payload
 
-    # For each category, check compliance using ifra_standards table
+# ===== API شهادة IFRA =====
+def certificate_report(ingredients, sweep):
+    """Certificate body: regulated ingredients and the max dosage per category."""
+    # For each category the max fragrance % in the final product is the
+    # tightest L = F / J (per ingredient and cumulative per CAS), without the
+    # 0.99 safety factor the formula page applies to E3.
+    regulated_ids = set(sweep.regulated_ids)
     category_limits = []
-    cat_ids = [c['id'] for c in IFRA_CATEGORIES]
-
     for cat in IFRA_CATEGORIES:
-        cat_id = cat['id']
-        max_fragrance_pct = None
-        restricted_materials = []
-
-        for ing in ingredients:
-            cas = ing['cas_number'] or ''
-            # Look up IFRA limit for this category from ifra_standards
-            ifra_limit_val = None
-            if cas:
-                ifra_row = conn.execute('''
-                    SELECT s.* FROM ifra_standards s
-                    JOIN ifra_cas_lookup l ON l.ifra_standard_id = s.id
-                    WHERE l.cas_number = ?
-                ''', (cas,)).fetchone()
-                if ifra_row:
-                    cv = ifra_row[cat_id]
-                    if cv is not None and cv >= 0:
-                        ifra_limit_val = cv
-                    elif cv == -1:
-                        ifra_limit_val = None  # No restriction for this category
-
-            # Fallback to manual ifra_limit
-            if ifra_limit_val is None and not cas:
-                if ing['ifra_limit'] and ing['ifra_limit'] > 0:
-                    ifra_limit_val = ing['ifra_limit']
-
-            if ifra_limit_val is not None and ifra_limit_val >= 0:
-                conc = get_concentration(ing['dilution'])
-                pure_weight = ing['weight'] * conc
-                pure_pct_in_formula = (pure_weight / total_pure * 100) if total_pure > 0 else 0
-
-                if ifra_limit_val == 0:
-                    restricted_materials.append(f"{ing['name']} (PROHIBITED)")
-                elif pure_pct_in_formula > 0:
-                    # max fragrance % in final product = ifra_limit / pure_pct_in_formula * 100
-                    max_frag = (ifra_limit_val / pure_pct_in_formula) * 100
-                    # Cap: anything above 100% is effectively no restriction (can't exceed 100% of the product)
-                    if max_frag <= 100:
-                        if max_fragrance_pct is None or max_frag < max_fragrance_pct:
-                            max_fragrance_pct = max_frag
-
-        limit_value = round(max_fragrance_pct, 3) if max_fragrance_pct else None
+        result = sweep.categories[cat['id']]
+        restricted_materials = [f"{name} (PROHIBITED)" for name in result.prohibited]
+        max_fragrance_pct = result.final_bound
+        # Anything above 100% is effectively no restriction; so is no bound at
+        # all, or the 0 a prohibited constituent leaves (it is listed instead)
+        if not max_fragrance_pct or max_fragrance_pct > 100:
+            max_fragrance_pct = None
 
         category_limits.append({
-            'id': cat_id,
+            'id': cat['id'],
             'name': cat['name'],
             'desc': cat['desc'],
-            'limit': limit_value if limit_value else 'No Restriction',
+            'limit': round(max_fragrance_pct, 3) if max_fragrance_pct is not None else 'No Restriction',
             'compliant': len(restricted_materials) == 0,
             'restricted': restricted_materials
         })
 
     # Return ONLY regulated materials in the composition table
-    regulated_ingredients = [dict(i) for i in ingredients if i['id'] in regulated_ids]
-
-    conn.close()
-    return jsonify({
-        'success': True,
-        'formula': dict(formula),
-        'ingredients': regulated_ingredients,
+    return {
+        'ingredients': [dict(i) for i in ingredients if i['id'] in regulated_ids],
         'categories': category_limits,
-        'total_weight': total_weight
-    })
+        'total_weight': sum(i['weight'] for i in ingredients),
+    }
 
-# ===== API تقرير MSDS =====
-@app.route('/api/msds/<int:fid>')
+@app.route('/api/ifra-certificate/<int:fid>')
 @login_required
-def api_msds_report(fid):
+def api_ifra_certificate(fid):
     conn = get_db()
     formula = conn.execute("SELECT * FROM formulas WHERE id=?", (fid,)).fetchone()
     if not formula:
@@ -3708,10 +6296,27 @@ def api_msds_report(fid):
         return jsonify({'success': False, 'message': 'التركيبة غير موجودة'})
     if formula['status'] != 'final':
         conn.close()
-        return jsonify({'success': False, 'message': 'تقرير MSDS متاح فقط للتركيبات المعتمدة (Final). اعتمد مسودة أولاً.'})
+        return jsonify({'success': False, 'message': 'شهادة IFRA متاحة فقط للتركيبات المعتمدة (Final). اعتمد مسودة أولاً.'})
 
-    company = conn.execute("SELECT * FROM company_info WHERE id=1").fetchone()
-    
+    snapshot = formula_snapshot(conn, formula)
+    if snapshot:
+        report = snapshot['certificate']
+    else:
+        ingredients = conn.execute(FORMULA_ROWS_SQL, (fid,)).fetchall()
+        report = certificate_report(ingredients, formula_evaluator(conn, ingredients).evaluate_all(ingredients))
+    conn.close()
+
+    return jsonify({
+        'success': True,
+        'formula': dict(formula),
+        **report,
+        'snapshot': snapshot['meta'] if snapshot else None,
+    })
+
+# ===== API تقرير MSDS =====
+def msds_report(conn, fid):
+    """GHS data of the formula: ingredients carrying GHS info and the union of
+    their H/P codes, pictograms and the strongest signal word."""
     ingredients = conn.execute('''
         SELECT fi.*, m.name, m.cas_number, mm.h_codes, mm.p_codes, mm.pictograms, mm.signal_word, mm.ghs_classification
         FROM formula_ingredients fi
@@ -3719,15 +6324,15 @@ def api_msds_report(fid):
         LEFT JOIN material_msds mm ON m.id = mm.material_id
         WHERE fi.formula_id = ?
     ''', (fid,)).fetchall()
-    
+
     total_weight = sum(i['weight'] for i in ingredients)
-    
+
     # جمع كل H-codes و P-codes من المكونات
     all_h_codes = set()
     all_p_codes = set()
     all_pictograms = set()
     signal_words = set()
-    
+
     ingredient_list = []
     for i in ingredients:
         has_ghs = bool((i['h_codes'] and i['h_codes'].strip())
@@ -3757,26 +6362,48 @@ def api_msds_report(fid):
                     all_pictograms.add(pic.strip())
         if i['signal_word']:
             signal_words.add(i['signal_word'])
-    
+
     # تحديد Signal Word (الأقوى)
     final_signal_word = 'Danger' if 'Danger' in signal_words else ('Warning' if 'Warning' in signal_words else '')
-    
+
+    # Sorted so the same data always gives the same snapshot hash
+    return {
+        'ingredients': ingredient_list,
+        'h_codes': sorted(all_h_codes),
+        'p_codes': sorted(all_p_codes),
+        'pictograms': sorted(all_pictograms),
+        'signal_word': final_signal_word,
+        'total_weight': total_weight
+    }
+
+@app.route('/api/msds/<int:fid>')
+@login_required
+def api_msds_report(fid):
+    conn = get_db()
+    formula = conn.execute("SELECT * FROM formulas WHERE id=?", (fid,)).fetchone()
+    if not formula:
+        conn.close()
+        return jsonify({'success': False, 'message': 'التركيبة غير موجودة'})
+    if formula['status'] != 'final':
+        conn.close()
+        return jsonify({'success': False, 'message': 'تقرير MSDS متاح فقط للتركيبات المعتمدة (Final). اعتمد مسودة أولاً.'})
+
+    company = conn.execute("SELECT * FROM company_info WHERE id=1").fetchone()
+    snapshot = formula_snapshot(conn, formula)
+    report = snapshot['msds'] if snapshot else msds_report(conn, fid)
     conn.close()
     return jsonify({
         'success': True,
         'formula': dict(formula),
         'company': dict(company) if company else {},
-        'ingredients': ingredient_list,
-        'h_codes': list(all_h_codes),
-        'p_codes': list(all_p_codes),
-        'pictograms': list(all_pictograms),
-        'signal_word': final_signal_word,
-        'total_weight': total_weight
+        **report,
+        'snapshot': snapshot['meta'] if snapshot else None,
     })
 
 # ===== API الموردين =====
 @app.route('/api/suppliers', methods=['GET', 'POST'])
 @login_required
+@conditional_get('suppliers', 'materials')
 def api_suppliers():
     conn = get_db()
     
@@ -3912,6 +6539,20 @@ def api_settings():
         conn.close()
         return jsonify({'success': True, 'data': list_backups()})
 
+    elif action == 'backup_status':
+        conn.close()
+        return jsonify({'success': True, 'data': dict(backup_status)})
+
+    elif action == 'backup_schedule':
+        conn.close()
+        data = dict(backup_schedule, after_writes=BACKUP_AFTER_WRITES, after_minutes=BACKUP_AFTER_MINUTES,
+                    chain_mb=round(backup_chain_bytes() / 1024 / 1024, 1), budget_mb=BACKUP_BUDGET_MB)
+        return jsonify({'success': True, 'data': data})
+
+    elif action == 'schema_info':
+        conn.close()
+        return jsonify({'success': True, 'data': schema_status()})
+
     elif action == 'restore_backup':
         conn.close()
         filename = request.form.get('filename', '')
@@ -3925,9 +6566,7 @@ def api_settings():
         filename = request.form.get('filename', '')
         if not filename or '..' in filename or '/' in filename:
             return jsonify({'success': False, 'message': 'Invalid filename'})
-        path = os.path.join(BACKUP_DIR, filename)
-        if os.path.exists(path):
-            os.remove(path)
+        if delete_backup(filename):
             return jsonify({'success': True, 'message': 'تم الحذف'})
         return jsonify({'success': False, 'message': 'Not found'})
 
@@ -3970,15 +6609,8 @@ def api_formula_card_settings(fid):
     conn.close()
     return jsonify({'success': True, 'message': 'تم حفظ إعدادات البطاقة'})
 
-@app.route('/api/formula/<int:fid>/card')
-@login_required
-def api_formula_card(fid):
-    conn = get_db()
-    formula = conn.execute("SELECT * FROM formulas WHERE id=?", (fid,)).fetchone()
-    if not formula:
-        conn.close()
-        return jsonify({'success': False, 'message': 'التركيبة غير موجودة'})
-
+def card_report(conn, fid):
+    """Card body: olfactive families by weight and the Top/Heart/Base pyramid."""
     ingredients = conn.execute('''
         SELECT fi.*, m.name, m.name_ar, m.cas_number, m.profile, m.odor_description,
                f.name as family_name, f.name_ar as family_name_ar, f.icon as family_icon
@@ -4027,6 +6659,24 @@ def api_formula_card(fid):
             'odor_description': i['odor_description'] or ''
         })
 
+    return {
+        'families': family_list,
+        'pyramid': pyramid,
+        'total_weight': total_weight,
+        'ingredients_count': len(ingredients),
+    }
+
+@app.route('/api/formula/<int:fid>/card')
+@login_required
+def api_formula_card(fid):
+    conn = get_db()
+    formula = conn.execute("SELECT * FROM formulas WHERE id=?", (fid,)).fetchone()
+    if not formula:
+        conn.close()
+        return jsonify({'success': False, 'message': 'التركيبة غير موجودة'})
+
+    snapshot = formula_snapshot(conn, formula)
+    report = snapshot['card'] if snapshot else card_report(conn, fid)
     company = conn.execute("SELECT * FROM company_info WHERE id=1").fetchone()
     all_families = conn.execute("SELECT id, name, name_ar, icon FROM families ORDER BY name_ar").fetchall()
     conn.close()
@@ -4043,13 +6693,11 @@ def api_formula_card(fid):
     return jsonify({
         'success': True,
         'formula': dict(formula),
-        'families': family_list,
+        **report,
         'all_families': [dict(f) for f in all_families],
-        'pyramid': pyramid,
-        'total_weight': total_weight,
-        'ingredients_count': len(ingredients),
         'company': dict(company) if company else {},
-        'card_settings': card_settings
+        'card_settings': card_settings,
+        'snapshot': snapshot['meta'] if snapshot else None,
     })
 
 # ===== Smart Import - قراءة Excel =====
@@ -4401,205 +7049,211 @@ def api_import_execute():
                 field_to_col[sys_field] = excel_col
 
         rows = data[1:]
-        conn = get_db()
-
-        # بناء lookup للموجود
-        existing = {}
-        for row in conn.execute("SELECT id, name, cas_number FROM materials"):
-            existing[(row['name'] or '').lower().strip()] = row['id']
-            if row['cas_number']:
-                existing[('cas:' + row['cas_number']).strip()] = row['id']
-
-        # بناء lookup للعائلات والموردين
-        families = {}
-        for row in conn.execute("SELECT id, name FROM families"):
-            families[row['name'].lower()] = row['id']
-
-        suppliers = {}
-        for row in conn.execute("SELECT id, name FROM suppliers"):
-            suppliers[row['name'].lower()] = row['id']
-
-        # خريطة أسماء العائلات المختلفة
-        family_aliases = {
-            'flower': 'floral', 'flowers': 'floral', 'frutiy': 'fruity', 'fruit': 'fruity',
-            'marine': 'aquatic', 'wood': 'woody', 'woods': 'woody', 'spice': 'spicy',
-            'balsam': 'balsamic', 'anisic': 'aromatic', 'mint': 'aromatic',
-            'musk': 'musk', 'leather': 'leather',
-        }
-
-        added = 0
-        updated = 0
-        skipped = 0
-
-        for row in rows:
-            item = {}
-            for sys_field, excel_col in field_to_col.items():
-                val = str(row.get(excel_col, '')).strip()
-                if val and val != '#DIV/0!':
-                    item[sys_field] = val
-                else:
-                    item[sys_field] = ''
+        # All writes happen in one writer job, so readers keep going and
+        # other saves queue behind the import instead of timing out
+        def write(conn):
+            # بناء lookup للموجود
+            existing = {}
+            for row in conn.execute("SELECT id, name, cas_number FROM materials"):
+                existing[(row['name'] or '').lower().strip()] = row['id']
+                if row['cas_number']:
+                    existing[('cas:' + row['cas_number']).strip()] = row['id']
+
+            # بناء lookup للعائلات والموردين
+            families = {}
+            for row in conn.execute("SELECT id, name FROM families"):
+                families[row['name'].lower()] = row['id']
+
+            suppliers = {}
+            for row in conn.execute("SELECT id, name FROM suppliers"):
+                suppliers[row['name'].lower()] = row['id']
+
+            # خريطة أسماء العائلات المختلفة
+            family_aliases = {
+                'flower': 'floral', 'flowers': 'floral', 'frutiy': 'fruity', 'fruit': 'fruity',
+                'marine': 'aquatic', 'wood': 'woody', 'woods': 'woody', 'spice': 'spicy',
+                'balsam': 'balsamic', 'anisic': 'aromatic', 'mint': 'aromatic',
+                'musk': 'musk', 'leather': 'leather',
+            }
 
-            name = item.get('name', '').strip()
-            if not name:
-                skipped += 1
-                continue
+            added = 0
+            updated = 0
+            skipped = 0
 
-            cas = item.get('cas_number', '').strip()
+            for row in rows:
+                item = {}
+                for sys_field, excel_col in field_to_col.items():
+                    val = str(row.get(excel_col, '')).strip()
+                    if val and val != '#DIV/0!':
+                        item[sys_field] = val
+                    else:
+                        item[sys_field] = ''
 
-            # Merge enriched data (only fill empty fields)
-            enriched = enriched_by_cas.get(cas) or enriched_by_name.get(name.lower()) or {}
-            for ekey, eval_ in enriched.items():
-                if ekey.startswith('_') or ekey in ('source_url', 'cid', 'pubchem_url', 'kind', 'uses_in_perfumery', 'molecular_formula', 'molecular_weight', 'iupac_name', 'logp', 'olfactive_family'):
+                name = item.get('name', '').strip()
+                if not name:
+                    skipped += 1
                     continue
-                if eval_ and not item.get(ekey):
-                    item[ekey] = str(eval_)
-
-            # MSDS data from enrichment
-            msds_signal = enriched.get('_msds_signal', '')
-            msds_h_codes = enriched.get('_msds_h_codes', '')
-            msds_p_codes = enriched.get('_msds_p_codes', '')
-            msds_pictograms = enriched.get('_msds_pictograms', '')
-            msds_classification = enriched.get('_msds_classification', '')
 
-            # تحقق من الموجود
-            exist_id = existing.get(name.lower()) or (existing.get('cas:' + cas) if cas else None)
+                cas = item.get('cas_number', '').strip()
 
-            if exist_id and not update_existing:
-                skipped += 1
-                continue
+                # Merge enriched data (only fill empty fields)
+                enriched = enriched_by_cas.get(cas) or enriched_by_name.get(name.lower()) or {}
+                for ekey, eval_ in enriched.items():
+                    if ekey.startswith('_') or ekey in ('source_url', 'cid', 'pubchem_url', 'kind', 'uses_in_perfumery', 'molecular_formula', 'molecular_weight', 'iupac_name', 'logp', 'olfactive_family'):
+                        continue
+                    if eval_ and not item.get(ekey):
+                        item[ekey] = str(eval_)
 
-            # ربط العائلة
-            family_id = None
-            family_text = item.get('family', '').strip().lower()
-            if family_text:
-                resolved = family_aliases.get(family_text, family_text)
-                family_id = families.get(resolved) or families.get(family_text)
-                if not family_id:
-                    # إنشاء عائلة جديدة
-                    cur = conn.execute("INSERT INTO families (name, name_ar, icon) VALUES (?, ?, ?)",
-                                       (item.get('family', '').strip(), '', '🏷️'))
-                    family_id = cur.lastrowid
-                    families[family_text] = family_id
-
-            # ربط المورد
-            supplier_id = None
-            supplier_text = item.get('supplier', '').strip()
-            if supplier_text:
-                supplier_id = suppliers.get(supplier_text.lower())
-                if not supplier_id:
-                    cur = conn.execute("INSERT INTO suppliers (name) VALUES (?)", (supplier_text,))
-                    supplier_id = cur.lastrowid
-                    suppliers[supplier_text.lower()] = supplier_id
-
-            # حساب السعر — احترم سعر الجرام إذا زوّده المستخدم مباشرة في الملف
-            price = 0
-            qty = 1
-            try:
-                price = float(item.get('purchase_price', 0) or 0)
-            except: pass
-            try:
-                qty = float(item.get('purchase_quantity', 1) or 1)
-            except: pass
-            ppg = 0
-            raw_ppg = (item.get('price_per_gram', '') or '').strip()
-            if raw_ppg:
-                try:
-                    ppg = float(raw_ppg)
-                except: pass
-            if ppg <= 0:
-                ppg = price / qty if qty > 0 else 0
+                # MSDS data from enrichment
+                msds_signal = enriched.get('_msds_signal', '')
+                msds_h_codes = enriched.get('_msds_h_codes', '')
+                msds_p_codes = enriched.get('_msds_p_codes', '')
+                msds_pictograms = enriched.get('_msds_pictograms', '')
+                msds_classification = enriched.get('_msds_classification', '')
 
-            # Profile
-            profile = item.get('profile', '').strip()
-            if profile and profile.lower() in ('top', 'heart', 'base'):
-                profile = profile.capitalize()
-            else:
-                profile = 'Heart'
+                # تحقق من الموجود
+                exist_id = existing.get(name.lower()) or (existing.get('cas:' + cas) if cas else None)
 
-            # IFRA
-            ifra = None
-            try:
-                ifra = float(item.get('ifra_limit', '') or 0) or None
-            except: pass
+                if exist_id and not update_existing:
+                    skipped += 1
+                    continue
 
-            if exist_id and update_existing:
-                in_stock_val = 0
+                # ربط العائلة
+                family_id = None
+                family_text = item.get('family', '').strip().lower()
+                if family_text:
+                    resolved = family_aliases.get(family_text, family_text)
+                    family_id = families.get(resolved) or families.get(family_text)
+                    if not family_id:
+                        # إنشاء عائلة جديدة
+                        cur = conn.execute("INSERT INTO families (name, name_ar, icon) VALUES (?, ?, ?)",
+                                           (item.get('family', '').strip(), '', '🏷️'))
+                        family_id = cur.lastrowid
+                        families[family_text] = family_id
+
+                # ربط المورد
+                supplier_id = None
+                supplier_text = item.get('supplier', '').strip()
+                if supplier_text:
+                    supplier_id = suppliers.get(supplier_text.lower())
+                    if not supplier_id:
+                        cur = conn.execute("INSERT INTO suppliers (name) VALUES (?)", (supplier_text,))
+                        supplier_id = cur.lastrowid
+                        suppliers[supplier_text.lower()] = supplier_id
+
+                # حساب السعر — احترم سعر الجرام إذا زوّده المستخدم مباشرة في الملف
+                price = 0
+                qty = 1
                 try:
-                    in_stock_val = float(item.get('in_stock', 0) or 0)
+                    price = float(item.get('purchase_price', 0) or 0)
                 except: pass
-                conn.execute('''UPDATE materials SET name=?, name_ar=?, cas_number=?, family_id=?,
-                    profile=?, supplier_id=?, ifra_limit=?, purchase_price=?, purchase_quantity=?,
-                    price_per_gram=?, odor_description=?, notes=?, flash_point=?, specific_gravity=?,
-                    color=?, appearance=?, physical_state=?,
-                    melting_point=?, boiling_point=?, refractive_index=?, solubility=?,
-                    vapor_density=?, ph=?,
-                    synonyms=?, lot=?, strength_odor=?, vapor_pressure=?,
-                    effect=?, recommended_smell_pct=?, properties=?, in_stock=? WHERE id=?''',
-                    (name, item.get('name_ar', ''), cas, family_id,
-                     profile, supplier_id, ifra, price, qty, ppg,
-                     item.get('odor_description', ''), item.get('notes', ''),
-                     item.get('flash_point', ''), item.get('specific_gravity', ''),
-                     item.get('color', ''), item.get('appearance', ''),
-                     item.get('physical_state', ''),
-                     item.get('melting_point', ''), item.get('boiling_point', ''),
-                     item.get('refractive_index', ''), item.get('solubility', ''),
-                     item.get('vapor_density', ''), item.get('ph', ''),
-                     item.get('synonyms', ''), item.get('lot', ''),
-                     item.get('strength_odor', ''), item.get('vapor_pressure', ''),
-                     item.get('effect', ''), item.get('recommended_smell_pct', ''),
-                     item.get('properties', ''), in_stock_val, exist_id))
-                mat_id = exist_id
-                updated += 1
-            else:
-                in_stock_val = 0
                 try:
-                    in_stock_val = float(item.get('in_stock', 0) or 0)
+                    qty = float(item.get('purchase_quantity', 1) or 1)
                 except: pass
-                cur = conn.execute('''INSERT INTO materials (name, name_ar, cas_number, family_id, profile,
-                    supplier_id, ifra_limit, purchase_price, purchase_quantity, price_per_gram,
-                    odor_description, notes, flash_point, specific_gravity, color, appearance, physical_state,
-                    melting_point, boiling_point, refractive_index, solubility, vapor_density, ph,
-                    synonyms, lot, strength_odor, vapor_pressure, effect, recommended_smell_pct, properties, in_stock)
-                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
-                    (name, item.get('name_ar', ''), cas, family_id,
-                     profile, supplier_id, ifra, price, qty, ppg,
-                     item.get('odor_description', ''), item.get('notes', ''),
-                     item.get('flash_point', ''), item.get('specific_gravity', ''),
-                     item.get('color', ''), item.get('appearance', ''),
-                     item.get('physical_state', ''),
-                     item.get('melting_point', ''), item.get('boiling_point', ''),
-                     item.get('refractive_index', ''), item.get('solubility', ''),
-                     item.get('vapor_density', ''), item.get('ph', ''),
-                     item.get('synonyms', ''), item.get('lot', ''),
-                     item.get('strength_odor', ''), item.get('vapor_pressure', ''),
-                     item.get('effect', ''), item.get('recommended_smell_pct', ''),
-                     item.get('properties', ''), in_stock_val))
-                mat_id = cur.lastrowid
-                existing[name.lower()] = mat_id
-                if cas:
-                    existing['cas:' + cas] = mat_id
-                added += 1
-
-            # Save MSDS data from enrichment
-            if msds_signal or msds_h_codes or msds_p_codes or msds_pictograms:
-                conn.execute("""INSERT OR REPLACE INTO material_msds
-                    (material_id, h_codes, p_codes, pictograms, signal_word, ghs_classification)
-                    VALUES (?,?,?,?,?,?)""",
-                    (mat_id, msds_h_codes, msds_p_codes, msds_pictograms, msds_signal, msds_classification))
+                ppg = 0
+                raw_ppg = (item.get('price_per_gram', '') or '').strip()
+                if raw_ppg:
+                    try:
+                        ppg = float(raw_ppg)
+                    except: pass
+                if ppg <= 0:
+                    ppg = price / qty if qty > 0 else 0
+
+                # Profile
+                profile = item.get('profile', '').strip()
+                if profile and profile.lower() in ('top', 'heart', 'base'):
+                    profile = profile.capitalize()
+                else:
+                    profile = 'Heart'
 
-            # تصنيف عطري تلقائي
-            if auto_olfactive and item.get('odor_description'):
-                scores = auto_classify_odor(item['odor_description'])
-                if any(v > 0 for v in scores.values()):
-                    conn.execute("""INSERT OR REPLACE INTO material_olfactive
-                        (material_id, citrus, aldehydic, aromatic, green, marine, floral, fruity,
-                         spicy, balsamic, woody, ambery, musky, leathery, animal)
-                        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                        (mat_id, *[scores[cat] for cat in OLFACTIVE_CATEGORIES]))
+                # IFRA
+                ifra = None
+                try:
+                    ifra = float(item.get('ifra_limit', '') or 0) or None
+                except: pass
 
-        conn.commit()
-        conn.close()
+                if exist_id and update_existing:
+                    in_stock_val = 0
+                    try:
+                        in_stock_val = float(item.get('in_stock', 0) or 0)
+                    except: pass
+                    conn.execute('''UPDATE materials SET name=?, name_ar=?, cas_number=?, family_id=?,
+                        profile=?, supplier_id=?, ifra_limit=?, purchase_price=?, purchase_quantity=?,
+                        price_per_gram=?, odor_description=?, notes=?, flash_point=?, specific_gravity=?,
+                        color=?, appearance=?, physical_state=?,
+                        melting_point=?, boiling_point=?, refractive_index=?, solubility=?,
+                        vapor_density=?, ph=?,
+                        synonyms=?, lot=?, strength_odor=?, vapor_pressure=?,
+                        effect=?, recommended_smell_pct=?, properties=?, in_stock=? WHERE id=?''',
+                        (name, item.get('name_ar', ''), cas, family_id,
+                         profile, supplier_id, ifra, price, qty, ppg,
+                         item.get('odor_description', ''), item.get('notes', ''),
+                         item.get('flash_point', ''), item.get('specific_gravity', ''),
+                         item.get('color', ''), item.get('appearance', ''),
+                         item.get('physical_state', ''),
+                         item.get('melting_point', ''), item.get('boiling_point', ''),
+                         item.get('refractive_index', ''), item.get('solubility', ''),
+                         item.get('vapor_density', ''), item.get('ph', ''),
+                         item.get('synonyms', ''), item.get('lot', ''),
+                         item.get('strength_odor', ''), item.get('vapor_pressure', ''),
+                         item.get('effect', ''), item.get('recommended_smell_pct', ''),
+                         item.get('properties', ''), in_stock_val, exist_id))
+                    mat_id = exist_id
+                    updated += 1
+                else:
+                    in_stock_val = 0
+                    try:
+                        in_stock_val = float(item.get('in_stock', 0) or 0)
+                    except: pass
+                    cur = conn.execute('''INSERT INTO materials (name, name_ar, cas_number, family_id, profile,
+                        supplier_id, ifra_limit, purchase_price, purchase_quantity, price_per_gram,
+                        odor_description, notes, flash_point, specific_gravity, color, appearance, physical_state,
+                        melting_point, boiling_point, refractive_index, solubility, vapor_density, ph,
+                        synonyms, lot, strength_odor, vapor_pressure, effect, recommended_smell_pct, properties, in_stock)
+                        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+                        (name, item.get('name_ar', ''), cas, family_id,
+                         profile, supplier_id, ifra, price, qty, ppg,
+                         item.get('odor_description', ''), item.get('notes', ''),
+                         item.get('flash_point', ''), item.get('specific_gravity', ''),
+                         item.get('color', ''), item.get('appearance', ''),
+                         item.get('physical_state', ''),
+                         item.get('melting_point', ''), item.get('boiling_point', ''),
+                         item.get('refractive_index', ''), item.get('solubility', ''),
+                         item.get('vapor_density', ''), item.get('ph', ''),
+                         item.get('synonyms', ''), item.get('lot', ''),
+                         item.get('strength_odor', ''), item.get('vapor_pressure', ''),
+                         item.get('effect', ''), item.get('recommended_smell_pct', ''),
+                         item.get('properties', ''), in_stock_val))
+                    mat_id = cur.lastrowid
+                    existing[name.lower()] = mat_id
+                    if cas:
+                        existing['cas:' + cas] = mat_id
+                    added += 1
+
+                # Save MSDS data from enrichment
+                if msds_signal or msds_h_codes or msds_p_codes or msds_pictograms:
+                    conn.execute("""INSERT OR REPLACE INTO material_msds
+                        (material_id, h_codes, p_codes, pictograms, signal_word, ghs_classification)
+                        VALUES (?,?,?,?,?,?)""",
+                        (mat_id, msds_h_codes, msds_p_codes, msds_pictograms, msds_signal, msds_classification))
+
+                # تصنيف عطري تلقائي
+                if auto_olfactive and item.get('odor_description'):
+                    scores = auto_classify_odor(item['odor_description'])
+                    if any(v > 0 for v in scores.values()):
+                        conn.execute("""INSERT OR REPLACE INTO material_olfactive
+                            (material_id, citrus, aldehydic, aromatic, green, marine, floral, fruity,
+                             spicy, balsamic, woody, ambery, musky, leathery, animal)
+                            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+                            (mat_id, *[scores[cat] for cat in OLFACTIVE_CATEGORIES]))
+
+            compact_material_changes(conn)
+            return added, updated, skipped
+
+        with import_running():
+            added, updated, skipped = db_write(write)
+        invalidate_mixture_limits()
+        refresh_material_typeahead(None)
 
         # حذف الملف المؤقت
         try:
@@ -4617,16 +7271,371 @@ def api_import_execute():
         log(f"[IMPORT ERROR] {e}")
         return jsonify({'success': False, 'message': str(e)})
 
+@contextmanager
+def scratch_database(journal_mode=None):
+    """Point DB_PATH at a temporary copy of the database for the duration,
+    for benchmarks and checks that must not touch the real data."""
+    global DB_PATH, DB_JOURNAL_MODE
+    get_db().close()  # the live database exists and is migrated
+    live_path, live_mode = DB_PATH, DB_JOURNAL_MODE
+    scratch = tempfile.mkdtemp(prefix='perfumery-')
+    DB_PATH = os.path.join(scratch, 'scratch.db')
+    DB_JOURNAL_MODE = journal_mode or live_mode
+    try:
+        copy_database(live_path, DB_PATH)
+        reset_db_pool()
+        _prepare_db((DB_PATH, _db_pool_generation))
+        yield DB_PATH
+    finally:
+        reset_db_pool()
+        DB_PATH, DB_JOURNAL_MODE = live_path, live_mode
+        shutil.rmtree(scratch, ignore_errors=True)
+
+@app.cli.command('db-bench')
+@click.option('--readers', default=8, type=int, help='Concurrent reader threads')
+@click.option('--rows', default=100000, type=int, help='Materials written by the simulated import')
+@click.option('--seconds', default=3.0, type=float, help='Length of the idle (no writer) phase')
+@click.option('--url', 'urls', multiple=True, help='GET endpoints to read (default: formulas, suppliers, notebook)')
+@click.option('--journal', type=click.Choice(['wal', 'delete']), default='wal',
+              help='Journal mode of the scratch copy (delete = the old default)')
+def db_bench_command(readers, rows, seconds, urls, journal):
+    """Read latency (p50/p95/p99) idle and while an import runs, on a scratch
+    copy of the database — the real one is not touched."""
+    urls = list(urls) or ['/api/formulas', '/api/suppliers', '/api/notebook/entries']
+    with scratch_database(journal.upper()):
+        def read_until(stop, latencies, errors):
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['user_id'] = 1
+                sess['user_name'] = 'bench'
+            i = 0
+            while not stop.is_set():
+                started = time.perf_counter()
+                resp = client.get(urls[i % len(urls)])
+                if not stop.is_set():  # reads still in flight at the end belong to neither phase
+                    latencies.append((time.perf_counter() - started) * 1000)
+                if resp.status_code != 200:
+                    errors.append(resp.status_code)
+                i += 1
+
+        def phase(label, during):
+            stop = threading.Event()
+            latencies, errors = [], []
+            threads = [threading.Thread(target=read_until, args=(stop, latencies, errors))
+                       for _ in range(readers)]
+            for t in threads:
+                t.start()
+            started = time.perf_counter()
+            during()
+            elapsed = time.perf_counter() - started
+            stop.set()
+            for t in threads:
+                t.join()
+            latencies.sort()
+            pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0
+            click.echo(f"{label:<14} {elapsed:7.2f}s  reads={len(latencies):<6} "
+                       f"p50={pick(0.50):7.1f}ms  p95={pick(0.95):7.1f}ms  p99={pick(0.99):7.1f}ms  "
+                       f"max={pick(1.0):7.1f}ms  errors={len(errors)}")
+
+        def import_rows(conn):
+            # Same shape as api_import_execute: one transaction, row by row
+            for i in range(rows):
+                conn.execute("""INSERT INTO materials (name, cas_number, profile, odor_description, notes)
+                    VALUES (?,?,?,?,?)""",
+                    (f'bench material {i}', f'{i}-00-0', 'Heart', 'woody amber ' * 20, 'db-bench ' * 10))
+
+        click.echo(f"journal={journal} readers={readers} urls={','.join(urls)}")
+        phase('idle', lambda: time.sleep(seconds))
+        phase(f'import {rows}', lambda: db_write(import_rows))
+
+@app.cli.command('db-pool-check')
+@click.option('--requests', 'n_requests', default=20, type=int, help='GETs to serve one after another')
+@click.option('--concurrent', default=4, type=int, help='Then this many at once, twice')
+def db_pool_check_command(n_requests, concurrent):
+    """Serve GETs through a real threaded server (a new thread per request, as
+    in production) on a scratch copy of the database; exit status 1 if they
+    open more connections than run at once, i.e. the pool is not reused."""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    import urllib.request
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+    urls = ['/api/formulas', '/api/suppliers', '/api/notebook/entries']
+    with scratch_database():
+        server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        cookie = app.session_interface.get_signing_serializer(app).dumps({'user_id': 1})
+
+        def fetch(url):
+            req = urllib.request.Request(f"http://127.0.0.1:{server.server_port}{url}",
+                                         headers={'Cookie': f"{app.config['SESSION_COOKIE_NAME']}={cookie}"})
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                resp.read()
+                return resp.status
+
+        try:
+            opened = _db_connects
+            statuses = [fetch(urls[i % len(urls)]) for i in range(n_requests)]
+            sequential = _db_connects - opened
+            with ThreadPoolExecutor(concurrent) as pool:
+                for _ in range(2):
+                    statuses += list(pool.map(fetch, [urls[i % len(urls)] for i in range(concurrent)]))
+            total = _db_connects - opened
+        finally:
+            server.shutdown()
+            server.server_close()
+    click.echo(f"{n_requests} sequential GETs opened {sequential} connection(s); "
+               f"with {concurrent} at once, {total} in all")
+    ok = all(s == 200 for s in statuses) and sequential <= 1 and total <= concurrent
+    if not ok:
+        click.echo("connections are not reused across requests" if all(s == 200 for s in statuses)
+                   else f"unexpected statuses: {sorted(set(statuses))}")
+        raise SystemExit(1)
+
+# ===== Query plans =====
+# The per-row queries of the hot endpoints, as they appear in the code (keep
+# in sync when one changes), with the tables each is allowed to scan in full:
+# a listing scans its own table, everything else must SEARCH an index.
+# check_query_plans() runs EXPLAIN QUERY PLAN on each; `flask db-plan` does it
+# on a seeded scratch copy and exits non-zero on any unexpected SCAN.
+def hot_queries():
+    """[(name, sql, params, allowed_scans)]"""
+    return [
+        ('formula ingredients', FORMULA_ROWS_SQL, (1,), ()),
+        ('draft ingredients', DRAFT_ROWS_SQL, (1,), ()),
+        ('formulas list', FORMULAS_LIST_SQL, (), ('f',)),  # all of them, in index order
+        ('formula summary refresh', formula_summary_sql('?'), (1,), ()),
+        ('notebook page', '''SELECT e.id, e.title, e.category, e.tags, e.updated_at, substr(e.body, 1, 120) AS excerpt
+            FROM notebook_entries e
+            WHERE e.updated_at <= ? AND (e.updated_at, e.id) < (?, ?)
+            ORDER BY e.updated_at DESC, e.id DESC LIMIT 51''', ('9', '9', 1), ()),
+        ('notebook page of a tag', '''SELECT e.id, e.title FROM notebook_entries e
+            WHERE e.id IN (SELECT entry_id FROM notebook_tags WHERE tag = ?)
+            ORDER BY e.updated_at DESC, e.id DESC LIMIT 51''', ('rose',), ()),
+        ('notebook tags', "SELECT tag, COUNT(*) AS n FROM notebook_tags GROUP BY tag ORDER BY tag", (),
+         ('notebook_tags',)),  # the tag cloud: all of them, in key order
+        ('table versions', "SELECT name, version FROM table_versions WHERE name IN (?, ?) ORDER BY name",
+         ('formulas', 'formula_summary'), ()),
+        ('materials changed since', '''SELECT m.id, m.name, m.cas_number
+            FROM (SELECT DISTINCT material_id FROM material_changes WHERE seq > ?) c
+            LEFT JOIN materials m ON m.id = c.material_id
+            ORDER BY COALESCE(m.name, ''), c.material_id''', (1000,), ('c',)),  # the changed ids, off a rowid range
+        ('materials search', f'''SELECT m.id, m.name, f.name AS family_name
+            FROM materials_fts JOIN materials m ON m.id = materials_fts.rowid
+            LEFT JOIN families f ON m.family_id = f.id
+            WHERE materials_fts MATCH ? ORDER BY bm25(materials_fts), m.id LIMIT 20''',
+         ('"plan"* "material"*',), ('materials_fts',)),  # the FTS index itself
+        ('materials catalogue page', f'''SELECT m.id, m.name, f.name AS family_name {_materials_from(['family_name'])}
+            WHERE {MATERIAL_SORTS['name']} >= ? AND ({MATERIAL_SORTS['name']}, m.id) > (?, ?)
+            ORDER BY {MATERIAL_SORTS['name']}, m.id LIMIT 101''', ('m', 'm', 1), ()),  # keyset: seeks the sort index
+        ('formula summary refresh of a material\'s formulas',
+         formula_summary_sql('SELECT formula_id FROM formula_ingredients WHERE material_id = ?'), (1,), ()),
+        ('formula scale / production items', '''SELECT fi.*, m.name, m.cas_number, m.price_per_gram
+            FROM formula_ingredients fi JOIN materials m ON fi.material_id = m.id
+            WHERE fi.formula_id=?''', (1,), ()),
+        ('ingredient already in formula',
+         "SELECT id FROM formula_ingredients WHERE formula_id=? AND material_id=?", (1, 1), ()),
+        ('material in use', "SELECT COUNT(*) FROM formula_ingredients WHERE material_id=?", (1,), ()),
+        ('formula drafts', """
+            SELECT fd.*, COUNT(di.id) as ingredients_count
+            FROM formula_drafts fd
+            LEFT JOIN draft_ingredients di ON di.draft_id = fd.id
+            WHERE fd.formula_id = ?
+            GROUP BY fd.id
+            ORDER BY fd.draft_number ASC""", (1,), ()),
+        ('formula notes', "SELECT * FROM formula_notes WHERE formula_id=? ORDER BY created_at DESC", (1,), ()),
+        ('mixture components', '''
+            SELECT mc.id, mc.component_material_id, mc.pct, mc.note,
+                   m.name, m.name_ar, m.cas_number, m.ifra_limit,
+                   m.price_per_gram, m.manual_ifra_cats
+            FROM material_composition mc
+            JOIN materials m ON mc.component_material_id = m.id
+            WHERE mc.parent_material_id = ?
+            ORDER BY mc.id''', (1,), ()),
+        ('composition edges', "SELECT parent_material_id, component_material_id, pct FROM material_composition "
+                              "WHERE parent_material_id IN (?,?) ORDER BY id", (1, 2), ()),
+        ('composition descendants', "SELECT DISTINCT component_material_id FROM material_composition "
+                                    "WHERE parent_material_id IN (?,?)", (1, 2), ()),
+        ('composition rows of a deleted material',
+         "DELETE FROM material_composition WHERE parent_material_id=? OR component_material_id=?", (1, 1), ()),
+        ('material files', '''
+            SELECT id, filename, mime_type, size, uploaded_at
+            FROM material_files WHERE material_id=?
+            ORDER BY uploaded_at DESC''', (1,), ()),
+        ('pending production orders', "SELECT COUNT(*) FROM production_orders WHERE status='pending'", (), ()),
+    ]
+
+def check_query_plans(conn):
+    """EXPLAIN QUERY PLAN every hot query. Returns [{'name', 'plan', 'scans'}],
+    scans being the full table scans it was not allowed."""
+    report = []
+    for name, sql, params, allowed in hot_queries():
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        # SCAN (subquery-N) reads a subquery's own result rows, not a table
+        scans = [step for step in plan
+                 if step.startswith('SCAN ') and step.split()[1] not in allowed
+                 and not step.split()[1].startswith('(')]
+        report.append({'name': name, 'plan': plan, 'scans': scans})
+    return report
+
+def seed_plan_database(conn, formulas):
+    """Fill a scratch database with `formulas` synthetic formulas (and the
+    materials, drafts, mixtures, files and orders around them) so the planner
+    sees realistic table sizes."""
+    base = conn.execute("SELECT COALESCE(MAX(id), 0) FROM materials").fetchone()[0] + 1
+    n_materials = formulas * 5
+    # A real install may have a single supplier: the planner would rather scan it than seek
+    conn.executemany("INSERT INTO families (name) VALUES (?)", [(f'plan family {i}',) for i in range(40)])
+    conn.executemany("INSERT INTO suppliers (name) VALUES (?)", [(f'plan supplier {i}',) for i in range(max(40, formulas // 20))])
+    families = [r[0] for r in conn.execute("SELECT id FROM families")]
+    suppliers = [r[0] for r in conn.execute("SELECT id FROM suppliers")]
+    conn.executemany("INSERT INTO materials (id, name, cas_number, price_per_gram, family_id, supplier_id) VALUES (?,?,?,?,?,?)",
+                     [(base + i, f'plan material {i}', f'{i}-00-0', 0.5,
+                       families[i % len(families)], suppliers[i % len(suppliers)]) for i in range(n_materials)])
+    conn.executemany("INSERT INTO material_composition (parent_material_id, component_material_id, pct) VALUES (?,?,?)",
+                     [(base + i, base + i + 1 + k, 10) for i in range(0, n_materials - 4, 7) for k in range(3)])
+    conn.executemany("INSERT INTO material_files (material_id, filename, mime_type, size, sha256) VALUES (?,?,?,?,?)",
+                     [(base + i, f'f{i}.pdf', 'application/pdf', 8192, hashlib.sha256(b'%d' % i).hexdigest())
+                      for i in range(0, n_materials, 10)])
+    fbase = conn.execute("SELECT COALESCE(MAX(id), 0) FROM formulas").fetchone()[0] + 1
+    conn.executemany("INSERT INTO formulas (id, name) VALUES (?,?)",
+                     [(fbase + f, f'plan formula {f}') for f in range(formulas)])
+    conn.executemany("INSERT INTO formula_ingredients (formula_id, material_id, weight, dilution) VALUES (?,?,?,?)",
+                     [(fbase + f, base + (f * 13 + k) % n_materials, 1, 1) for f in range(formulas) for k in range(20)])
+    conn.executemany("INSERT INTO formula_notes (formula_id, title, content) VALUES (?,?,?)",
+                     [(fbase + f, 'note', '') for f in range(formulas)])
+    conn.executemany("INSERT INTO formula_drafts (formula_id, draft_number, name) VALUES (?,?,?)",
+                     [(fbase + f, d, f'Draft {d}') for f in range(formulas) for d in range(1, 4)])
+    conn.execute('''INSERT INTO draft_ingredients (draft_id, material_id, weight, dilution)
+        SELECT fd.id, fi.material_id, fi.weight, fi.dilution
+        FROM formula_drafts fd JOIN formula_ingredients fi ON fi.formula_id = fd.formula_id
+        WHERE fd.formula_id >= ?''', (fbase,))
+    conn.executemany("INSERT INTO production_orders (formula_id, target_quantity, status) VALUES (?,?,?)",
+                     [(fbase + f, 100, 'done' if f % 10 else 'pending') for f in range(formulas)])
+    conn.executemany("INSERT INTO notebook_entries (title, category, tags, body) VALUES (?,?,?,?)",
+                     [(f'plan note {f}', 'idea', f'rose, tag{f % 50}', 'plan ' * 40) for f in range(formulas)])
+    conn.execute("ANALYZE")
+
+@app.cli.command('db-plan')
+@click.option('--formulas', default=5000, type=int, help='Synthetic formulas to seed (0: plan the real data as is)')
+@click.option('--verbose', '-v', is_flag=True, help='Print every plan, not only failures')
+def db_plan_command(formulas, verbose):
+    """EXPLAIN QUERY PLAN every hot query on a seeded scratch copy of the
+    database; exit status 1 if any of them scans a table in full."""
+    with scratch_database():
+        if formulas:
+            db_write(lambda conn: seed_plan_database(conn, formulas))
+        conn = get_db()
+        report = check_query_plans(conn)
+        conn.close()
+    failed = [r for r in report if r['scans']]
+    for r in report:
+        click.echo(f"{'FAIL' if r['scans'] else 'ok  '}  {r['name']}")
+        if verbose or r['scans']:
+            for step in r['plan']:
+                click.echo(f"        {step}")
+    click.echo(f"{len(report) - len(failed)}/{len(report)} queries use an index")
+    if failed:
+        raise SystemExit(1)
+
+@app.cli.command('ifra-sweep')
+@click.option('--ids', default='', help='Comma-separated formula ids (default: all)')
+@click.option('--status', default=None, help='Only formulas with this status, e.g. final')
+@click.option('--category', default=None, help='Only formulas in this IFRA category, e.g. cat4')
+@click.option('--all-categories', is_flag=True, help='Also report E3/N3 for all 18 categories')
+@click.option('--workers', default=0, type=int, help='Worker count (default: CPU count, max 8)')
+@click.option('--threads', is_flag=True, help='Use threads instead of forked processes')
+@click.option('-o', '--output', type=click.File('w', encoding='utf-8'), default='-',
+              help='NDJSON file (default: stdout, mixed with log lines)')
+def cli_ifra_sweep(ids, status, category, all_categories, workers, threads, output):
+    """Check every formula against IFRA and write one NDJSON record per formula."""
+    for record in run_ifra_sweep(_parse_ids(ids), status, category, all_categories,
+                                 workers or None, use_processes=not threads):
+        click.echo(json.dumps(record, ensure_ascii=False), file=output)
+
+@app.cli.command('ifra-sweep-check')
+def cli_ifra_sweep_check():
+    """Sweep a few in-memory formulas whose verdicts are known (no database
+    involved); exit status 1 if any record disagrees."""
+    def standard(sid, name, cas, standard_type, value):
+        row = {'lookup_cas': cas, 'id': sid, 'ifra_key': f'CHECK_{sid}', 'name': name,
+               'standard_type': standard_type}
+        row.update({k: value(k) for k in IFRA_CAT_KEYS})
+        return row
+
+    ifra = build_ifra_index([
+        # SPECIFICATION standards carry no value in any category: unrestricted
+        standard(1, 'Linalool', '78-70-6', 'SPECIFICATION', lambda k: None),
+        standard(2, 'Banned', '1-1-1', 'PROHIBITION', lambda k: 0),
+        standard(3, 'Restricted', '2-2-2', 'RESTRICTION', lambda k: -1 if k == 'cat12' else 1.0),
+    ])
+    materials = {1: ('Linalool', '78-70-6'), 2: ('Banned', '1-1-1'), 3: ('Restricted', '2-2-2'), 4: ('Carrier', '')}
+    composition = CompositionIndex(
+        {mid: {'name': name, 'cas_number': cas, 'ifra_limit': None, 'manual_ifra_cats': {}, 'price_per_gram': 0}
+         for mid, (name, cas) in materials.items()}, {})
+    evaluator = FormulaEvaluator(ifra, {}, composition)
+
+    # (formula, category, {material id: weight}, compliant, violations as
+    #  (name, prohibited), categories listing a prohibited material)
+    cases = [
+        ('linalool only', 'cat4', {1: 10, 4: 90}, True, [], 0),
+        ('banned material', 'cat4', {1: 10, 2: 1, 4: 89}, False, [('Banned', True)], len(IFRA_CAT_KEYS)),
+        ('restriction exceeded', 'cat4', {1: 10, 3: 5, 4: 85}, False, [('Restricted', False)], 0),
+        ('unknown category (read as cat4)', 'catX', {1: 10, 3: 5, 4: 85}, False, [('Restricted', False)], 0),
+    ]
+    failed = 0
+    for fid, (label, category, weights, compliant, violations, prohibited_cats) in enumerate(cases, 1):
+        rows = [{'id': mid, 'material_id': mid, 'name': materials[mid][0], 'cas_number': materials[mid][1],
+                 'weight': weight, 'dilution': 100, 'ifra_limit': None, 'manual_ifra_cats': None,
+                 'price_per_gram': 0}
+                for mid, weight in weights.items()]
+        formula = {'id': fid, 'name': label, 'status': 'final', 'ifra_category': category}
+        record = sweep_formula(evaluator, formula, rows, all_categories=True)
+        got = (record['compliant'],
+               [(v['name'], v['prohibited']) for v in record['violations']],
+               sum(1 for c in record['categories'].values() if c['prohibited']))
+        ok = got == (compliant, violations, prohibited_cats)
+        failed += not ok
+        click.echo(f"{'ok  ' if ok else 'FAIL'}  {label}" + ('' if ok else f"  got {got}"))
+    click.echo(f"{len(cases) - failed}/{len(cases)} sweep verdicts as expected")
+    if failed:
+        raise SystemExit(1)
+
+@app.cli.command('ifra-impact')
+@click.argument('workbook', type=click.Path(exists=True, dir_okay=False))
+@click.option('--label', default='', help='Name for the staged amendment')
+@click.option('-o', '--output', type=click.File('w', encoding='utf-8'), default='-',
+              help='JSON report file (default: stdout)')
+def cli_ifra_impact(workbook, label, output):
+    """Stage a new IFRA standards workbook and report the formulas it affects."""
+    conn = get_db()
+    aid = stage_ifra_amendment(conn, workbook, label, os.path.basename(workbook))
+    conn.commit()
+    conn.close()
+    click.echo(json.dumps(ifra_amendment_impact(aid), ensure_ascii=False, indent=2), file=output)
+
 def bootstrap():
     """One-shot init used by both the dev entrypoint and the desktop launcher."""
+    global _db_schema_ready
     log("Starting My Perfumery v3...")
-    init_db()
+    migrate_db()
+    _db_schema_ready = (DB_PATH, _db_pool_generation)
+    adopt_legacy_backups()
+    _backup_scheduler.start()
     import_ifra_standards()
     import_ifra_contributions()
+    get_ifra_index()
+    get_contributions_index()
 
 if __name__ == '__main__':
-    bootstrap()
     port = int(os.environ.get('MYPERFUMERY_PORT', '8000'))
     host = os.environ.get('MYPERFUMERY_HOST', '0.0.0.0')
     debug = os.environ.get('MYPERFUMERY_DEBUG', '0' if IS_FROZEN else '1') == '1'
+    # With the reloader this process only watches files and restarts the
+    # child that serves requests; bootstrapping here too would run a second
+    # backup scheduler racing the child's on the backup chain
+    # (_backup_lock does not reach across processes).
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        bootstrap()
     app.run(host=host, port=port, debug=debug, use_reloader=debug)